@@ -0,0 +1,280 @@
+import os
+import time
+import struct
+import zipfile
+import threading
+import argparse
+import numpy as np
+
+CACHE_VERSION = 2
+_ARRAYS = ('names', 'mtimes', 'sizes', 'offsets', 'bad_lines', 'image_ids', 'class_ids', 'boxes')
+
+
+def default_cache_dir(label_dir):
+    # Hidden sibling of the label directory, so scripts that list label_dir never see it
+    label_dir = os.path.abspath(label_dir)
+    return os.path.join(os.path.dirname(label_dir), f'.{os.path.basename(label_dir)}.index')
+
+
+def load_npz_mmap(path):
+    # Memory-map every array of an uncompressed .npz (as written by np.savez) instead of reading it into
+    # memory, which np.load does for archives even with mmap_mode. Each member is a plain .npy stored at a
+    # fixed offset in the zip, so after its local header and .npy header the data can be mapped directly.
+    arrays = {}
+    with open(path, 'rb') as f, zipfile.ZipFile(f) as archive:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED or not info.filename.endswith('.npy'):
+                raise ValueError(f"{path}: {info.filename} is not an uncompressed .npy member")
+            f.seek(info.header_offset)
+            local_header = f.read(30)
+            name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            name = info.filename[:-len('.npy')]
+            if dtype.hasobject:
+                raise ValueError(f"{path}: {name} holds Python objects")
+            if not int(np.prod(shape)):
+                arrays[name] = np.zeros(shape, dtype)  # empty arrays can't be mapped
+            else:
+                arrays[name] = np.memmap(path, dtype, 'r', f.tell(), shape, 'F' if fortran_order else 'C')
+    return arrays
+
+
+def parse_label_file(path):
+    # Returns (class_ids, boxes, bad_lines) for one YOLO label file
+    with open(path, 'r') as f:
+        return parse_label_text(f.read())
+
+
+def parse_label_text(text):
+    # Same as parse_label_file, for the contents of a label file (e.g. read from a packed dataset)
+    rows = [line.split() for line in text.splitlines() if line.strip()]
+    parsed = None
+    bad_lines = 0
+    if all(len(row) == 5 for row in rows):
+        try:
+            parsed = np.array(rows, dtype=np.float64).reshape(-1, 5)
+        except ValueError:
+            parsed = None
+    if parsed is None:
+        # Slow path: at least one malformed line, keep the valid ones and count the rest
+        valid = []
+        for row in rows:
+            try:
+                if len(row) != 5:
+                    raise ValueError(row)
+                valid.append([float(p) for p in row])
+            except ValueError:
+                bad_lines += 1
+        parsed = np.array(valid, dtype=np.float64).reshape(-1, 5)
+    return parsed[:, 0].astype(np.int32), parsed[:, 1:].astype(np.float32), bad_lines
+
+
+def malformed_lines(text):
+    # (line number, reason) of every non-empty line of a label file that parse_label_text skips
+    problems = []
+    for number, line in enumerate(text.splitlines(), 1):
+        row = line.split()
+        if not row:
+            continue
+        if len(row) != 5:
+            problems.append((number, f'{len(row)} columns, expected 5'))
+            continue
+        try:
+            [float(p) for p in row]
+        except ValueError:
+            problems.append((number, 'non-numeric value'))
+    return problems
+
+
+def scan_label_dir(label_dir):
+    # (name, mtime_ns, size) of every .txt file, sorted by name
+    entries = []
+    with os.scandir(label_dir) as it:
+        for entry in it:
+            if entry.name.endswith('.txt') and entry.is_file():
+                st = entry.stat()
+                entries.append((entry.name, st.st_mtime_ns, st.st_size))
+    entries.sort()
+    return entries
+
+
+class AnnotationIndex:
+    # All boxes of a YOLO label directory as flat arrays: one row per box with the index of its
+    # label file (image_ids), its class id and its (x_center, y_center, width, height) as float32.
+    # offsets[i]:offsets[i + 1] are the rows of names[i].
+    def __init__(self, label_dir, names, mtimes, sizes, offsets, bad_lines, image_ids, class_ids, boxes):
+        self.label_dir = label_dir
+        self.names = names
+        self.mtimes = mtimes
+        self.sizes = sizes
+        self.offsets = offsets
+        self.bad_lines = bad_lines
+        self.image_ids = image_ids
+        self.class_ids = class_ids
+        self.boxes = boxes
+        self.reparsed = 0
+
+    def __len__(self):
+        return len(self.class_ids)
+
+    @property
+    def num_files(self):
+        return len(self.names)
+
+    @classmethod
+    def load(cls, label_dir, cache_dir=None, use_cache=True):
+        # Load the cached index for label_dir, reparsing only files whose mtime or size changed
+        cache_dir = cache_dir or default_cache_dir(label_dir)
+        entries = scan_label_dir(label_dir)
+        cached = cls._read_cache(label_dir, cache_dir) if use_cache else None
+
+        if cached is not None and len(cached.names) == len(entries):
+            names = cached.names.tolist()
+            if (names == [e[0] for e in entries]
+                    and np.array_equal(cached.mtimes, [e[1] for e in entries])
+                    and np.array_equal(cached.sizes, [e[2] for e in entries])):
+                return cached
+
+        previous = {}
+        if cached is not None:
+            for i, (name, mtime, size) in enumerate(zip(cached.names.tolist(), cached.mtimes, cached.sizes)):
+                previous[name] = (i, mtime, size)
+
+        class_chunks, box_chunks, counts, bad_lines = [], [], [], []
+        reparsed = 0
+        for name, mtime, size in entries:
+            hit = previous.get(name)
+            if hit is not None and hit[1] == mtime and hit[2] == size:
+                start, end = cached.offsets[hit[0]], cached.offsets[hit[0] + 1]
+                class_ids, boxes, bad = cached.class_ids[start:end], cached.boxes[start:end], cached.bad_lines[hit[0]]
+            else:
+                class_ids, boxes, bad = parse_label_file(os.path.join(label_dir, name))
+                reparsed += 1
+            class_chunks.append(class_ids)
+            box_chunks.append(boxes)
+            counts.append(len(class_ids))
+            bad_lines.append(bad)
+
+        counts = np.array(counts, dtype=np.int64)
+        offsets = np.zeros(len(entries) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        index = cls(label_dir,
+                    np.array([e[0] for e in entries], dtype=str),
+                    np.array([e[1] for e in entries], dtype=np.int64),
+                    np.array([e[2] for e in entries], dtype=np.int64),
+                    offsets,
+                    np.array(bad_lines, dtype=np.int32),
+                    np.repeat(np.arange(len(entries), dtype=np.int32), counts),
+                    np.concatenate(class_chunks).astype(np.int32) if class_chunks else np.zeros(0, np.int32),
+                    np.concatenate(box_chunks).astype(np.float32) if box_chunks else np.zeros((0, 4), np.float32))
+        index.reparsed = reparsed
+        if use_cache:
+            index.save(cache_dir)
+        return index
+
+    @classmethod
+    def _read_cache(cls, label_dir, cache_dir):
+        path = os.path.join(cache_dir, 'index.npz')
+        if not os.path.exists(path):
+            return None
+        try:
+            data = load_npz_mmap(path)
+            if int(data['version']) != CACHE_VERSION:
+                return None
+            arrays = {name: data[name] for name in _ARRAYS}
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile, struct.error):
+            return None
+        return cls(label_dir, **arrays)
+
+    def save(self, cache_dir):
+        # One uncompressed .npz (memory-mapped by the next load) swapped in with a single rename, so concurrent
+        # loads of the same labels (each saving under its own temporary name) never see a mix of two indexes,
+        # and readers still mapping the old file keep it until they are done. The cache is only an optimisation:
+        # when it can't be written (e.g. a read-only dataset) the next load just parses the labels again.
+        tmp_path = os.path.join(cache_dir, f'index.{os.getpid()}.{threading.get_ident()}.tmp.npz')
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.savez(tmp_path, version=CACHE_VERSION, **{name: np.asarray(getattr(self, name)) for name in _ARRAYS})
+            os.replace(tmp_path, os.path.join(cache_dir, 'index.npz'))
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def class_counts(self, num_classes=None):
+        # Number of boxes per class id
+        return np.bincount(self.class_ids, minlength=num_classes or 0)
+
+    def file_class_counts(self, num_classes=None):
+        # (num_files, num_classes) matrix of boxes per class in each file
+        num_classes = max(num_classes or 0, int(self.class_ids.max()) + 1 if len(self) else 0)
+        counts = np.zeros((self.num_files, num_classes), dtype=np.int32)
+        np.add.at(counts, (self.image_ids, self.class_ids), 1)
+        return counts
+
+    def files_with_classes(self, class_ids):
+        # Names of the label files containing at least one box of any of class_ids
+        mask = np.isin(self.class_ids, list(class_ids))
+        return self.names[np.unique(self.image_ids[mask])].tolist()
+
+    def rows_of(self, name):
+        i = int(np.searchsorted(self.names, name))
+        if i >= self.num_files or self.names[i] != name:
+            raise KeyError(name)
+        return slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    def export_yolo(self, output_dir, mask=None, class_map=None):
+        # Write one YOLO label file per indexed file (empty if no rows survive the mask).
+        # class_map optionally renumbers classes: an array mapping old class id -> new class id.
+        os.makedirs(output_dir, exist_ok=True)
+        mask = np.ones(len(self), dtype=bool) if mask is None else np.asarray(mask, dtype=bool)
+        class_ids = np.asarray(self.class_ids) if class_map is None else np.asarray(class_map)[self.class_ids]
+        boxes = np.asarray(self.boxes)
+        for i, name in enumerate(self.names.tolist()):
+            start, end = self.offsets[i], self.offsets[i + 1]
+            keep = mask[start:end]
+            with open(os.path.join(output_dir, name), 'w') as f:
+                f.writelines(f"{c} {x:.6f} {y:.6f} {w:.6f} {h:.6f}\n"
+                             for c, (x, y, w, h) in zip(class_ids[start:end][keep].tolist(),
+                                                        boxes[start:end][keep].tolist()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or update the cached annotation index of a YOLO label directory.')
+    parser.add_argument('label_dir', type=str, help='Directory containing YOLO label files.')
+    parser.add_argument('classes_file', type=str, help='File containing class names.')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Where to keep the index (default: next to label_dir).')
+    parser.add_argument('--export_dir', type=str, default=None, help='Optionally export the labels back to YOLO text.')
+    parser.add_argument('--keep_classes', type=str, default=None,
+                        help='Comma separated class names to keep when exporting (default: all).')
+    args = parser.parse_args()
+
+    with open(args.classes_file, 'r') as f:
+        class_names = [line.strip() for line in f.readlines()]
+
+    start = time.perf_counter()
+    index = AnnotationIndex.load(args.label_dir, args.cache_dir)
+    print(f"Indexed {index.num_files} files / {len(index)} boxes in {time.perf_counter() - start:.3f}s "
+          f"({index.reparsed} files reparsed, {int(index.bad_lines.sum())} malformed lines)")
+
+    for class_name, count in zip(class_names, index.class_counts(len(class_names))):
+        print(f"  {class_name}: {count}")
+
+    if args.export_dir:
+        mask = None
+        if args.keep_classes:
+            keep_ids = [class_names.index(name.strip()) for name in args.keep_classes.split(',')]
+            mask = np.isin(index.class_ids, keep_ids)
+        index.export_yolo(args.export_dir, mask)
+        print(f"Exported labels to {args.export_dir}")
+
+
+if __name__ == '__main__':
+    main()
+
+# python annotation_index.py yolo_labels classes.txt
+# python annotation_index.py augmented_data/all_labels classes.txt --export_dir augmented_data/labels --keep_classes person
@@ -0,0 +1,251 @@
+import os
+import ast
+import glob
+
+import cv2
+import numpy as np
+
+from two_stage import Detections, LetterboxPool, empty_detections, unletterbox_boxes, yolo_detector
+from image_io import IMAGE_EXTENSIONS
+from tiling import nms
+
+BACKENDS = ('torch', 'onnx', 'openvino')
+
+
+def infer_backend(weights):
+    # .pt -> torch, .onnx -> onnx, an OpenVINO .xml or ultralytics' *_openvino_model directory -> openvino
+    if os.path.isdir(weights) or weights.endswith('.xml'):
+        return 'openvino'
+    if weights.endswith('.onnx'):
+        return 'onnx'
+    return 'torch'
+
+
+def parse_names(text):
+    # Class names as stored in ultralytics export metadata: the repr of a {id: name} dict
+    if not text:
+        return None
+    try:
+        return {int(k): v for k, v in ast.literal_eval(text).items()}
+    except (ValueError, SyntaxError, AttributeError):
+        return None
+
+
+def to_tensor(batch):
+    # (N, H, W, 3) uint8 BGR -> (N, 3, H, W) float32 RGB in [0, 1], the ultralytics input format
+    tensor = batch[..., ::-1].transpose(0, 3, 1, 2).astype(np.float32)
+    tensor *= 1 / 255
+    return tensor
+
+
+def postprocess(output, conf=0.25, iou=0.7, max_det=300, max_candidates=3000):
+    # One image of a YOLOv8 detect head output, (4 + num_classes, anchors) with xywh boxes in input pixels,
+    # to Detections: confidence filter, best class per anchor and class-aware NMS, all in NumPy
+    scores_all = output[4:].T
+    classes = scores_all.argmax(axis=1)
+    scores = scores_all[np.arange(len(classes)), classes]
+    keep = np.flatnonzero(scores > conf)
+    if len(keep) == 0:
+        return empty_detections()
+    if len(keep) > max_candidates:
+        keep = keep[np.argpartition(-scores[keep], max_candidates)[:max_candidates]]
+
+    xc, yc, w, h = output[:4, keep]
+    boxes = np.stack([xc - w / 2, yc - h / 2, xc + w / 2, yc + h / 2], axis=1).astype(np.float32)
+    dets = nms(Detections(boxes, scores[keep].astype(np.float32), classes[keep].astype(int)), iou, 'iou')
+    return Detections(dets.boxes[:max_det], dets.scores[:max_det], dets.classes[:max_det])
+
+
+class NumpyYOLODetector:
+    # Detector callable for an exported YOLOv8 model: letterboxing, tensor conversion and NMS in NumPy,
+    # so neither torch nor ultralytics is needed at inference time. Subclasses provide `forward`.
+    # Models exported with a fixed batch size are run in chunks of that size.
+    letterboxes = True
+
+    def __init__(self, imgsz=640, batch_size=None, conf=0.25, iou=0.7, names=None):
+        self.imgsz = imgsz
+        self.batch_size = batch_size
+        self.conf = conf
+        self.iou = iou
+        self.names = names or {}
+        self.pool = LetterboxPool(imgsz)
+
+    @property
+    def params(self):
+        # Inference parameters affecting the detections (result_cache.cache_namespace)
+        return {'conf': self.conf, 'iou': self.iou, 'imgsz': self.imgsz}
+
+    def forward(self, tensor):
+        raise NotImplementedError
+
+    def __call__(self, images):
+        images = list(images)
+        step = self.batch_size or max(len(images), 1)
+        results = []
+        for start in range(0, len(images), step):
+            chunk = images[start:start + step]
+            batch, params = self.pool.batch(chunk)
+            tensor = to_tensor(batch)
+            if self.batch_size and len(chunk) < self.batch_size:
+                # Static batch dimension: pad the last chunk
+                tensor = np.concatenate([tensor, np.zeros((self.batch_size - len(chunk),) + tensor.shape[1:],
+                                                          np.float32)])
+            outputs = self.forward(tensor)
+            for image, (r, pad), output in zip(chunk, params, outputs):
+                dets = postprocess(output, self.conf, self.iou)
+                results.append(Detections(unletterbox_boxes(dets.boxes, r, pad, image.shape), dets.scores,
+                                          dets.classes))
+        return results
+
+
+class OnnxDetector(NumpyYOLODetector):
+    def __init__(self, model_path, imgsz=None, conf=0.25, iou=0.7, threads=None, names=None):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        batch_size, _, height, _ = model_input.shape
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        super().__init__(imgsz or (height if isinstance(height, int) else 640),
+                         batch_size if isinstance(batch_size, int) else None, conf, iou,
+                         names or parse_names(metadata.get('names')))
+
+    def forward(self, tensor):
+        return self.session.run(None, {self.input_name: tensor})[0]
+
+
+class OpenVINODetector(NumpyYOLODetector):
+    def __init__(self, model_path, imgsz=None, conf=0.25, iou=0.7, threads=None, names=None):
+        import openvino as ov
+        if os.path.isdir(model_path):
+            model_path = glob.glob(os.path.join(model_path, '*.xml'))[0]
+        core = ov.Core()
+        model = core.read_model(model_path)
+        config = {'PERFORMANCE_HINT': 'LATENCY'}
+        if threads:
+            config['INFERENCE_NUM_THREADS'] = threads
+        self.compiled = core.compile_model(model, 'CPU', config)
+        shape = model.input(0).get_partial_shape()
+        batch_size = shape[0].get_length() if shape[0].is_static else None
+        height = shape[2].get_length() if shape[2].is_static else None
+        super().__init__(imgsz or height or 640, batch_size, conf, iou,
+                         names or self._metadata_names(os.path.dirname(model_path)))
+
+    @staticmethod
+    def _metadata_names(model_dir):
+        # ultralytics writes the class names next to the model in metadata.yaml
+        path = os.path.join(model_dir, 'metadata.yaml')
+        if not os.path.exists(path):
+            return None
+        import yaml
+        with open(path) as f:
+            return {int(k): v for k, v in (yaml.safe_load(f) or {}).get('names', {}).items()}
+
+    def forward(self, tensor):
+        return self.compiled(tensor)[0]
+
+
+def load_detector(weights, backend=None, imgsz=None, conf=0.25, iou=0.7, threads=None):
+    # Detector callable (list of images -> list of Detections, with .names) for any supported backend.
+    # imgsz defaults to the size the model was exported (or trained) at.
+    backend = backend or infer_backend(weights)
+    if backend == 'onnx':
+        return OnnxDetector(weights, imgsz, conf, iou, threads)
+    if backend == 'openvino':
+        return OpenVINODetector(weights, imgsz, conf, iou, threads)
+    from ultralytics import YOLO
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+    kwargs = {'imgsz': imgsz} if imgsz else {}
+    return yolo_detector(YOLO(weights), conf=conf, iou=iou, **kwargs)
+
+
+def export_model(weights, backend='onnx', imgsz=640, dynamic=True):
+    # Export ultralytics weights, returns the exported path (.onnx file or *_openvino_model directory)
+    from ultralytics import YOLO
+    if backend == 'onnx':
+        return YOLO(weights).export(format='onnx', imgsz=imgsz, dynamic=dynamic, simplify=True)
+    return YOLO(weights).export(format='openvino', imgsz=imgsz, dynamic=dynamic)
+
+
+def calibration_tensors(image_dir, imgsz=640, samples=300, seed=0):
+    # (1, 3, imgsz, imgsz) inputs from a random sample of a directory of images (e.g. the person crops
+    # written by crop_images.py for the PPE model), preprocessed exactly like at inference time
+    names = sorted(f for f in os.listdir(image_dir) if f.lower().endswith(IMAGE_EXTENSIONS))
+    rng = np.random.default_rng(seed)
+    names = [names[i] for i in rng.permutation(len(names))[:samples]]
+    pool = LetterboxPool(imgsz)
+    for name in names:
+        image = cv2.imread(os.path.join(image_dir, name))
+        if image is not None:
+            batch, _ = pool.batch([image])
+            yield to_tensor(batch)
+
+
+def detect_head_nodes(model_path):
+    # Names of the nodes in the last top-level module of an ultralytics export (the Detect head:
+    # box decoding, DFL and the final concat), which lose the most accuracy when quantised
+    import onnx
+    nodes = onnx.load(model_path).graph.node
+    modules = [node.name.split('/')[1] for node in nodes if node.name.startswith('/model.')]
+    if not modules:
+        return []
+    head = max(modules, key=lambda m: int(m.split('.')[1]))
+    return [node.name for node in nodes if node.name.startswith(f'/{head}/')]
+
+
+def quantize_onnx_int8(model_path, output_path, calibration_dir, imgsz=640, samples=300, seed=0,
+                       quantize_head=False):
+    # Static INT8 quantisation (QDQ, per-channel weights) calibrated on our own images
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+    import onnxruntime as ort
+
+    prepared_path = os.path.splitext(output_path)[0] + '.prep.onnx'
+    quant_pre_process(model_path, prepared_path)
+    input_name = ort.InferenceSession(prepared_path, providers=['CPUExecutionProvider']).get_inputs()[0].name
+
+    class Reader(CalibrationDataReader):
+        def __init__(self):
+            self.tensors = calibration_tensors(calibration_dir, imgsz, samples, seed)
+
+        def get_next(self):
+            tensor = next(self.tensors, None)
+            return None if tensor is None else {input_name: tensor}
+
+    quantize_static(prepared_path, output_path, Reader(), quant_format=QuantFormat.QDQ, per_channel=True,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                    nodes_to_exclude=[] if quantize_head else detect_head_nodes(prepared_path))
+    os.remove(prepared_path)
+
+    # Keep the class names of the original export
+    import onnx
+    source, quantized = onnx.load(model_path), onnx.load(output_path)
+    del quantized.metadata_props[:]
+    quantized.metadata_props.extend(source.metadata_props)
+    onnx.save(quantized, output_path)
+    return output_path
+
+
+def quantize_openvino_int8(model_path, output_dir, calibration_dir, imgsz=640, samples=300, seed=0):
+    # Post-training INT8 quantisation with NNCF, leaving the box decoding ops of the head in float
+    import nncf
+    import shutil
+    import openvino as ov
+    source_dir = model_path if os.path.isdir(model_path) else os.path.dirname(model_path)
+    xml_path = glob.glob(os.path.join(model_path, '*.xml'))[0] if os.path.isdir(model_path) else model_path
+    model = ov.Core().read_model(xml_path)
+    dataset = nncf.Dataset(list(calibration_tensors(calibration_dir, imgsz, samples, seed)))
+    quantized = nncf.quantize(model, dataset, preset=nncf.QuantizationPreset.MIXED, subset_size=samples,
+                              ignored_scope=nncf.IgnoredScope(types=['Multiply', 'Subtract', 'Sigmoid']))
+    os.makedirs(output_dir, exist_ok=True)
+    ov.save_model(quantized, os.path.join(output_dir, os.path.basename(xml_path)))
+    if os.path.exists(os.path.join(source_dir, 'metadata.yaml')):
+        shutil.copy(os.path.join(source_dir, 'metadata.yaml'), output_dir)
+    return output_dir
@@ -0,0 +1,172 @@
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from two_stage import letterbox, person_crops, restore_detections, assemble_result
+
+
+class BatchMetrics:
+    def __init__(self):
+        self.batch_sizes = []
+        self.latencies = []  # submit -> result, per request
+        self.waits = []  # submit -> batch start, per request
+        self.busy = 0.0
+
+    def summary(self):
+        latencies = np.asarray(self.latencies) * 1000
+        waits = np.asarray(self.waits) * 1000
+        sizes = np.asarray(self.batch_sizes)
+
+        def pct(values, q):
+            return float(np.percentile(values, q)) if len(values) else 0.0
+
+        return {
+            'requests': int(len(latencies)),
+            'batches': int(len(sizes)),
+            'mean_batch_size': float(sizes.mean()) if len(sizes) else 0.0,
+            'max_batch_size': int(sizes.max()) if len(sizes) else 0,
+            'latency_p50_ms': pct(latencies, 50),
+            'latency_p95_ms': pct(latencies, 95),
+            'latency_p99_ms': pct(latencies, 99),
+            'wait_p50_ms': pct(waits, 50),
+            'busy_s': self.busy,
+        }
+
+
+class MicroBatcher:
+    # Collects single-image requests into batches for one detector. A batch is dispatched as soon as it
+    # holds max_batch_size requests or the oldest request has waited max_wait seconds. Lane 0 is the
+    # highest priority and is always drained first. The detector runs on an executor thread so the
+    # event loop keeps accepting requests while a batch is in flight.
+    def __init__(self, detector, max_batch_size=16, max_wait=0.005, lanes=2, executor=None):
+        self.detector = detector
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.lanes = lanes
+        self.executor = executor
+        self.metrics = BatchMetrics()
+        self.queues = None
+        self.task = None
+        self.batch = []  # requests taken off the queues and not yet answered
+
+    def start(self):
+        self.queues = [asyncio.Queue() for _ in range(self.lanes)]
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        # Fail whatever was still waiting, so no submitter hangs on a future nobody will resolve
+        pending = self.batch
+        self.batch = []
+        for q in self.queues or ():
+            while not q.empty():
+                pending.append(q.get_nowait())
+        for _, future, _ in pending:
+            if not future.done():
+                future.set_exception(RuntimeError('batch scheduler stopped'))
+
+    async def submit(self, image, priority=0):
+        future = asyncio.get_running_loop().create_future()
+        lane = min(max(priority, 0), self.lanes - 1)
+        self.queues[lane].put_nowait((image, future, time.perf_counter()))
+        self.wakeup.set()
+        return await future
+
+    def _take(self, batch):
+        for q in self.queues:
+            while len(batch) < self.max_batch_size and not q.empty():
+                batch.append(q.get_nowait())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = self.batch = []
+            self.wakeup.clear()
+            self._take(batch)
+            if not batch:
+                await self.wakeup.wait()
+                continue
+
+            # Wait for more requests until the batch is full or the oldest request's deadline passes
+            deadline = min(item[2] for item in batch) + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+                self._take(batch)
+
+            batch = self.batch = [item for item in batch if not item[1].cancelled()]
+            if not batch:
+                continue
+            started = time.perf_counter()
+            try:
+                outputs = await loop.run_in_executor(self.executor, self.detector, [item[0] for item in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finished = time.perf_counter()
+
+            self.metrics.batch_sizes.append(len(batch))
+            self.metrics.busy += finished - started
+            for (_, future, submitted), output in zip(batch, outputs):
+                self.metrics.waits.append(started - submitted)
+                self.metrics.latencies.append(finished - submitted)
+                if not future.done():
+                    future.set_result(output)
+
+
+class TwoStageScheduler:
+    # Person and PPE micro-batchers in front of the two models of inf.py. Full frames from any number of
+    # concurrent callers are batched for the person model; their person crops are letterboxed and batched,
+    # across frames, for the PPE model.
+    def __init__(self, person_detector, ppe_detector, imgsz=640, max_batch_size=16, ppe_max_batch_size=64,
+                 max_wait=0.005, ppe_max_wait=0.002, lanes=2):
+        # One thread per model: each model only ever runs one batch at a time
+        self.executors = [ThreadPoolExecutor(1), ThreadPoolExecutor(1)]
+        self.person = MicroBatcher(person_detector, max_batch_size, max_wait, lanes, self.executors[0])
+        self.ppe = MicroBatcher(ppe_detector, ppe_max_batch_size, ppe_max_wait, lanes, self.executors[1])
+        self.imgsz = imgsz
+
+    def start(self):
+        self.person.start()
+        self.ppe.start()
+
+    async def stop(self):
+        await self.person.stop()
+        await self.ppe.stop()
+        for executor in self.executors:
+            executor.shutdown(wait=False)
+
+    async def detect_persons(self, frame, priority=0):
+        return await self.person.submit(frame, priority)
+
+    async def detect_ppe(self, crops, priority=0):
+        prepared = [letterbox(crop, self.imgsz) for crop in crops]
+        outputs = await asyncio.gather(*(self.ppe.submit(image, priority) for image, _, _ in prepared))
+        return [restore_detections(dets, r, pad, crop.shape)
+                for crop, (_, r, pad), dets in zip(crops, prepared, outputs)]
+
+    async def detect(self, frame, priority=0):
+        persons = await self.detect_persons(frame, priority)
+        regions, valid, crops = person_crops(frame, persons)
+        ppe = await self.detect_ppe(crops, priority)
+        return assemble_result(persons, regions, dict(zip(valid, ppe)))
+
+    def metrics(self):
+        return {'person': self.person.metrics.summary(), 'ppe': self.ppe.metrics.summary()}
@@ -0,0 +1,75 @@
+import os
+import time
+import argparse
+
+import cv2
+
+from backends import infer_backend, load_detector
+from detection_metrics import evaluate_detector
+from image_io import IMAGE_EXTENSIONS
+
+
+def time_detector(detector, images, batch_size, repeats):
+    detector(images[:batch_size])  # warmup
+    start = time.perf_counter()
+    count = 0
+    for _ in range(repeats):
+        for i in range(0, len(images), batch_size):
+            detector(images[i:i + batch_size])
+            count += len(images[i:i + batch_size])
+    return (time.perf_counter() - start) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CPU latency (with thread-count tuning) and mAP parity of the '
+                                                 'inference backends for one model.')
+    parser.add_argument('models', nargs='+',
+                        help='The same model in several formats, the first one is the reference, '
+                             'e.g. ppe_detection.pt ppe_detection.onnx ppe_detection_int8.onnx.')
+    parser.add_argument('--image_dir', type=str, default='inference_on_sample_test_set', help='Images to time.')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, os.cpu_count()],
+                        help='Thread counts to try.')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1], help='Images per call to time.')
+    parser.add_argument('--repeats', type=int, default=3, help='Passes over the images per measurement.')
+    parser.add_argument('--eval_images', type=str, default=None,
+                        help='Held-out split images for the mAP parity check (e.g. ppe_dataset/test/images).')
+    parser.add_argument('--eval_labels', type=str, default=None, help='YOLO labels of the held-out split.')
+    parser.add_argument('--eval_limit', type=int, default=None, help='Evaluate on at most this many images.')
+    args = parser.parse_args()
+
+    names = sorted(f for f in os.listdir(args.image_dir) if f.lower().endswith(IMAGE_EXTENSIONS))
+    images = [cv2.imread(os.path.join(args.image_dir, name)) for name in names]
+
+    print(f"{'model':>32} {'backend':>8} {'threads':>7} {'batch':>5} {'ms/image':>9}")
+    best = {}
+    for model in args.models:
+        backend = infer_backend(model)
+        for threads in sorted(set(args.threads)):
+            detector = load_detector(model, backend, threads=threads)
+            for batch_size in args.batch_sizes:
+                latency = time_detector(detector, images, batch_size, args.repeats)
+                print(f"{os.path.basename(model.rstrip('/')):>32} {backend:>8} {threads:>7} {batch_size:>5} "
+                      f"{latency * 1000:>9.1f}")
+                if model not in best or latency < best[model][0]:
+                    best[model] = (latency, threads, batch_size)
+    print('Fastest setting per model:')
+    for model, (latency, threads, batch_size) in best.items():
+        print(f'  {model}: {latency * 1000:.1f} ms/image with {threads} threads, batch {batch_size}')
+
+    if args.eval_images and args.eval_labels:
+        print(f"{'model':>32} {'mAP50':>7} {'mAP50-95':>9} {'delta':>7}")
+        reference = None
+        for model in args.models:
+            # Low confidence threshold, as when validating with ultralytics, so mAP sees the full PR curve
+            detector = load_detector(model, threads=best[model][1], conf=0.001)
+            metrics = evaluate_detector(detector, args.eval_images, args.eval_labels, limit=args.eval_limit)
+            reference = metrics['map50_95'] if reference is None else reference
+            print(f"{os.path.basename(model.rstrip('/')):>32} {metrics['map50']:>7.4f} {metrics['map50_95']:>9.4f} "
+                  f"{metrics['map50_95'] - reference:>+7.4f}")
+
+
+if __name__ == '__main__':
+    main()
+
+# python benchmark_backends.py ppe_detection.pt ppe_detection.onnx ppe_detection_int8.onnx --image_dir cropped/images
+# python benchmark_backends.py person_detection.pt person_detection.onnx person_detection_int8.onnx --batch_sizes 1 4 --eval_images person_dataset/test/images --eval_labels person_dataset/test/labels
@@ -0,0 +1,159 @@
+import os
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+
+def make_synthetic_dataset(root, num_images, width=1920, height=1080, seed=0):
+    # Camera-like JPEGs (smooth noise compresses like real frames, unlike white noise) with person and PPE labels
+    images_dir, labels_dir = os.path.join(root, 'images'), os.path.join(root, 'labels')
+    os.makedirs(images_dir)
+    os.makedirs(labels_dir)
+    rng = np.random.default_rng(seed)
+    base = cv2.resize(rng.integers(0, 255, (height // 16, width // 16, 3), dtype=np.uint8), (width, height))
+    for i in range(num_images):
+        noise = rng.integers(-12, 12, (height, width, 3), dtype=np.int16)
+        image = np.clip(np.roll(base, 37 * i, axis=1).astype(np.int16) + noise, 0, 255).astype(np.uint8)
+        cv2.imwrite(os.path.join(images_dir, f'{i:06d}.jpg'), image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        lines = []
+        for _ in range(3):
+            px, py = rng.uniform(0.2, 0.8, 2)
+            lines.append(f"0 {px:.6f} {py:.6f} 0.2 0.5\n")
+            lines += [f"{c} {px + dx:.6f} {py + dy:.6f} 0.05 0.05\n"
+                      for c, dx, dy in zip(rng.integers(1, 10, 3), rng.uniform(-0.05, 0.05, 3),
+                                           rng.uniform(-0.2, 0.2, 3))]
+        with open(os.path.join(labels_dir, f'{i:06d}.txt'), 'w') as f:
+            f.writelines(lines)
+    return images_dir, labels_dir
+
+
+def _reset_peak_rss():
+    # Linux resets the peak (VmHWM) to the current RSS, so the peak left by the imports doesn't hide the scenario's
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return _peak_rss_mb()
+
+
+def _run(scenario, mode, images_dir, labels_dir, output_dir, cache_mb):
+    # Runs in a fresh process so peak RSS belongs to this scenario alone
+    import image_io
+    from PIL import Image
+    from crop_images import process_image
+    from corrupt_files_detection import check_image
+    from data_augmentation import flip_sample
+
+    image_io.image_cache.resize(cache_mb << 20)
+    names = sorted(os.listdir(images_dir))
+    paths = [os.path.join(images_dir, name) for name in names]
+    _reset_peak_rss()
+    baseline = _rss_mb()
+    start = time.perf_counter()
+
+    if scenario == 'view_annotations':
+        # Preview decode: full resolution before, DCT-scaled after
+        for path in paths:
+            image = cv2.imread(path) if mode == 'before' else image_io.read_image(path, 2)
+            cv2.rectangle(image, (10, 10), (100, 100), (0, 0, 255), 2)
+    elif scenario == 'corrupt_files_detection':
+        for path in paths:
+            if mode == 'before':
+                with Image.open(path) as img:
+                    img.verify()
+                with Image.open(path) as img:
+                    img.load()
+            else:
+                check_image(path, full_decode=True)
+    elif scenario == 'size_probe':
+        # Dimensions for label normalisation: decoded shape before, header only after
+        for path in paths:
+            if mode == 'before':
+                cv2.imread(path).shape[:2]
+            else:
+                image_io.image_size(path)
+    elif scenario == 'build_flip_then_crop':
+        # What a build.py worker does: its whole flip stage, then its whole crop stage, over the same sources.
+        # The crop stage only hits the cache while the sources flipped earlier are still in it, i.e. when a
+        # worker's share of the dataset fits in --cache_mb; the cache is disabled before and used after.
+        cache = image_io.image_cache if mode == 'after' else None
+        for d in ('flipped', 'crops/images', 'crops/labels'):
+            os.makedirs(os.path.join(output_dir, d), exist_ok=True)
+        labels = [os.path.join(labels_dir, os.path.splitext(name)[0] + '.txt') for name in names]
+        for name, path, label in zip(names, paths, labels):
+            flip_sample(path, label, os.path.join(output_dir, 'flipped', name),
+                        os.path.join(output_dir, 'flipped', os.path.splitext(name)[0] + '.txt'), cache=cache)
+        for path, label in zip(paths, labels):
+            process_image(path, label, os.path.join(output_dir, 'crops/images'), os.path.join(output_dir, 'crops/labels'),
+                          cache=cache)
+    seconds = time.perf_counter() - start
+    return seconds, baseline, _peak_rss_mb(), image_io.image_cache.hits
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark image decoding of the dataset tools with and without '
+                                                 'image_io (reduced decoding, header probing, shared cache).')
+    parser.add_argument('--num_images', type=int, default=60, help='Synthetic 1080p JPEGs.')
+    parser.add_argument('--cache_mb', type=int, default=512, help='Decoded image cache budget.')
+    parser.add_argument('--image_dir', type=str, default=None,
+                        help='Use these images (and --label_dir) instead of a synthetic dataset.')
+    parser.add_argument('--label_dir', type=str, default=None, help='Labels of --image_dir.')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='image_io_bench_')
+    try:
+        if args.image_dir:
+            images_dir, labels_dir = args.image_dir, args.label_dir
+        else:
+            images_dir, labels_dir = make_synthetic_dataset(os.path.join(root, 'data'), args.num_images)
+        num_images = len(os.listdir(images_dir))
+        print(f"{num_images} images")
+        print(f"{'tool':<26}{'mode':<8}{'ms/image':>10}{'peak RSS MB':>13}{'above base':>12}{'cache hits':>12}")
+        context = multiprocessing.get_context('spawn')
+        for scenario in ('view_annotations', 'corrupt_files_detection', 'size_probe', 'build_flip_then_crop'):
+            for mode in ('before', 'after'):
+                output_dir = os.path.join(root, f'{scenario}_{mode}')
+                with ProcessPoolExecutor(1, mp_context=context) as pool:
+                    seconds, baseline, peak, hits = pool.submit(_run, scenario, mode, images_dir, labels_dir,
+                                                                output_dir, args.cache_mb).result()
+                print(f"{scenario:<26}{mode:<8}{1000 * seconds / num_images:>10.2f}{peak:>13.0f}"
+                      f"{peak - baseline:>12.0f}{hits:>12}")
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
+
+# python benchmark_image_io.py
+# python benchmark_image_io.py --num_images 200 --cache_mb 256
+# python benchmark_image_io.py --image_dir augmented_data/images --label_dir augmented_data/all_labels
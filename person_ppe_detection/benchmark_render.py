@@ -0,0 +1,79 @@
+import time
+import argparse
+
+import cv2
+import numpy as np
+
+from render import CLASS_COLORS, FONT, class_color, draw_detections
+
+
+def baseline_draw(image, boxes, classes, names, scores=None, font_scale=0.5):
+    # The drawing view_annotations.py did before render.py: anti-aliased rectangles and a putText per box
+    for k, (x1, y1, x2, y2) in enumerate(boxes.astype(int).tolist()):
+        color = CLASS_COLORS[classes[k] % len(CLASS_COLORS)]
+        text = names[classes[k]] if scores is None else f'{names[classes[k]]} {scores[k]:.2f}'
+        cv2.rectangle(image, (x1, y1), (x2, y2), color, 2, lineType=cv2.LINE_AA)
+        cv2.putText(image, text, (x1, y1 - 10), FONT, font_scale, color, 1, lineType=cv2.LINE_AA)
+    return image
+
+
+def puttext_draw(image, boxes, classes, names, scores=None, font_scale=0.5):
+    # render.draw_detections with the label rasterised by putText on every box instead of the glyph cache
+    for k, (x1, y1, x2, y2) in enumerate(boxes.astype(int).tolist()):
+        color = class_color(classes[k])
+        text = names[classes[k]] if scores is None else f'{names[classes[k]]} {scores[k]:.2f}'
+        cv2.rectangle(image, (x1, y1), (x2, y2), color, 2)
+        ascent = cv2.getTextSize(text, FONT, font_scale, 1)[0][1]
+        y = y1 - 10 if y1 - 10 >= ascent else y1 + ascent + 2
+        cv2.putText(image, text, (x1, y), FONT, font_scale, color, 1, cv2.LINE_AA)
+    return image
+
+
+def make_boxes(count, size, seed=0):
+    w, h = size
+    rng = np.random.default_rng(seed)
+    x1 = rng.uniform(0, w * 0.9, count)
+    y1 = rng.uniform(0, h * 0.9, count)
+    boxes = np.stack([x1, y1, x1 + rng.uniform(0.02, 0.1, count) * w, y1 + rng.uniform(0.05, 0.2, count) * h], axis=1)
+    return boxes.astype(np.float32), rng.integers(0, 9, count).tolist(), rng.uniform(0, 1, count).tolist()
+
+
+def time_draw(draw, image, boxes, classes, names, scores, font_scale, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        canvas = image.copy()
+        start = time.perf_counter()
+        draw(canvas, boxes, classes, names, scores, font_scale=font_scale)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark label drawing: glyph cache against putText per box.')
+    parser.add_argument('--classes_file', type=str, default='cropped_classes.txt', help='Class names.')
+    parser.add_argument('--boxes', type=int, nargs='+', default=[10, 40, 200], help='Boxes per image.')
+    parser.add_argument('--repeats', type=int, default=50, help='Timed repeats (the fastest counts).')
+    args = parser.parse_args()
+
+    with open(args.classes_file, 'r') as f:
+        names = f.read().strip().split('\n')
+
+    print(f"{'image':>10} {'boxes':>6} {'labels':>7} {'baseline ms':>12} {'putText ms':>11} {'cached ms':>10}")
+    for size, font_scale in (((1920, 1080), 0.5), ((160, 160), 0.35)):
+        image = np.full((size[1], size[0], 3), 96, np.uint8)
+        for count in args.boxes:
+            boxes, classes, scores = make_boxes(count, size)
+            for label_scores in (None, scores):
+                draw_detections(image.copy(), boxes, classes, names, label_scores, font_scale=font_scale)  # warm cache
+                times = [time_draw(draw, image, boxes, classes, names, label_scores, font_scale, args.repeats)
+                         for draw in (baseline_draw, puttext_draw, draw_detections)]
+                kind = 'name' if label_scores is None else 'score'
+                print(f"{size[0]}x{size[1]:<5} {count:>6} {kind:>7} " + ' '.join(
+                    f"{t * 1000:>{width}.3f}" for t, width in zip(times, (12, 11, 10))))
+
+
+if __name__ == '__main__':
+    main()
+
+# python benchmark_render.py
+# python benchmark_render.py --boxes 40 --repeats 200
@@ -0,0 +1,94 @@
+import time
+import asyncio
+import argparse
+import numpy as np
+
+from two_stage import StubDetector
+from batch_scheduler import TwoStageScheduler
+
+
+def make_frames(count, width, height, seed=0):
+    rng = np.random.default_rng(seed)
+    return [rng.integers(0, 255, (height, width, 3), dtype=np.uint8) for _ in range(count)]
+
+
+async def run_load(scheduler, frames, clients, requests_per_client, high_priority_every=0, rate=0.0, seed=0):
+    # Without a rate each client sends its next frame as soon as the previous one is answered (closed loop).
+    # With a rate, each client sends frames with Poisson arrivals at rate / clients per second whether or
+    # not earlier ones were answered (open loop), which is how independent cameras behave.
+    latencies = {0: [], 1: []}
+    rng = np.random.default_rng(seed)
+
+    async def request(frame, priority):
+        start = time.perf_counter()
+        await scheduler.detect(frame, priority)
+        latencies[priority].append(time.perf_counter() - start)
+
+    async def client(index):
+        pending = []
+        for i in range(requests_per_client):
+            priority = 0 if high_priority_every and i % high_priority_every == 0 else 1
+            frame = frames[(index + i) % len(frames)]
+            if not rate:
+                await request(frame, priority)
+                continue
+            pending.append(asyncio.ensure_future(request(frame, priority)))
+            await asyncio.sleep(rng.exponential(clients / rate))
+        await asyncio.gather(*pending)
+
+    scheduler.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(clients)))
+    elapsed = time.perf_counter() - start
+    await scheduler.stop()
+    return elapsed, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput and latency of the micro-batching scheduler '
+                                                 'for different batching deadlines.')
+    parser.add_argument('--max_wait_ms', type=float, nargs='+', default=[0, 2, 5, 10, 20],
+                        help='Batching deadlines to benchmark in milliseconds.')
+    parser.add_argument('--clients', type=int, default=16, help='Concurrent clients.')
+    parser.add_argument('--requests', type=int, default=20, help='Frames sent per client.')
+    parser.add_argument('--rate', type=float, default=0.0,
+                        help='Total frames per second sent by the clients (default: 0, closed loop).')
+    parser.add_argument('--persons', type=int, default=4, help='Persons per frame returned by the stub.')
+    parser.add_argument('--max_batch_size', type=int, default=16, help='Maximum frames per person forward pass.')
+    parser.add_argument('--ppe_max_batch_size', type=int, default=64, help='Maximum crops per PPE forward pass.')
+    parser.add_argument('--imgsz', type=int, default=320, help='PPE model input size.')
+    parser.add_argument('--high_priority_every', type=int, default=4,
+                        help='Every n-th request of a client goes in the high priority lane (0 disables).')
+    parser.add_argument('--call_latency', type=float, default=0.008,
+                        help='Stub fixed cost per forward pass in seconds (default: 0.008).')
+    parser.add_argument('--image_latency', type=float, default=0.0005,
+                        help='Stub cost per image in a batch in seconds (default: 0.0005).')
+    args = parser.parse_args()
+
+    frames = make_frames(8, 640, 480)
+    print(f"{'wait ms':>7} {'frames/s':>9} {'person bs':>9} {'ppe bs':>7} {'p50 ms':>7} {'p99 ms':>7} "
+          f"{'hi p50':>7} {'hi p99':>7}")
+    for max_wait_ms in args.max_wait_ms:
+        person_detector = StubDetector(boxes_per_image=args.persons, latency=args.call_latency,
+                                       per_image_latency=args.image_latency)
+        ppe_detector = StubDetector(boxes_per_image=3, num_classes=9, latency=args.call_latency,
+                                    per_image_latency=args.image_latency)
+        scheduler = TwoStageScheduler(person_detector, ppe_detector, args.imgsz, args.max_batch_size,
+                                      args.ppe_max_batch_size, max_wait_ms / 1000, max_wait_ms / 1000)
+        elapsed, latencies = asyncio.run(run_load(scheduler, frames, args.clients, args.requests,
+                                                  args.high_priority_every, args.rate))
+        metrics = scheduler.metrics()
+        low = np.asarray(latencies[1] or [0]) * 1000
+        high = np.asarray(latencies[0] or [0]) * 1000
+        total = args.clients * args.requests
+        print(f"{max_wait_ms:>7.1f} {total / elapsed:>9.1f} {metrics['person']['mean_batch_size']:>9.1f} "
+              f"{metrics['ppe']['mean_batch_size']:>7.1f} {np.percentile(low, 50):>7.1f} "
+              f"{np.percentile(low, 99):>7.1f} {np.percentile(high, 50):>7.1f} {np.percentile(high, 99):>7.1f}")
+
+
+if __name__ == '__main__':
+    main()
+
+# python benchmark_scheduler.py
+# python benchmark_scheduler.py --clients 64 --max_wait_ms 0 5 10
+# python benchmark_scheduler.py --clients 32 --rate 150 --requests 40
@@ -0,0 +1,75 @@
+import os
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import numpy as np
+
+from annotation_index import AnnotationIndex
+from split_dataset import group_class_counts, assign_groups, split_report, print_report
+
+
+def make_synthetic_dataset(root, num_labels, num_classes=10, boxes_per_file=5, seed=0):
+    # Empty image files plus YOLO labels with a long-tailed class distribution and the same kinds of
+    # derived names the pipeline produces (f_ flips and _pN crops)
+    images_dir, labels_dir = os.path.join(root, 'images'), os.path.join(root, 'labels')
+    os.makedirs(images_dir)
+    os.makedirs(labels_dir)
+    rng = np.random.default_rng(seed)
+    class_p = 1.0 / np.arange(1, num_classes + 1) ** 1.5
+    class_p /= class_p.sum()
+
+    num_files = num_labels // boxes_per_file
+    for i in range(num_files):
+        source = i // 4
+        variant = i % 4
+        stem = [f'{source:07d}', f'f_{source:07d}', f'{source:07d}_p1', f'f_{source:07d}_p1'][variant]
+        classes = rng.choice(num_classes, size=boxes_per_file, p=class_p)
+        boxes = rng.uniform(0.05, 0.95, (boxes_per_file, 4))
+        with open(os.path.join(labels_dir, stem + '.txt'), 'w') as f:
+            f.writelines(f"{c} {x:.6f} {y:.6f} {w:.6f} {h:.6f}\n" for c, (x, y, w, h) in zip(classes, boxes))
+        open(os.path.join(images_dir, stem + '.jpg'), 'wb').close()
+    return images_dir, labels_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the stratified, group-aware splitter.')
+    parser.add_argument('--num_labels', type=int, default=1000000, help='Total boxes in the synthetic dataset.')
+    parser.add_argument('--num_classes', type=int, default=10, help='Number of classes.')
+    parser.add_argument('--keep', type=str, default=None, help='Keep the synthetic dataset in this directory.')
+    args = parser.parse_args()
+
+    root = args.keep or tempfile.mkdtemp(prefix='split_bench_')
+    try:
+        start = time.perf_counter()
+        images_dir, labels_dir = make_synthetic_dataset(os.path.join(root, 'data'), args.num_labels, args.num_classes)
+        print(f"Generated {args.num_labels} labels in {time.perf_counter() - start:.1f}s")
+
+        start = time.perf_counter()
+        index = AnnotationIndex.load(labels_dir)
+        index_time = time.perf_counter() - start
+        start = time.perf_counter()
+        AnnotationIndex.load(labels_dir)
+        cached_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        image_files = sorted(os.listdir(images_dir))
+        groups, counts, sizes = group_class_counts(image_files, index)
+        split_of_group = assign_groups(counts, sizes, [0.7, 0.1, 0.2])
+        split_time = time.perf_counter() - start
+
+        print(f"Index build {index_time:.2f}s, cached reload {cached_time:.2f}s, "
+              f"grouping + assignment {split_time:.2f}s for {len(image_files)} images in {len(sizes)} groups")
+        print(f"Peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+        print_report(split_report(['train', 'val', 'test'], split_of_group, counts, sizes))
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
+
+# python benchmark_split.py
+# python benchmark_split.py --num_labels 100000
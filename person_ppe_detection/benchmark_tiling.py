@@ -0,0 +1,100 @@
+import os
+import time
+import argparse
+
+import cv2
+import numpy as np
+
+from two_stage import StubDetector, yolo_detector
+from image_io import IMAGE_EXTENSIONS
+from tiling import MERGE_METHODS, box_overlap, sliced_detector
+
+
+def load_boxes(label_path, shape):
+    # Ground truth person boxes from a YOLO label file, in pixels
+    if not os.path.exists(label_path):
+        return np.zeros((0, 4), np.float32)
+    rows = np.loadtxt(label_path, ndmin=2, usecols=(1, 2, 3, 4)).astype(np.float32)
+    h, w = shape[:2]
+    xc, yc, bw, bh = rows[:, 0] * w, rows[:, 1] * h, rows[:, 2] * w, rows[:, 3] * h
+    return np.stack([xc - bw / 2, yc - bh / 2, xc + bw / 2, yc + bh / 2], axis=1)
+
+
+def matched(pred, truth, threshold=0.5):
+    # Number of truth boxes matched one-to-one by predictions (greedy in score order)
+    if len(truth) == 0 or len(pred.scores) == 0:
+        return 0
+    overlap = box_overlap(pred.boxes[np.argsort(-pred.scores)], truth)
+    free = np.ones(len(truth), bool)
+    for row in overlap:
+        row = np.where(free, row, 0)
+        best = row.argmax()
+        if row[best] >= threshold:
+            free[best] = False
+    return int((~free).sum())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recall gained by sliced person detection against its extra compute.')
+    parser.add_argument('--weights', type=str, default='person_detection.pt', help='Person model weights.')
+    parser.add_argument('--image_dir', type=str, default='inference_on_sample_test_set', help='Images to run on.')
+    parser.add_argument('--label_dir', type=str, default=None,
+                        help='YOLO person labels; without them recall is measured against a high resolution pass.')
+    parser.add_argument('--imgsz', type=int, default=640, help='Model input size (default: 640, as in args.yaml).')
+    parser.add_argument('--reference_imgsz', type=int, default=1920,
+                        help='Input size of the high resolution reference pass when there are no labels.')
+    parser.add_argument('--tile_sizes', type=int, nargs='+', default=[640, 320, 256],
+                        help='Tile sizes to benchmark. The bundled samples are 500 px wide, so tiles smaller than '
+                             'the model input show the same effect as 640 px tiles on 4K frames.')
+    parser.add_argument('--overlap', type=float, default=0.2, help='Tile overlap fraction.')
+    parser.add_argument('--merge', choices=MERGE_METHODS, default='nms', help='Duplicate merging across tiles.')
+    parser.add_argument('--stub', action='store_true', help='Use a stub model (checks the plumbing, not recall).')
+    args = parser.parse_args()
+
+    if args.stub:
+        base = reference = StubDetector(boxes_per_image=5)
+    else:
+        from ultralytics import YOLO
+        model = YOLO(args.weights)
+        base = yolo_detector(model, imgsz=args.imgsz)
+        reference = yolo_detector(model, imgsz=args.reference_imgsz)
+
+    names = sorted(f for f in os.listdir(args.image_dir) if f.lower().endswith(IMAGE_EXTENSIONS))
+    images = [cv2.imread(os.path.join(args.image_dir, name)) for name in names]
+    if args.label_dir:
+        truths = [load_boxes(os.path.join(args.label_dir, os.path.splitext(name)[0] + '.txt'), image.shape)
+                  for name, image in zip(names, images)]
+        truth_source = 'labels'
+    else:
+        truths = [dets.boxes for dets in reference(images)]
+        truth_source = f'imgsz {args.reference_imgsz} pass'
+    total = sum(len(t) for t in truths)
+    print(f'{len(images)} images, {total} persons in {truth_source}')
+
+    modes = [('full frame', base)]
+    for tile_size in args.tile_sizes:
+        for full_frame in (False, True):
+            label = f"tiles {tile_size}{' + full' if full_frame else ''}"
+            modes.append((label, sliced_detector(base, tile_size, args.overlap, full_frame, args.merge)))
+
+    print(f"{'mode':>18} {'recall':>7} {'persons':>8} {'model inputs':>13} {'ms/image':>9} {'cost':>6}")
+    baseline_time = None
+    for label, detector in modes:
+        detector(images[:1])  # warmup
+        if hasattr(detector, 'forward_images'):
+            detector.forward_images = 0
+        start = time.perf_counter()
+        outputs = [detector([image])[0] for image in images]
+        elapsed = (time.perf_counter() - start) / len(images)
+        baseline_time = baseline_time or elapsed
+        inputs = getattr(detector, 'forward_images', len(images))
+        found = sum(matched(dets, truth) for dets, truth in zip(outputs, truths))
+        print(f"{label:>18} {found / max(total, 1):>7.3f} {sum(len(d.scores) for d in outputs):>8} "
+              f"{inputs:>13} {elapsed * 1000:>9.1f} {elapsed / baseline_time:>5.1f}x")
+
+
+if __name__ == '__main__':
+    main()
+
+# python benchmark_tiling.py
+# python benchmark_tiling.py --image_dir site_cameras/images --label_dir site_cameras/labels --tile_sizes 640 --merge wbf
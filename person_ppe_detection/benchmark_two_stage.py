@@ -0,0 +1,89 @@
+import time
+import argparse
+import tracemalloc
+import numpy as np
+
+from two_stage import TwoStagePipeline, StubDetector, yolo_detector
+
+
+def make_frame(width, height, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+
+
+def time_pipeline(pipeline, frame, repeats):
+    pipeline(frame)  # warmup
+    start = time.perf_counter()
+    for _ in range(repeats):
+        pipeline(frame)
+    return (time.perf_counter() - start) / repeats
+
+
+def profile_allocations(pipeline, frame, repeats):
+    # Peak memory allocated while processing one frame, after a warmup frame has sized any reusable buffers
+    pipeline(frame)
+    tracemalloc.start()
+    peak = 0
+    for _ in range(repeats):
+        tracemalloc.reset_peak()
+        pipeline(frame)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare per-crop and batched PPE inference throughput.')
+    parser.add_argument('--person_counts', type=int, nargs='+', default=[1, 5, 10, 25, 50],
+                        help='Number of persons per frame to benchmark.')
+    parser.add_argument('--repeats', type=int, default=10, help='Frames timed per configuration.')
+    parser.add_argument('--max_batch_size', type=int, default=32, help='Maximum crops per PPE forward pass.')
+    parser.add_argument('--imgsz', type=int, default=640, help='PPE model input size.')
+    parser.add_argument('--ppe_weights', type=str, default=None,
+                        help='Optional PPE weights to benchmark a real model instead of the stub.')
+    parser.add_argument('--call_latency', type=float, default=0.008,
+                        help='Stub fixed cost per forward pass in seconds (default: 0.008).')
+    parser.add_argument('--image_latency', type=float, default=0.001,
+                        help='Stub cost per image in a batch in seconds (default: 0.001).')
+    parser.add_argument('--profile_memory', type=int, default=0, metavar='PERSONS',
+                        help='Instead of timing, profile allocations (tracemalloc) on a frame with this many '
+                             'persons, with and without the reusable letterbox buffers.')
+    args = parser.parse_args()
+
+    if args.ppe_weights:
+        from ultralytics import YOLO
+        ppe_detector = yolo_detector(YOLO(args.ppe_weights))
+    else:
+        ppe_detector = StubDetector(boxes_per_image=3, num_classes=9, latency=args.call_latency,
+                                    per_image_latency=args.image_latency)
+
+    frame = make_frame(1920, 1080)
+    if args.profile_memory:
+        person_detector = StubDetector(boxes_per_image=args.profile_memory)
+        for reuse in (False, True):
+            pipeline = TwoStagePipeline(person_detector, ppe_detector, imgsz=args.imgsz,
+                                        max_batch_size=args.max_batch_size, reuse_buffers=reuse)
+            peak = profile_allocations(pipeline, frame, args.repeats)
+            pool = pipeline.pool.buffer.nbytes if pipeline.pool is not None else 0
+            print(f"reuse_buffers={reuse}: {peak / 2 ** 20:.1f} MB allocated per frame with "
+                  f"{args.profile_memory} persons, {pool / 2 ** 20:.1f} MB reusable pool")
+        return
+
+    print(f"{'persons':>8} {'per-crop ms':>12} {'batched ms':>11} {'speedup':>8} {'crops/s':>9}")
+    for count in args.person_counts:
+        person_detector = StubDetector(boxes_per_image=count)
+        results = {}
+        for batched in (False, True):
+            pipeline = TwoStagePipeline(person_detector, ppe_detector, imgsz=args.imgsz,
+                                        max_batch_size=args.max_batch_size, batched=batched)
+            results[batched] = time_pipeline(pipeline, frame, args.repeats)
+        print(f"{count:>8} {results[False] * 1000:>12.1f} {results[True] * 1000:>11.1f} "
+              f"{results[False] / results[True]:>7.2f}x {count / results[True]:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
+
+# python benchmark_two_stage.py
+# python benchmark_two_stage.py --ppe_weights ppe_detection.pt --person_counts 1 10 25
+# python benchmark_two_stage.py --profile_memory 50
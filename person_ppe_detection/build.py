@@ -0,0 +1,539 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+
+from annotation_index import AnnotationIndex
+from image_io import IMAGE_EXTENSIONS, image_cache, load_image
+from staging import LINK_MODES, stage_file
+
+BUILD_VERSION = 1
+
+# Builds the datasets as a DAG of stages described in a JSON config (see dataset_build.json), replacing the
+# hand-run chain pascalVOC_to_yolo.py -> dedup.py -> data_augmentation.py -> crop_images.py ->
+# label_correction.py -> imbalance_correction.py -> split_dataset.py. Every stage writes <build_dir>/<stage>/images and /labels
+# (a split stage writes <build_dir>/<stage>/<split>/...). A sample is the image and label file sharing a
+# stem; each stage remembers per sample the content hash of its inputs and the files it wrote, so a
+# rebuild only reprocesses new or changed samples (and deletes the outputs of removed ones). Stages
+# whose inputs are ready run concurrently, their samples in chunks on a shared process pool.
+
+
+def file_digest(path, chunk_size=1 << 20):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def scan_files(directory, extensions):
+    # {stem: (path, [mtime_ns, size])} of the files with one of the extensions
+    files = {}
+    if not os.path.isdir(directory):
+        return files
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.name.lower().endswith(extensions) and entry.is_file():
+                st = entry.stat()
+                files[os.path.splitext(entry.name)[0]] = (entry.path, [st.st_mtime_ns, st.st_size])
+    return files
+
+
+def load_class_names(classes_file):
+    with open(classes_file, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def read_label_lines(path):
+    with open(path, 'r') as f:
+        return [line if line.endswith('\n') else line + '\n' for line in f if line.strip()]
+
+
+def unlink(path):
+    # Generated files are written to a fresh inode: the path may be a hardlink to an input of an earlier stage
+    if os.path.lexists(path):
+        os.remove(path)
+
+
+class Manifest:
+    # What a stage built last time: the stage config it was built with and per sample
+    # [input stats, content digest, unit key, outputs relative to the stage directory]
+    def __init__(self, path):
+        self.path = path
+        self.config = None
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == BUILD_VERSION:
+                self.config = data['config']
+                self.entries = data['entries']
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': BUILD_VERSION, 'config': self.config, 'entries': self.entries}, f,
+                      separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+
+def _process_chunk(stage_class, params, output_dir, chunk):
+    # Worker: (stem, outputs, error) of every (stem, image, label, unit key, previous outputs) of the chunk
+    results = []
+    for stem, image, label, unit_key, previous in chunk:
+        for rel_path in previous:
+            unlink(os.path.join(output_dir, rel_path))
+        try:
+            outputs = stage_class.process(params, output_dir, stem, image, label, unit_key)
+            results.append((stem, outputs, None))
+        except Exception as e:
+            results.append((stem, [], f'{type(e).__name__}: {e}'))
+    return results
+
+
+class Stage:
+    # Maps every sample of its input on its own. Subclasses define the input files (units), the
+    # dataset-wide decisions shared by all samples (prepare), what else a sample's output depends on
+    # (unit_key, e.g. whether it gets augmented) and process(), which runs in the worker processes.
+    label_extension = '.txt'
+
+    def __init__(self, name, config, build_dir, link_mode='auto'):
+        self.name = name
+        self.config = config
+        self.build_dir = build_dir
+        self.output_dir = os.path.join(build_dir, name)
+        self.link_mode = config.get('link_mode', link_mode)
+        self.after = [config['from']] if 'from' in config else []
+        if 'from' in config:
+            self.images_dir = os.path.join(build_dir, config['from'], 'images')
+            self.labels_dir = os.path.join(build_dir, config['from'], 'labels')
+        else:
+            self.images_dir, self.labels_dir = config['images'], config['labels']
+        self.manifest_path = os.path.join(build_dir, '.build', f'{name}.json')
+
+    def units(self):
+        # {stem: (image path or None, label path or None, input stats)}
+        images = scan_files(self.images_dir, IMAGE_EXTENSIONS)
+        labels = scan_files(self.labels_dir, (self.label_extension,))
+        units = {}
+        for stem in images.keys() | labels.keys():
+            image, image_stat = images.get(stem, (None, None))
+            label, label_stat = labels.get(stem, (None, None))
+            units[stem] = (image, label, [image_stat, label_stat])
+        return units
+
+    def prepare(self, units, previous):
+        # Parameters passed to process(); previous are the manifest entries of the last build with this config
+        return {'link_mode': self.link_mode}
+
+    def unit_key(self, stem, image, label):
+        return None
+
+    def output_subdirs(self):
+        return ['images', 'labels']
+
+    @classmethod
+    def process(cls, params, output_dir, stem, image, label, unit_key):
+        raise NotImplementedError
+
+    def run(self, pool, workers=1, force=False, dry_run=False):
+        start = time.perf_counter()
+        manifest = Manifest(self.manifest_path)
+        config_key = json.dumps([type(self).__name__, self.config, self.link_mode], sort_keys=True)
+        same_config = manifest.config == config_key and not force
+        units = self.units()
+        self.pool = pool  # for dataset-wide work in prepare()
+        params = self.prepare(units, manifest.entries if same_config else {})
+
+        entries, todo = {}, []
+        for stem, (image, label, stats) in units.items():
+            entry = manifest.entries.get(stem)
+            if entry is not None and entry[0] == stats:
+                digest = entry[1]
+            else:
+                digest = hashlib.blake2b(''.join(f'{os.path.basename(p)}:{file_digest(p)};' if p else '-;'
+                                                 for p in (image, label)).encode(), digest_size=16).hexdigest()
+            unit_key = self.unit_key(stem, image, label)
+            if same_config and entry is not None and entry[1] == digest and entry[2] == unit_key:
+                entries[stem] = [stats, digest, unit_key, entry[3]]
+            else:
+                entries[stem] = [stats, digest, unit_key, None]
+                todo.append((stem, image, label, unit_key, entry[3] if entry is not None else []))
+        removed = [stem for stem in manifest.entries if stem not in units]
+        report = {'stage': self.name, 'samples': len(units), 'rebuilt': len(todo), 'removed': len(removed),
+                  'failed': 0, 'errors': []}
+        if dry_run:
+            report['seconds'] = time.perf_counter() - start
+            return report
+
+        for subdir in self.output_subdirs():
+            os.makedirs(os.path.join(self.output_dir, subdir), exist_ok=True)
+        for stem in removed:
+            for rel_path in manifest.entries[stem][3]:
+                unlink(os.path.join(self.output_dir, rel_path))
+
+        chunk_size = int(np.clip(len(todo) // (4 * workers), 1, 256))
+        futures = [pool.submit(_process_chunk, type(self), params, self.output_dir, todo[i:i + chunk_size])
+                   for i in range(0, len(todo), chunk_size)]
+        for future in futures:
+            for stem, outputs, error in future.result():
+                if error is None:
+                    entries[stem][3] = outputs
+                else:
+                    # Not recorded, so the sample is retried on the next build
+                    del entries[stem]
+                    report['failed'] += 1
+                    report['errors'].append(f'{stem}: {error}')
+
+        manifest.config = config_key
+        manifest.entries = entries
+        manifest.save()
+        self.finish(params, entries, report)
+        report['seconds'] = time.perf_counter() - start
+        return report
+
+    def finish(self, params, entries, report):
+        pass
+
+
+def stage_image(image, output_dir, link_mode, subdir='images'):
+    # Images are linked where possible, as split_dataset.py does
+    rel_path = os.path.join(subdir, os.path.basename(image))
+    stage_file(image, os.path.join(output_dir, rel_path), link_mode)
+    return rel_path
+
+
+def write_label(output_dir, stem, lines, subdir='labels'):
+    rel_path = os.path.join(subdir, f'{stem}.txt')
+    unlink(os.path.join(output_dir, rel_path))
+    with open(os.path.join(output_dir, rel_path), 'w') as f:
+        f.writelines(lines)
+    return rel_path
+
+
+class VocToYolo(Stage):
+    # pascalVOC_to_yolo.py: <input>/labels/*.xml -> YOLO labels, the images of <input>/images are staged alongside
+    label_extension = '.xml'
+
+    def __init__(self, name, config, build_dir, link_mode='auto'):
+        config = dict(config, images=config.get('images', os.path.join(config['input'], 'images')),
+                      labels=os.path.join(config['input'], 'labels'))
+        super().__init__(name, config, build_dir, link_mode)
+
+    def prepare(self, units, previous):
+        class_names = load_class_names(self.config.get('classes_file', os.path.join(self.config['input'], 'classes.txt')))
+        return {'link_mode': self.link_mode, 'bounds': self.config.get('bounds', 'clip'),
+                'class_ids': {name: i for i, name in enumerate(class_names)}}
+
+    @classmethod
+    def process(cls, params, output_dir, stem, image, label, unit_key):
+        from pascalVOC_to_yolo import convert_annotation
+        outputs = [stage_image(image, output_dir, params['link_mode'])] if image else []
+        if label:
+            yolo_annotations, _ = convert_annotation(label, params['class_ids'], params['bounds'])
+            rel_path = os.path.join('labels', f'{stem}.txt')
+            unlink(os.path.join(output_dir, rel_path))
+            with open(os.path.join(output_dir, rel_path), 'w') as f:
+                f.write("\n".join(yolo_annotations))
+            outputs.append(rel_path)
+        return outputs
+
+
+class Augment(Stage):
+    # data_augmentation.py: the samples plus a flipped copy (f_<name>) of those containing a class with less
+    # than ratio_threshold times the annotations of the most common one, or one of extra_classes
+    def prepare(self, units, previous):
+        from data_augmentation import select_target_classes
+        index = AnnotationIndex.load(self.labels_dir)
+        totals = {class_id: int(count) for class_id, count in enumerate(index.class_counts()) if count}
+        targets = set()
+        if totals:
+            _, targets = select_target_classes(totals, self.config.get('ratio_threshold', 0.5))
+        if self.config.get('extra_classes'):
+            class_names = load_class_names(self.config['classes_file'])
+            targets.update(class_names.index(name) for name in self.config['extra_classes'])
+        # A sample whose flipped name is taken (e.g. the crop of a flipped image, f_<id>_p1, for the crop
+        # <id>_p1) already has its mirror image in the dataset
+        self.flipped = {os.path.splitext(name)[0] for name in index.files_with_classes(targets)} if targets else set()
+        self.flipped = {stem for stem in self.flipped if f'f_{stem}' not in units}
+        return {'link_mode': self.link_mode}
+
+    def unit_key(self, stem, image, label):
+        return stem in self.flipped
+
+    @classmethod
+    def process(cls, params, output_dir, stem, image, label, unit_key):
+        from data_augmentation import flip_sample
+        outputs = []
+        if image:
+            outputs.append(stage_image(image, output_dir, params['link_mode']))
+        if label:
+            outputs.append(os.path.join('labels', f'{stem}.txt'))
+            stage_file(label, os.path.join(output_dir, outputs[-1]), 'copy')
+        if unit_key and image and label:
+            image_name = f'f_{os.path.basename(image)}'
+            unlink(os.path.join(output_dir, 'images', image_name))
+            unlink(os.path.join(output_dir, 'labels', f'f_{stem}.txt'))
+            if flip_sample(image, label, os.path.join(output_dir, 'images', image_name),
+                           os.path.join(output_dir, 'labels', f'f_{stem}.txt'), cache=image_cache):
+                outputs += [os.path.join('images', image_name), os.path.join('labels', f'f_{stem}.txt')]
+        return outputs
+
+
+class Crop(Stage):
+    # crop_images.py: one image per annotated person with its PPE labels (class ids shifted down by one)
+    def prepare(self, units, previous):
+        return {'person_class_id': self.config.get('person_class_id', 0)}
+
+    @classmethod
+    def process(cls, params, output_dir, stem, image, label, unit_key):
+        from crop_images import crop_sample, load_annotations
+        if not (image and label):
+            return []
+        # Through the worker's cache: a source flipped earlier in this worker is not decoded twice
+        decoded = load_image(image)
+        if decoded is None:
+            raise ValueError(f'unreadable image {image}')
+        h, w = decoded.shape[:2]
+        outputs = []
+        crop_sample(decoded, load_annotations(label, w, h), stem, stem, os.path.join(output_dir, 'images'),
+                    os.path.join(output_dir, 'labels'), params['person_class_id'], Counter(), outputs)
+        return [os.path.relpath(p, output_dir) for p in outputs]
+
+
+class FilterClasses(Stage):
+    # label_correction.py: keep only the boxes of the classes named in `keep`
+    def prepare(self, units, previous):
+        class_names = load_class_names(self.config['classes_file'])
+        return {'link_mode': self.link_mode, 'keep': [class_names.index(name) for name in self.config['keep']]}
+
+    @classmethod
+    def process(cls, params, output_dir, stem, image, label, unit_key):
+        outputs = [stage_image(image, output_dir, params['link_mode'])] if image else []
+        if label:
+            keep = set(params['keep'])
+            outputs.append(write_label(output_dir, stem,
+                                       [line for line in read_label_lines(label) if int(line.split()[0]) in keep]))
+        return outputs
+
+
+class DropRareClasses(Stage):
+    # imbalance_correction.py: remove the boxes of classes with at most `threshold` annotations (none below 0)
+    def prepare(self, units, previous):
+        index = AnnotationIndex.load(self.labels_dir)
+        counts = index.class_counts()
+        threshold = self.config.get('threshold', -1)
+        removed = np.flatnonzero((counts <= threshold) & (counts > 0))
+        self.removed_by_stem = {}
+        mask = np.isin(index.class_ids, removed)
+        for image_id, class_id in np.unique(np.stack([index.image_ids[mask], index.class_ids[mask]], 1), axis=0):
+            stem = os.path.splitext(str(index.names[image_id]))[0]
+            self.removed_by_stem.setdefault(stem, []).append(int(class_id))
+        if len(removed):
+            print(f"{self.name}: removing classes {removed.tolist()} (<= {threshold} annotations)")
+        return {'link_mode': self.link_mode}
+
+    def unit_key(self, stem, image, label):
+        return self.removed_by_stem.get(stem, [])
+
+    @classmethod
+    def process(cls, params, output_dir, stem, image, label, unit_key):
+        outputs = [stage_image(image, output_dir, params['link_mode'])] if image else []
+        if label:
+            drop = set(unit_key)
+            outputs.append(write_label(output_dir, stem,
+                                       [line for line in read_label_lines(label) if int(line.split()[0]) not in drop]))
+        return outputs
+
+
+class Dedup(Stage):
+    # dedup.py: leave out near-duplicate images (perceptual hashes within `max_distance` bits), keeping one
+    # image of each group, and write the groups to <stage>/dedup_manifest.json for split stages downstream
+    def prepare(self, units, previous):
+        from dedup import find_duplicates
+        self.manifest = find_duplicates(self.images_dir, self.labels_dir, self.config.get('hash', 'phash'),
+                                        self.config.get('max_distance', 6), self.config.get('conflicts', 'keep'),
+                                        self.config.get('iou', 0.5), os.cpu_count() or 1,
+                                        os.path.join(self.build_dir, '.build', f'{self.name}.hashes.npz'), self.pool)
+        self.dropped = {os.path.splitext(name)[0]
+                        for group in self.manifest['groups'] for name, *_ in group['drop']}
+        summary = self.manifest['summary']
+        print(f"{self.name}: {summary['dropped']} near-duplicates in {summary['groups']} groups, "
+              f"{summary['label_conflicts']} label conflicts")
+        return {'link_mode': self.link_mode}
+
+    def unit_key(self, stem, image, label):
+        return 'drop' if stem in self.dropped else None
+
+    @classmethod
+    def process(cls, params, output_dir, stem, image, label, unit_key):
+        if unit_key == 'drop':
+            return []
+        outputs = [stage_image(image, output_dir, params['link_mode'])] if image else []
+        if label:
+            outputs.append(write_label(output_dir, stem, read_label_lines(label)))
+        return outputs
+
+    def finish(self, params, entries, report):
+        with open(os.path.join(self.output_dir, 'dedup_manifest.json'), 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+
+
+class Split(Stage):
+    # split_dataset.py: stratified train/(val/)test split keeping derived files together. Groups keep the
+    # split they were assigned to in earlier builds, only new groups are assigned (stratified among
+    # themselves), so adding images never moves existing ones between splits. With `dedup` (the name of a
+    # dedup stage upstream) the near-duplicates it kept because their labels disagree share a split.
+    def __init__(self, name, config, build_dir, link_mode='auto'):
+        super().__init__(name, config, build_dir, link_mode)
+        if 'dedup' in config:
+            self.after.append(config['dedup'])
+
+    def split_names(self):
+        return ['train', 'val', 'test'] if self.config.get('val_size') else ['train', 'test']
+
+    def output_subdirs(self):
+        return [os.path.join(split, subdir) for split in self.split_names() for subdir in ('images', 'labels')]
+
+    def prepare(self, units, previous):
+        from split_dataset import assign_groups, group_class_counts
+        split_names = self.split_names()
+        test_size, val_size = self.config.get('test_size', 0.2), self.config.get('val_size', 0.0)
+        fractions = [1.0 - test_size - val_size, val_size, test_size] if val_size else [1.0 - test_size, test_size]
+
+        image_files = sorted(os.path.basename(image) for image, _, _ in units.values() if image)
+        index = AnnotationIndex.load(self.labels_dir)
+        aliases = None
+        if 'dedup' in self.config:
+            from dedup import load_manifest
+            aliases = load_manifest(os.path.join(self.build_dir, self.config['dedup'], 'dedup_manifest.json'))[1]
+        groups, counts, sizes = group_class_counts(image_files, index, aliases)
+        split_of_group = np.full(len(sizes), -1, dtype=np.int64)
+        for file_name, group in zip(image_files, groups.tolist()):
+            entry = previous.get(os.path.splitext(file_name)[0])
+            if entry is not None and entry[2] in split_names:
+                split_of_group[group] = split_names.index(entry[2])
+        new = np.flatnonzero(split_of_group < 0)
+        if len(new):
+            split_of_group[new] = assign_groups(counts[new], sizes[new], fractions, self.config.get('seed', 42))
+
+        self.split_of_stem = {os.path.splitext(f)[0]: split_names[s]
+                              for f, s in zip(image_files, split_of_group[groups].tolist())}
+        self.report_data = (split_names, split_of_group, counts, sizes)
+        return {'link_mode': self.link_mode}
+
+    def unit_key(self, stem, image, label):
+        return self.split_of_stem.get(stem)
+
+    @classmethod
+    def process(cls, params, output_dir, stem, image, label, unit_key):
+        if unit_key is None:
+            return []
+        outputs = [stage_image(image, output_dir, params['link_mode'], os.path.join(unit_key, 'images'))]
+        if label:
+            # Labels are real copies: later steps (e.g. imbalance_correction.py) rewrite them in place
+            outputs.append(os.path.join(unit_key, 'labels', f'{stem}.txt'))
+            stage_file(label, os.path.join(output_dir, outputs[-1]), 'copy')
+        return outputs
+
+    def finish(self, params, entries, report):
+        from split_dataset import split_report
+        class_names = load_class_names(self.config['classes_file']) if 'classes_file' in self.config else None
+        split_names, split_of_group, counts, sizes = self.report_data
+        if class_names and counts.shape[1] < len(class_names):
+            counts = np.pad(counts, ((0, 0), (0, len(class_names) - counts.shape[1])))
+        with open(os.path.join(self.output_dir, 'split_report.json'), 'w') as f:
+            json.dump(split_report(split_names, split_of_group, counts, sizes, class_names), f, indent=2)
+
+
+STAGE_TYPES = {'voc_to_yolo': VocToYolo, 'dedup': Dedup, 'augment': Augment, 'crop': Crop,
+               'filter_classes': FilterClasses, 'drop_rare_classes': DropRareClasses, 'split': Split}
+
+
+def load_pipeline(config_path):
+    with open(config_path, 'r') as f:
+        config = json.load(f)
+    build_dir = config.get('build_dir', 'build')
+    stages = {}
+    for stage_config in config['stages']:
+        name, stage_type = stage_config['name'], stage_config['type']
+        if stage_type not in STAGE_TYPES:
+            raise ValueError(f"Stage {name}: unknown type {stage_type!r} (one of {', '.join(STAGE_TYPES)})")
+        if name in stages:
+            raise ValueError(f"Duplicate stage name {name!r}")
+        stages[name] = STAGE_TYPES[stage_type](name, stage_config, build_dir, config.get('link_mode', 'auto'))
+    for stage in stages.values():
+        for dependency in stage.after:
+            if dependency not in stages:
+                raise ValueError(f"Stage {stage.name} reads from unknown stage {dependency!r}")
+    return stages
+
+
+def run_pipeline(stages, targets=None, workers=None, force=False, dry_run=False):
+    # Runs the target stages (default: all) and what they depend on, each as soon as its inputs are built
+    needed, todo = set(), list(targets or stages)
+    while todo:
+        name = todo.pop()
+        if name not in needed:
+            needed.add(name)
+            todo.extend(stages[name].after)
+    workers = workers or os.cpu_count() or 1
+    pending = {name: stages[name] for name in stages if name in needed}
+    running, done, reports = {}, set(), []
+    with ProcessPoolExecutor(workers) as pool, ThreadPoolExecutor(len(pending) or 1) as runner:
+        while pending or running:
+            for name in [n for n, stage in pending.items() if all(d in done for d in stage.after)]:
+                stage = pending.pop(name)
+                # A dry run can't know what upstream stages would change, so it checks them all as they are
+                running[runner.submit(stage.run, pool, workers, force, dry_run)] = name
+            if not running:
+                raise ValueError(f"Stages {', '.join(pending)} depend on each other")
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                done.add(running.pop(future))
+                report = future.result()
+                reports.append(report)
+                print(f"{report['stage']}: {report['samples']} samples, {report['rebuilt']} "
+                      f"{'to rebuild' if dry_run else 'rebuilt'}, {report['removed']} removed, "
+                      f"{report['failed']} failed ({report['seconds']:.1f} s)")
+                for error in report['errors'][:5]:
+                    print(f"  {error}")
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the datasets described by a pipeline config, reprocessing '
+                                                 'only the samples whose inputs changed since the last build.')
+    parser.add_argument('config', type=str, help='Pipeline config (JSON), e.g. dataset_build.json.')
+    parser.add_argument('stages', nargs='*', help='Stages to build, with their dependencies (default: all).')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: all cores).')
+    parser.add_argument('--force', action='store_true', help='Rebuild every sample of the selected stages.')
+    parser.add_argument('--dry_run', action='store_true', help='Only report what would be rebuilt.')
+    parser.add_argument('--link_mode', choices=LINK_MODES, default=None,
+                        help='Override how images are staged in every stage.')
+    args = parser.parse_args()
+
+    stages = load_pipeline(args.config)
+    unknown = [name for name in args.stages if name not in stages]
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(unknown)}")
+    if args.link_mode:
+        for stage in stages.values():
+            stage.link_mode = args.link_mode
+    start = time.perf_counter()
+    reports = run_pipeline(stages, args.stages, args.workers, args.force, args.dry_run)
+    print(f"Built {len(reports)} stages in {time.perf_counter() - start:.1f} s")
+
+
+if __name__ == '__main__':
+    main()
+
+# python build.py dataset_build.json
+# python build.py dataset_build.json ppe_dataset --workers 8
+# python build.py dataset_build.json --dry_run
@@ -0,0 +1,267 @@
+import json
+import time
+import argparse
+from collections import namedtuple
+
+import numpy as np
+
+from tiling import overlapping_pairs
+from tracker import SortTracker
+
+# Body regions as fractions of the person box: (x1, y1, x2, y2), x relative to the box width and y to
+# its height. Slightly wider than the box where items stick out (hard-hat brims, boots, gloves).
+REGIONS = {
+    'head': (-0.15, -0.1, 1.15, 0.3),
+    'torso': (-0.1, 0.12, 1.1, 0.7),
+    'hands': (-0.3, 0.25, 1.3, 0.8),
+    'feet': (-0.15, 0.75, 1.15, 1.08),
+    'body': (-0.1, -0.1, 1.1, 1.1),
+}
+CLASS_REGIONS = {
+    'hard-hat': 'head', 'glasses': 'head', 'ear-protector': 'head', 'mask': 'head',
+    'vest': 'torso', 'safety-harness': 'torso', 'gloves': 'hands', 'boots': 'feet', 'ppe-suit': 'body',
+}
+
+FrameCompliance = namedtuple('FrameCompliance', ['owner', 'present', 'required', 'missing', 'track_ids',
+                                                 'violations'])
+
+
+def load_class_names(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def region_fractions(class_names):
+    # (C, 4) body region of every class, as fractions of the person box
+    return np.array([REGIONS[CLASS_REGIONS.get(name, 'body')] for name in class_names], np.float32)
+
+
+def associate(person_boxes, ppe_boxes, ppe_classes, fractions, min_ioa=0.5):
+    # Owner (person index, or -1) of every PPE item: the person whose body region for the item's class
+    # contains most of the item. Containment in the whole person box breaks ties between overlapping
+    # people. Candidate pairs come from a sorted sweep (tiling.overlapping_pairs), nothing is (P, M).
+    person_boxes = np.asarray(person_boxes, np.float32).reshape(-1, 4)
+    ppe_boxes = np.asarray(ppe_boxes, np.float32).reshape(-1, 4)
+    owner = np.full(len(ppe_boxes), -1)
+    if len(person_boxes) == 0 or len(ppe_boxes) == 0:
+        return owner
+    # Candidate pairs: items overlapping the envelope of all body regions of a person
+    lo, hi = fractions[:, :2].min(axis=0), fractions[:, 2:].max(axis=0)
+    size = person_boxes[:, 2:] - person_boxes[:, :2]
+    p, m = overlapping_pairs(np.hstack([person_boxes[:, :2] + lo * size, person_boxes[:, :2] + hi * size]), ppe_boxes)
+
+    # Per pair, as (4, K) rows of x1, y1, x2, y2 (np.take gathers rows several times faster than indexing)
+    person = np.ascontiguousarray(np.take(person_boxes, p, axis=0).T)
+    item = np.ascontiguousarray(np.take(ppe_boxes, m, axis=0).T)
+    f = np.ascontiguousarray(np.take(fractions, np.asarray(ppe_classes, int)[m], axis=0).T)
+    wh = person[2:] - person[:2]
+    area = np.maximum((item[2] - item[0]) * (item[3] - item[1]), 1e-6)
+    region1, region2 = person[:2] + f[:2] * wh, person[:2] + f[2:] * wh
+    overlap = np.maximum(np.minimum(region2, item[2:]) - np.maximum(region1, item[:2]), 0)
+    ioa = overlap[0] * overlap[1] / area
+    inside = np.maximum(np.minimum(person[2:], item[2:]) - np.maximum(person[:2], item[:2]), 0)
+    containment = inside[0] * inside[1] / area
+
+    # Best person per item: sort the pairs by item, then score, and keep the first of every item
+    ok = ioa >= min_ioa
+    p, m, score = p[ok], m[ok], (ioa + 0.01 * containment)[ok]
+    order = np.lexsort((-score, m))
+    first = order[np.r_[True, m[order][1:] != m[order][:-1]]] if len(order) else order
+    owner[m[first]] = p[first]
+    return owner
+
+
+def points_in_polygon(points, polygon):
+    # Ray casting for (N, 2) points against one (E, 2) polygon, vectorised over points and edges
+    polygon = np.asarray(polygon, np.float32)
+    x, y = points[:, 0:1], points[:, 1:2]
+    x1, y1 = polygon[:, 0], polygon[:, 1]
+    x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+    crosses = (y1 > y) != (y2 > y)
+    x_cross = x1 + (y - y1) * (x2 - x1) / np.where(y2 == y1, 1e-9, y2 - y1)
+    return ((crosses & (x < x_cross)).sum(axis=1) % 2) == 1
+
+
+class ComplianceRules:
+    # Required PPE per zone. A JSON file like
+    #   {"default": ["hard-hat", "vest"],
+    #    "zones": [{"name": "welding bay", "polygon": [[0, 0], [640, 0], [640, 360], [0, 360]],
+    #               "required": ["glasses", "gloves"]}]}
+    # where a person is in a zone when their feet (bottom centre of the box) are inside its polygon
+    # and must wear the default items plus those of every zone they are in.
+    def __init__(self, class_names, default=(), zones=()):
+        self.class_names = list(class_names)
+        index = {name: i for i, name in enumerate(self.class_names)}
+
+        def mask(names):
+            unknown = [name for name in names if name not in index]
+            if unknown:
+                raise ValueError(f'Unknown PPE classes in rules: {unknown}, expected names from {self.class_names}')
+            m = np.zeros(len(self.class_names), bool)
+            m[[index[name] for name in names]] = True
+            return m
+
+        self.default = mask(default)
+        self.zones = [(zone.get('name', f'zone_{i}'), np.asarray(zone['polygon'], np.float32),
+                       mask(zone.get('required', []))) for i, zone in enumerate(zones)]
+
+    @classmethod
+    def load(cls, path, class_names):
+        with open(path) as f:
+            config = json.load(f)
+        return cls(class_names, config.get('default', []), config.get('zones', []))
+
+    def required(self, person_boxes):
+        # (P, C) required items per person
+        person_boxes = np.asarray(person_boxes, np.float32).reshape(-1, 4)
+        required = np.broadcast_to(self.default, (len(person_boxes), len(self.default))).copy()
+        if self.zones and len(person_boxes):
+            feet = np.stack([(person_boxes[:, 0] + person_boxes[:, 2]) / 2, person_boxes[:, 3]], axis=1)
+            for _, polygon, zone_required in self.zones:
+                required |= points_in_polygon(feet, polygon)[:, None] & zone_required
+        return required
+
+
+class ComplianceEngine:
+    # Associates PPE to persons, checks the rules and, over a sequence of frames, only reports a
+    # violation once the item has been missing for `debounce_frames` consecutive frames of the same
+    # track (tracker.SortTracker), and clears it after `clear_frames` compliant frames.
+    def __init__(self, rules, min_ioa=0.5, debounce_frames=5, clear_frames=5, iou_threshold=0.3, max_age=5):
+        self.rules = rules
+        self.class_names = rules.class_names
+        self.min_ioa = min_ioa
+        self.debounce_frames = debounce_frames
+        self.clear_frames = clear_frames
+        self.fractions = region_fractions(self.class_names)
+        self.tracker = SortTracker(iou_threshold, max_age)
+        # Per track row of the tracker, per class: consecutive frames missing, consecutive frames
+        # compliant, and whether the violation is being reported
+        self.state = np.zeros((0, 3, len(self.class_names)), np.int32)
+
+    def evaluate(self, person_boxes, ppe_boxes, ppe_classes):
+        # Single frame, no tracking: violations are the raw missing items
+        person_boxes = np.asarray(person_boxes, np.float32).reshape(-1, 4)
+        ppe_classes = np.asarray(ppe_classes, int)
+        owner = associate(person_boxes, ppe_boxes, ppe_classes, self.fractions, self.min_ioa)
+        num_classes = len(self.class_names)
+        worn = owner >= 0
+        present = np.bincount(owner[worn] * num_classes + ppe_classes[worn],
+                              minlength=len(person_boxes) * num_classes).reshape(-1, num_classes) > 0
+        required = self.rules.required(person_boxes)
+        missing = required & ~present
+        return FrameCompliance(owner, present, required, missing, None, missing)
+
+    def update(self, person_boxes, ppe_boxes, ppe_classes):
+        # Next frame of a sequence: adds track ids and the debounced violations
+        frame = self.evaluate(person_boxes, ppe_boxes, ppe_classes)
+        track_ids = self.tracker.update(person_boxes)
+
+        # Carry the state over to the new track rows; new tracks (source -1) take the zero row appended last
+        state = np.take(np.concatenate([self.state, np.zeros((1,) + self.state.shape[1:], np.int32)]),
+                        self.tracker.source, axis=0)
+        # Only the tracks seen in this frame advance
+        rows = self.tracker.rows
+        missing = frame.missing
+        missing_streak, ok_streak, active = np.take(state, rows, axis=0).transpose(1, 0, 2)
+        missing_streak = np.where(missing, missing_streak + 1, 0)
+        ok_streak = np.where(missing, 0, ok_streak + 1)
+        active = (active.astype(bool) | (missing_streak >= self.debounce_frames)) & (ok_streak < self.clear_frames)
+        state[rows] = np.stack([missing_streak, ok_streak, active], axis=1)
+        self.state = state
+        return frame._replace(track_ids=track_ids, violations=active)
+
+    def describe(self, frame):
+        # "worker 3 missing hard-hat, vest" lines for the persons with violations
+        ids = frame.track_ids if frame.track_ids is not None else np.arange(len(frame.violations))
+        lines = []
+        for worker, row in zip(ids.tolist(), frame.violations):
+            if row.any():
+                lines.append(f"worker {worker} missing {', '.join(np.array(self.class_names)[row])}")
+        return lines
+
+
+def frame_detections(result):
+    # Full-frame person boxes and PPE boxes/classes from a two_stage.FrameResult
+    ppe_boxes = [person.ppe_frame_boxes for person in result.people]
+    ppe_classes = [person.ppe.classes for person in result.people]
+    return (result.persons.boxes,
+            np.concatenate(ppe_boxes) if ppe_boxes else np.zeros((0, 4), np.float32),
+            np.concatenate(ppe_classes) if ppe_classes else np.zeros(0, int))
+
+
+def synthetic_frame(persons, rng, width=3840, height=2160, items_per_person=3):
+    # Random persons with PPE items on their head, torso and feet
+    x1 = rng.uniform(0, width - 100, persons)
+    y1 = rng.uniform(0, height - 250, persons)
+    w, h = rng.uniform(30, 100, persons), rng.uniform(80, 250, persons)
+    person_boxes = np.stack([x1, y1, x1 + w, y1 + h], axis=1).astype(np.float32)
+    owners = np.repeat(np.arange(persons), items_per_person)
+    classes = rng.integers(0, 9, len(owners))
+    fy = rng.uniform(0, 0.9, len(owners))
+    px1, py1, pw, ph = x1[owners], y1[owners], w[owners], h[owners]
+    ppe_boxes = np.stack([px1 + 0.2 * pw, py1 + fy * ph, px1 + 0.8 * pw, py1 + (fy + 0.1) * ph],
+                         axis=1).astype(np.float32)
+    return person_boxes, ppe_boxes, classes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check PPE compliance of recorded detections, or benchmark the engine.')
+    parser.add_argument('results', nargs='?', default=None,
+                        help='A .jsonl/.parquet/.arrow file written by the sinks of predict.py, inf.py or stream.py.')
+    parser.add_argument('--classes_file', type=str, default='cropped_classes.txt', help='PPE class names.')
+    parser.add_argument('--rules', type=str, default=None, help='JSON rules file (default zones and required PPE).')
+    parser.add_argument('--required', nargs='+', default=['hard-hat', 'vest'],
+                        help='Required PPE everywhere when no rules file is given.')
+    parser.add_argument('--debounce_frames', type=int, default=5,
+                        help='Frames an item must be missing before a violation is reported (1 for still images).')
+    parser.add_argument('--benchmark', type=int, nargs='*', default=None, metavar='PERSONS',
+                        help='Time the engine on synthetic frames with these person counts.')
+    args = parser.parse_args()
+
+    class_names = load_class_names(args.classes_file)
+    rules = ComplianceRules.load(args.rules, class_names) if args.rules else ComplianceRules(class_names,
+                                                                                             args.required)
+    if args.benchmark is not None:
+        rng = np.random.default_rng(0)
+        print(f"{'persons':>8} {'items':>6} {'evaluate ms':>12} {'tracked ms':>11}")
+        for persons in args.benchmark or [10, 100, 300]:
+            frame = synthetic_frame(persons, rng)
+            engine = ComplianceEngine(rules, debounce_frames=args.debounce_frames)
+            timings = []
+            for step in (engine.evaluate, engine.update):
+                step(*frame)  # warmup
+                start = time.perf_counter()
+                for _ in range(200):
+                    step(*frame)
+                timings.append((time.perf_counter() - start) / 200 * 1000)
+            print(f'{persons:>8} {len(frame[2]):>6} {timings[0]:>12.3f} {timings[1]:>11.3f}')
+        return
+
+    if not args.results:
+        parser.error('a results file is required unless --benchmark is given')
+    from sinks import read_rows
+    rows = read_rows(args.results)
+    engine = ComplianceEngine(rules, debounce_frames=args.debounce_frames)
+    # Group the rows by image, keeping the recording order (frames of a stream are in sequence)
+    images, first, inverse = np.unique(rows['image'], return_index=True, return_inverse=True)
+    rank = np.argsort(np.argsort(first))[inverse]
+    order = np.argsort(rank, kind='stable')
+    bounds = np.flatnonzero(np.diff(rank[order])) + 1
+    boxes = np.stack([rows['x1'], rows['y1'], rows['x2'], rows['y2']], axis=1).astype(np.float32)
+    stage, class_id = rows['stage'].astype(str), rows['class_id'].astype(int)
+    total = 0
+    for group in np.split(order, bounds):
+        persons, ppe = group[stage[group] == 'person'], group[stage[group] == 'ppe']
+        frame = engine.update(boxes[persons], boxes[ppe], class_id[ppe])
+        for line in engine.describe(frame):
+            print(f"{rows['image'][group[0]]}: {line}")
+            total += 1
+    print(f'{len(images)} images, {total} violations reported')
+
+
+if __name__ == '__main__':
+    main()
+
+# python compliance.py --benchmark 10 100 300
+# python compliance.py site_day.parquet --rules site_rules.json
+# python compliance.py inference.jsonl --required hard-hat vest boots --debounce_frames 1
@@ -1,65 +1,255 @@
 import os
-from PIL import Image
+import json
+import time
 import shutil
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from annotation_index import AnnotationIndex, malformed_lines
+from image_io import IMAGE_EXTENSIONS
+
+CACHE_VERSION = 1
+
+
+def default_cache_path(image_dir):
+    image_dir = os.path.abspath(image_dir)
+    return os.path.join(os.path.dirname(image_dir), f'.{os.path.basename(image_dir)}.integrity.json')
+
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def check_image(path, full_decode=False):
+    # verify() only checks the container structure; a full decode also catches truncated JPEGs
+    try:
+        with Image.open(path) as img:
+            size = img.size
+            img.verify()
+        if full_decode:
+            with Image.open(path) as img:
+                # Every compressed byte is still decoded, but JPEGs go through libjpeg's 1/8 DCT scaling
+                # instead of producing the full-resolution pixels
+                img.draft(img.mode, (max(size[0] // 8, 1), max(size[1] // 8, 1)))
+                img.load()
+    except Exception as e:
+        return {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+    return {'ok': True, 'width': size[0], 'height': size[1]}
+
+
+def load_cache(cache_path, full_decode):
+    if not cache_path or not os.path.exists(cache_path):
+        return {}, {}
+    try:
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}, {}
+    # Results obtained without a full decode don't count when a full decode is requested
+    if cache.get('version') != CACHE_VERSION or (full_decode and not cache.get('full_decode')):
+        return {}, {}
+    return cache.get('files', {}), cache.get('results', {})
+
+
+def save_cache(cache_path, files, results, full_decode):
+    # Best effort: without a writable cache location (e.g. a read-only dataset) the next run just checks again
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'full_decode': full_decode, 'files': files, 'results': results}, f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Warning: could not write the integrity cache {cache_path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def scan_images(image_dir, workers=8, full_decode=False, cache_path=None):
+    # Validate every image in image_dir. Files whose size and mtime are unchanged reuse their cached
+    # hash; files whose content hash was already validated reuse that result.
+    cached_files, cached_results = load_cache(cache_path, full_decode)
+    entries = []
+    with os.scandir(image_dir) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                st = entry.stat()
+                entries.append((entry.name, st.st_size, st.st_mtime_ns))
+    entries.sort()
+
+    def scan(entry):
+        name, size, mtime = entry
+        known = cached_files.get(name)
+        if known and known['size'] == size and known['mtime'] == mtime and known['hash'] in cached_results:
+            return name, known, cached_results[known['hash']], False
+        path = os.path.join(image_dir, name)
+        digest = file_hash(path)
+        result = cached_results.get(digest)
+        checked = result is None
+        if checked:
+            result = check_image(path, full_decode)
+        return name, {'size': size, 'mtime': mtime, 'hash': digest}, result, checked
+
+    files, results, image_results = {}, {}, {}
+    checked = 0
+    with ThreadPoolExecutor(workers) as pool:
+        for name, info, result, was_checked in pool.map(scan, entries):
+            files[name] = info
+            results[info['hash']] = result
+            image_results[name] = result
+            checked += was_checked
+
+    if cache_path:
+        save_cache(cache_path, files, results, full_decode)
+    return image_results, checked
 
 
-def check_images_and_labels(image_dir, label_dir, corrupt_image_dir, corrupt_label_dir):
-    corrupt_images = []
-    corrupt_labels = []
+def check_labels(index, num_classes):
+    # Validate every box of every label file in one vectorised pass. Returns {issue: per-file counts}.
+    boxes = np.asarray(index.boxes)
+    class_ids = np.asarray(index.class_ids)
+    image_ids = np.asarray(index.image_ids)
 
-    # Create directories for corrupt files if they don't exist
+    row_issues = {
+        'out_of_range': ((boxes < 0) | (boxes > 1)).any(axis=1),
+        'bad_class': (class_ids < 0) | (class_ids >= num_classes),
+        'zero_area': (boxes[:, 2] <= 0) | (boxes[:, 3] <= 0),
+    }
+
+    # Identical (file, class, box) rows after the first are duplicates
+    duplicate = np.zeros(len(class_ids), dtype=bool)
+    if len(class_ids):
+        keys = np.column_stack([image_ids.astype(np.int64), class_ids.astype(np.int64),
+                                np.round(boxes.astype(np.float64) * 1e6).astype(np.int64)])
+        _, first = np.unique(keys, axis=0, return_index=True)
+        duplicate[:] = True
+        duplicate[first] = False
+    row_issues['duplicate'] = duplicate
+
+    issues = {'malformed_lines': np.asarray(index.bad_lines).astype(np.int64)}
+    for issue, mask in row_issues.items():
+        issues[issue] = np.bincount(image_ids[mask], minlength=index.num_files)
+    return issues
+
+
+def check_images_and_labels(image_dir, label_dir, classes_file, workers=8, full_decode=False, cache_path=None):
+    with open(classes_file, 'r') as f:
+        class_names = [line.strip() for line in f.readlines() if line.strip()]
+
+    image_results, checked = scan_images(image_dir, workers, full_decode, cache_path)
+    index = AnnotationIndex.load(label_dir)
+    label_names = index.names.tolist()
+    issues = check_labels(index, len(class_names))
+
+    image_stems = {os.path.splitext(name)[0]: name for name in image_results}
+    label_stems = {os.path.splitext(name)[0] for name in label_names}
+
+    corrupt_images = [{'file': name, 'error': result['error']}
+                      for name, result in image_results.items() if not result['ok']]
+    label_issues = []
+    for i, name in enumerate(label_names):
+        found = {issue: int(counts[i]) for issue, counts in issues.items() if counts[i]}
+        if found:
+            entry = {'file': name, 'issues': found}
+            if found.get('malformed_lines'):
+                # Only the few files with malformed lines are read again, to say which lines and why
+                with open(os.path.join(label_dir, name), 'r') as f:
+                    entry['malformed'] = [{'line': number, 'error': error}
+                                          for number, error in malformed_lines(f.read())]
+            label_issues.append(entry)
+
+    report = {
+        'image_dir': os.path.abspath(image_dir),
+        'label_dir': os.path.abspath(label_dir),
+        'full_decode': full_decode,
+        'summary': {
+            'images': len(image_results),
+            'images_checked': checked,
+            'label_files': index.num_files,
+            'boxes': int(len(index)),
+            'corrupt_images': len(corrupt_images),
+            'labels_with_issues': len(label_issues),
+            **{issue: int(counts.sum()) for issue, counts in issues.items()},
+        },
+        'corrupt_images': corrupt_images,
+        'label_issues': label_issues,
+        'orphan_images': sorted(name for stem, name in image_stems.items() if stem not in label_stems),
+        'orphan_labels': sorted(name for name in label_names if os.path.splitext(name)[0] not in image_stems),
+    }
+    report['summary']['orphan_images'] = len(report['orphan_images'])
+    report['summary']['orphan_labels'] = len(report['orphan_labels'])
+    return report
+
+
+def copy_corrupt_files(report, corrupt_image_dir, corrupt_label_dir, workers=8):
+    # Copy corrupt images and labels (with their counterparts) for inspection
     os.makedirs(corrupt_image_dir, exist_ok=True)
     os.makedirs(corrupt_label_dir, exist_ok=True)
+    image_dir, label_dir = report['image_dir'], report['label_dir']
+    images = {entry['file'] for entry in report['corrupt_images']}
+    labels = {entry['file'] for entry in report['label_issues']}
+    stems_to_images = {os.path.splitext(name)[0]: name for name in os.listdir(image_dir)}
+
+    copies = []
+    for name in images:
+        copies.append((os.path.join(image_dir, name), os.path.join(corrupt_image_dir, name)))
+        label = os.path.splitext(name)[0] + '.txt'
+        if os.path.exists(os.path.join(label_dir, label)):
+            copies.append((os.path.join(label_dir, label), os.path.join(corrupt_label_dir, label)))
+    for name in labels:
+        copies.append((os.path.join(label_dir, name), os.path.join(corrupt_label_dir, name)))
+        image = stems_to_images.get(os.path.splitext(name)[0])
+        if image is not None:
+            copies.append((os.path.join(image_dir, image), os.path.join(corrupt_image_dir, image)))
+
+    with ThreadPoolExecutor(workers) as pool:
+        list(pool.map(lambda pair: shutil.copy(*pair), set(copies)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check a YOLO dataset for corrupt images and invalid labels.')
+    parser.add_argument('image_dir', type=str, help='Directory containing images.')
+    parser.add_argument('label_dir', type=str, help='Directory containing YOLO label files.')
+    parser.add_argument('classes_file', type=str, help='File containing class names.')
+    parser.add_argument('--report', type=str, default=None, help='Write the JSON report to this file.')
+    parser.add_argument('--workers', type=int, default=8, help='Threads used to validate images (default: 8).')
+    parser.add_argument('--full_decode', action='store_true',
+                        help='Fully decode every image to catch truncated files that verify() misses.')
+    parser.add_argument('--cache', type=str, default=None,
+                        help='Per-file hash cache (default: hidden file next to image_dir).')
+    parser.add_argument('--no_cache', action='store_true', help='Revalidate every image.')
+    parser.add_argument('--corrupt_image_dir', type=str, default=None, help='Copy corrupt images here.')
+    parser.add_argument('--corrupt_label_dir', type=str, default=None, help='Copy corrupt labels here.')
+    args = parser.parse_args()
+
+    cache_path = None if args.no_cache else (args.cache or default_cache_path(args.image_dir))
+    start = time.perf_counter()
+    report = check_images_and_labels(args.image_dir, args.label_dir, args.classes_file, args.workers,
+                                     args.full_decode, cache_path)
+    report['summary']['seconds'] = round(time.perf_counter() - start, 3)
+
+    if args.corrupt_image_dir and args.corrupt_label_dir:
+        copy_corrupt_files(report, args.corrupt_image_dir, args.corrupt_label_dir, args.workers)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+    for key, value in report['summary'].items():
+        print(f"{key}: {value}")
+    for entry in report['label_issues']:
+        for problem in entry.get('malformed', []):
+            print(f"{entry['file']}:{problem['line']}: {problem['error']}")
+
+
+if __name__ == '__main__':
+    main()
 
-    # Check images for corruption
-    for img_file in os.listdir(image_dir):
-        img_path = os.path.join(image_dir, img_file)
-        label_file = os.path.splitext(img_file)[0] + '.txt'
-        label_path = os.path.join(label_dir, label_file)
-
-        try:
-            img = Image.open(img_path)
-            img.verify()  # Verify if the image is valid
-        except (IOError, SyntaxError) as e:
-            corrupt_images.append(img_file)
-            shutil.copy(img_path, os.path.join(corrupt_image_dir, img_file))  # Copy corrupt image
-            if os.path.exists(label_path):
-                shutil.copy(label_path, os.path.join(corrupt_label_dir, label_file))  # Copy corresponding label
-
-    # Check labels for corruption and out-of-bounds coordinates
-    for lbl_file in os.listdir(label_dir):
-        lbl_path = os.path.join(label_dir, lbl_file)
-        img_file = os.path.splitext(lbl_file)[0] + '.jpg'  # Assuming the image extension is .jpg
-        img_path = os.path.join(image_dir, img_file)
-
-        try:
-            with open(lbl_path, 'r') as f:
-                lines = f.readlines()
-                for line in lines:
-                    values = line.strip().split()
-                    if len(values) != 5:
-                        raise ValueError("Incorrect label format")
-
-                    # Check if the coordinates are normalized and within bounds [0, 1]
-                    _, x_center, y_center, width, height = map(float, values)
-                    if not (0 <= x_center <= 1 and 0 <= y_center <= 1 and 0 <= width <= 1 and 0 <= height <= 1):
-                        raise ValueError("Coordinates out of bounds")
-
-        except (IOError, ValueError) as e:
-            corrupt_labels.append(lbl_file)
-            shutil.copy(lbl_path, os.path.join(corrupt_label_dir, lbl_file))  # Copy corrupt label
-            if os.path.exists(img_path):
-                shutil.copy(img_path, os.path.join(corrupt_image_dir, img_file))  # Copy corresponding image
-
-    return corrupt_images, corrupt_labels
-
-
-image_dir = 'augmented_data/cropped/images'
-label_dir = 'augmented_data/cropped/labels'  # Change to your label directory
-corrupt_image_dir = 'augmented_data/cropped/corrupt_images'  # Change to your corrupt images directory
-corrupt_label_dir = 'augmented_data/cropped/corrupt_labels'  # Change to your corrupt labels directory
-
-corrupt_images, corrupt_labels = check_images_and_labels(image_dir, label_dir, corrupt_image_dir, corrupt_label_dir)
-
-print(f"Corrupt images: {corrupt_images}")
-print(f"Corrupt labels: {corrupt_labels}")
+# python corrupt_files_detection.py augmented_data/cropped/images augmented_data/cropped/labels cropped_classes.txt --report integrity.json
+# python corrupt_files_detection.py augmented_data/cropped/images augmented_data/cropped/labels cropped_classes.txt --full_decode --corrupt_image_dir augmented_data/cropped/corrupt_images --corrupt_label_dir augmented_data/cropped/corrupt_labels
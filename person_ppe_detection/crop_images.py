@@ -1,6 +1,12 @@
 import cv2
 import os
 import argparse
+from collections import Counter
+from multiprocessing import Pool
+import numpy as np
+
+from image_io import load_image
+from shards import is_packed, open_packed
 
 def adjust_bbox(bbox, person_bbox):
     # Adjust bbox based on person_bbox (person's cropped region)
@@ -23,25 +29,109 @@ def adjust_bbox(bbox, person_bbox):
 
     return [new_x_center, new_y_center, new_width, new_height]
 
-def process_image(image_path, annotation_path, output_image_dir, output_label_dir, person_class_id=0):
+def adjust_bboxes(boxes, person_boxes):
+    # Vectorised adjust_bbox: all annotation boxes (A, 4) against all person boxes (P, 4) at once.
+    # Returns the adjusted boxes (P, A, 4) and a (P, A) mask of boxes that fall inside each person.
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    person_boxes = np.asarray(person_boxes, dtype=np.float64).reshape(-1, 4)
+    x_center, y_center, width, height = (boxes[None, :, i] for i in range(4))
+    px, py, pw, ph = (person_boxes[:, i, None] for i in range(4))
+
+    # Same arithmetic, in the same order, as adjust_bbox so the results are bit-identical
+    new_x_center = (x_center - px + pw / 2) / pw
+    new_y_center = (y_center - py + ph / 2) / ph
+    new_width = width / pw
+    new_height = height / ph
+
+    inside = (new_x_center >= 0) & (new_x_center <= 1) & (new_y_center >= 0) & (new_y_center <= 1)
+    valid_size = (new_width > 0) & (new_width <= 1) & (new_height > 0) & (new_height <= 1)
+    return np.stack([new_x_center, new_y_center, new_width, new_height], axis=-1), inside & valid_size
+
+
+def load_annotations(annotation_path, w, h):
+    # Rows of (class_id, x_center, y_center, width, height) in pixels
+    with open(annotation_path, 'r') as f:
+        return annotations_from_lines(f, w, h)
+
+
+def annotations_from_lines(lines, w, h):
+    rows = [line.split() for line in lines if line.strip()]
+    if not rows:
+        return np.zeros((0, 5))
+    annotations = np.array(rows, dtype=np.float64)
+    annotations[:, 1:] *= np.array([w, h, w, h], dtype=np.float64)
+    return annotations
+
+
+def process_image(image_path, annotation_path, output_image_dir, output_label_dir, person_class_id=0, cache=None):
+    # Returns a summary Counter for this image. Pass image_io.image_cache when something else in the
+    # process decodes the same image (each image is read once here).
+    summary = Counter(images=1)
+    if not os.path.exists(annotation_path):
+        summary['missing_labels'] += 1
+        return summary
+
     # Load image
-    image = cv2.imread(image_path)
+    image = load_image(image_path, cache=cache)
+    if image is None:
+        summary['unreadable_images'] += 1
+        return summary
     h, w, _ = image.shape
 
     # Load annotations
-    annotations = []
-    with open(annotation_path, 'r') as f:
-        for line in f:
-            class_id, x_center, y_center, width, height = map(float, line.strip().split())
-            annotations.append([int(class_id), x_center * w, y_center * h, width * w, height * h])
+    annotations = load_annotations(annotation_path, w, h)
+    base_name = os.path.splitext(os.path.basename(image_path))[0]
+    label_base_name = os.path.splitext(os.path.basename(annotation_path))[0]
+    return crop_sample(image, annotations, base_name, label_base_name, output_image_dir, output_label_dir,
+                       person_class_id, summary)
+
+
+def process_packed(pack_path, image_name, annotation_path, output_image_dir, output_label_dir, person_class_id=0):
+    # process_image for a sample of a packed dataset; its labels come from the pack unless annotation_path is given
+    summary = Counter(images=1)
+    dataset = open_packed(pack_path)
+    if annotation_path is None:
+        label_text = dataset.read_label_text(image_name)
+    elif os.path.exists(annotation_path):
+        with open(annotation_path, 'r') as f:
+            label_text = f.read()
+    else:
+        label_text = None
+    if label_text is None:
+        summary['missing_labels'] += 1
+        return summary
+
+    image = dataset.read_image(image_name)
+    if image is None:
+        summary['unreadable_images'] += 1
+        return summary
+    h, w, _ = image.shape
+    annotations = annotations_from_lines(label_text.splitlines(), w, h)
+    base_name = os.path.splitext(image_name)[0]
+    return crop_sample(image, annotations, base_name, base_name, output_image_dir, output_label_dir,
+                       person_class_id, summary)
 
-    # Extract person bounding boxes
-    person_bboxes = [ann for ann in annotations if ann[0] == person_class_id]
 
-    # Process each person bounding box
-    for i, person_bbox in enumerate(person_bboxes):
-        px_center, py_center, p_width, p_height = person_bbox[1:]
+def crop_sample(image, annotations, base_name, label_base_name, output_image_dir, output_label_dir, person_class_id,
+                summary, outputs=None):
+    # Writes the person crops of one decoded image and their PPE labels, counting what happened in summary
+    # (and appending the written paths to outputs when given)
+    h, w, _ = image.shape
+    class_ids = annotations[:, 0].astype(int)
+
+    # Split person and PPE bounding boxes
+    is_person = class_ids == person_class_id
+    person_bboxes = annotations[is_person, 1:]
+    ppe_class_ids = class_ids[~is_person] - 1  # Decrease class index by 1
+    adjusted, keep = adjust_bboxes(annotations[~is_person, 1:], person_bboxes)
+
+    summary['persons'] += len(person_bboxes)
+    summary['ppe_boxes'] += len(ppe_class_ids)
+    # PPE boxes that do not fall inside any person are lost from the cropped dataset
+    summary['ppe_boxes_dropped'] += int((~keep.any(axis=0)).sum()) if len(person_bboxes) else len(ppe_class_ids)
 
+    # Process each person bounding box
+    for i, (px_center, py_center, p_width, p_height) in enumerate(person_bboxes):
         # Crop the image around the person bbox
         x1 = int(px_center - p_width / 2)
         y1 = int(py_center - p_height / 2)
@@ -54,57 +144,98 @@ def process_image(image_path, annotation_path, output_image_dir, output_label_di
         x2 = min(x2, w)
         y2 = min(y2, h)
 
-        # Calculate the width and height of the cropped image
-        crop_w = x2 - x1
-        crop_h = y2 - y1
-
-        # Crop the image if the bounding box is within the valid area
-        if crop_w > 0 and crop_h > 0:
-            cropped_image = image[y1:y2, x1:x2]
-
-            # Create new annotations for cropped image
-            new_annotations = []
-            for ann in annotations:
-                if ann[0] != person_class_id:  # Skip person bbox
-                    # Adjust the bounding box coordinates to the cropped image
-                    adjusted_bbox = adjust_bbox(ann[1:], person_bbox[1:])
-                    if adjusted_bbox:
-                        new_class_id = ann[0] - 1  # Decrease class index by 1
-                        new_annotations.append([new_class_id] + adjusted_bbox)
-
-            if new_annotations:
-                # Save the cropped image
-                output_image_path = os.path.join(output_image_dir,
-                                                 f"{os.path.splitext(os.path.basename(image_path))[0]}_p{i + 1}.jpg")
-                cv2.imwrite(output_image_path, cropped_image)
-
-                # Save the corresponding annotation
-                output_label_path = os.path.join(output_label_dir,
-                                                 f"{os.path.splitext(os.path.basename(annotation_path))[0]}_p{i + 1}.txt")
-                with open(output_label_path, 'w') as f:
-                    for ann in new_annotations:
-                        f.write(f"{ann[0]} {ann[1]:.6f} {ann[2]:.6f} {ann[3]:.6f} {ann[4]:.6f}\n")
+        # Skip the crop if the bounding box is outside the valid area
+        if x2 - x1 <= 0 or y2 - y1 <= 0:
+            summary['crops_out_of_bounds'] += 1
+            continue
+
+        # New annotations for the cropped image
+        kept = np.flatnonzero(keep[i])
+        if not len(kept):
+            summary['crops_without_ppe'] += 1
+            continue
+
+        # Save the cropped image
+        output_image_path = os.path.join(output_image_dir, f"{base_name}_p{i + 1}.jpg")
+        cv2.imwrite(output_image_path, image[y1:y2, x1:x2])
+
+        # Save the corresponding annotation
+        output_label_path = os.path.join(output_label_dir, f"{label_base_name}_p{i + 1}.txt")
+        with open(output_label_path, 'w') as f:
+            for class_id, (x, y, bw, bh) in zip(ppe_class_ids[kept], adjusted[i, kept]):
+                f.write(f"{class_id} {x:.6f} {y:.6f} {bw:.6f} {bh:.6f}\n")
+        summary['crops_written'] += 1
+        if outputs is not None:
+            outputs += [output_image_path, output_label_path]
+        summary['ppe_boxes_written'] += len(kept)
+    return summary
+
+
+def _process_task(task):
+    # (function, arguments...): process_image for image files, process_packed for packed samples
+    return task[0](*task[1:])
+
+
+def crop_dataset(image_dir, label_dir, output_image_dir, output_label_dir, person_class_id=0, workers=1):
+    # Crop every .jpg of image_dir (or of a packed dataset), returns the summed summary Counter
+    os.makedirs(output_image_dir, exist_ok=True)
+    os.makedirs(output_label_dir, exist_ok=True)
+
+    tasks = []
+    if is_packed(image_dir):
+        # Labels are read from the pack, unless label_dir is a directory of label files
+        use_label_dir = os.path.isdir(label_dir)
+        for image_file in sorted(open_packed(image_dir).image_names()):
+            if image_file.endswith(".jpg"):
+                annotation_path = None
+                if use_label_dir:
+                    annotation_path = os.path.join(label_dir, f"{os.path.splitext(image_file)[0]}.txt")
+                tasks.append((process_packed, image_dir, image_file, annotation_path, output_image_dir,
+                              output_label_dir, person_class_id))
+    else:
+        for image_file in sorted(os.listdir(image_dir)):
+            if image_file.endswith(".jpg"):
+                image_path = os.path.join(image_dir, image_file)
+                annotation_path = os.path.join(label_dir, f"{os.path.splitext(image_file)[0]}.txt")
+                tasks.append((process_image, image_path, annotation_path, output_image_dir,
+                              output_label_dir, person_class_id))
+
+    summary = Counter()
+    if workers > 1:
+        # Each worker decodes and crops its own share of images; only the small summaries come back
+        chunksize = max(len(tasks) // (workers * 8), 1)
+        with Pool(workers) as pool:
+            for image_summary in pool.imap_unordered(_process_task, tasks, chunksize=chunksize):
+                summary.update(image_summary)
+    else:
+        for task in tasks:
+            summary.update(_process_task(task))
+    return summary
+
 
 def main():
     parser = argparse.ArgumentParser(description='Process and crop images with bounding boxes.')
-    parser.add_argument('image_dir', type=str, help='Directory containing input images.')
-    parser.add_argument('label_dir', type=str, help='Directory containing input annotations.')
+    parser.add_argument('image_dir', type=str, help='Directory containing input images, or a packed dataset (shards.py).')
+    parser.add_argument('label_dir', type=str, help='Directory containing input annotations (ignored for a packed '
+                                                    'dataset unless it exists).')
     parser.add_argument('output_image_dir', type=str, help='Directory to save cropped images.')
     parser.add_argument('output_label_dir', type=str, help='Directory to save cropped annotations.')
     parser.add_argument('--person_class_id', type=int, default=0, help='Class ID for person annotations (default: 0).')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes (default: 1).')
 
     args = parser.parse_args()
 
-    os.makedirs(args.output_image_dir, exist_ok=True)
-    os.makedirs(args.output_label_dir, exist_ok=True)
+    summary = crop_dataset(args.image_dir, args.label_dir, args.output_image_dir, args.output_label_dir,
+                           args.person_class_id, args.workers)
 
-    for image_file in os.listdir(args.image_dir):
-        if image_file.endswith(".jpg"):
-            image_path = os.path.join(args.image_dir, image_file)
-            annotation_path = os.path.join(args.label_dir, f"{os.path.splitext(image_file)[0]}.txt")
-            process_image(image_path, annotation_path, args.output_image_dir, args.output_label_dir, args.person_class_id)
+    print("Crop summary:")
+    for key in ('images', 'missing_labels', 'unreadable_images', 'persons', 'crops_written', 'crops_without_ppe',
+                'crops_out_of_bounds', 'ppe_boxes', 'ppe_boxes_written', 'ppe_boxes_dropped'):
+        print(f"  {key}: {summary[key]}")
 
 if __name__ == "__main__":
     main()
 
-# python crop_images.py augmented_data/images augmented_data/all_labels augmented_data/cropped/images augmented_data/cropped/labels
\ No newline at end of file
+# python crop_images.py augmented_data/images augmented_data/all_labels augmented_data/cropped/images augmented_data/cropped/labels
+# python crop_images.py augmented_data/images augmented_data/all_labels augmented_data/cropped/images augmented_data/cropped/labels --workers 8
+# python crop_images.py augmented_data/packed - augmented_data/cropped/images augmented_data/cropped/labels --workers 8
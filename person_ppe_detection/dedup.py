@@ -0,0 +1,422 @@
+import os
+import json
+import time
+import argparse
+from itertools import combinations
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from annotation_index import AnnotationIndex
+from image_io import IMAGE_EXTENSIONS, decode_image, image_size, read_image
+from shards import is_packed, open_packed
+from tiling import box_overlap
+from detection_metrics import yolo_to_xyxy
+
+HASHES = ('dhash', 'phash')
+CACHE_VERSION = 1
+MANIFEST_VERSION = 1
+MIN_HASH_SIDE = 64  # smallest decoded side worth hashing; bigger JPEGs are decoded at a DCT-reduced scale
+CHUNK_BITS = 16  # multi-index hashing: the 64-bit hashes are looked up by four 16-bit chunks
+
+# Finds near-duplicate images (overlapping camera dumps, re-encoded copies) by 64-bit perceptual hashes and
+# writes a manifest of the duplicate groups: one image of each group is kept, the others are dropped.
+# split_dataset.py and build.py read the manifest; dropping an image also drops the f_ flips and _pN crops
+# made from it. Memory stays linear in the number of images: hashes and sizes are numpy arrays, the pair
+# search never materialises more than max_candidates candidate pairs at once and merges them into a
+# union-find as it goes, and only duplicate groups are ever held as Python objects.
+
+
+def default_cache_path(image_dir):
+    image_dir = os.path.abspath(image_dir)
+    return os.path.join(os.path.dirname(image_dir), f'.{os.path.basename(image_dir)}.hashes.npz')
+
+
+def _pack_bits(bits):
+    return int(np.packbits(bits.ravel()).view('>u8')[0])
+
+
+def image_hashes(gray):
+    # (dHash, pHash) of a grayscale image: the sign of horizontal gradients on a 9x8 thumbnail, and the low
+    # 8x8 DCT frequencies of a 32x32 thumbnail above their median
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    dhash = _pack_bits(small[:, 1:] > small[:, :-1])
+    low = cv2.dct(cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32))[:8, :8]
+    return dhash, _pack_bits(low > np.median(low))
+
+
+def hash_scale(width, height):
+    # Largest DCT scale that still decodes at least MIN_HASH_SIDE pixels on the short side
+    return max([s for s in (8, 4, 2) if min(width, height) // s >= MIN_HASH_SIDE] + [1])
+
+
+def _hash_chunk(source, names):
+    # Worker: (dhash, phash, width, height) arrays of the named images of a directory or packed dataset;
+    # width 0 for an image that can't be decoded
+    packed = open_packed(source) if is_packed(source) else None
+    result = np.zeros((len(names), 4), np.uint64)
+    for k, name in enumerate(names):
+        if packed is not None:
+            i = packed.index_of(name)
+            width, height = int(packed.widths[i]), int(packed.heights[i])
+            gray = decode_image(packed.read_bytes(name), hash_scale(width, height), grayscale=True)
+        else:
+            path = os.path.join(source, name)
+            width, height = image_size(path)
+            gray = read_image(path, hash_scale(width, height), grayscale=True)
+        if gray is None or gray.size == 0:
+            continue
+        if not width:
+            height, width = gray.shape[:2]
+        result[k] = (*image_hashes(gray), width, height)
+    return result
+
+
+def list_images(source):
+    # (names, sizes, mtimes) of the images of a directory, sorted by name; a packed dataset's sample sizes
+    # stand in for file stats
+    if is_packed(source):
+        dataset = open_packed(source)
+        order = np.argsort(np.array(dataset.image_names()))
+        names = np.array(dataset.image_names())[order]
+        return names, dataset.image_sizes[order].astype(np.int64), np.zeros(len(names), np.int64)
+    names, sizes, mtimes = [], [], []
+    with os.scandir(source) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                st = entry.stat()
+                names.append(entry.name)
+                sizes.append(st.st_size)
+                mtimes.append(st.st_mtime_ns)
+    order = np.argsort(np.array(names, dtype=str))
+    return (np.array(names, dtype=str)[order], np.array(sizes, np.int64)[order], np.array(mtimes, np.int64)[order])
+
+
+def load_cache(cache_path):
+    if not cache_path or not os.path.exists(cache_path):
+        return None
+    try:
+        with np.load(cache_path) as data:
+            if int(data['version']) != CACHE_VERSION:
+                return None
+            return {name: data[name] for name in ('names', 'sizes', 'mtimes', 'hashes')}
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_cache(cache_path, names, sizes, mtimes, hashes):
+    # Best effort: without a writable cache location the next run just hashes again
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp.npz'
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        np.savez(tmp_path, version=CACHE_VERSION, names=names, sizes=sizes, mtimes=mtimes, hashes=hashes)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Warning: could not write the hash cache {cache_path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def hash_images(source, workers=8, cache_path=None, chunk_size=256, pool=None):
+    # (names, (N, 4) uint64 [dhash, phash, width, height]) of every image of source. Images whose size
+    # and mtime match the cache aren't decoded again; the others are hashed in chunks on a process pool
+    # (`pool`, or one of `workers` processes).
+    names, sizes, mtimes = list_images(source)
+    hashes = np.zeros((len(names), 4), np.uint64)
+    todo = np.ones(len(names), bool)
+    cache = load_cache(cache_path)
+    if cache is not None and len(cache['names']) and len(names):
+        rows = np.clip(np.searchsorted(cache['names'], names), 0, len(cache['names']) - 1)
+        hit = ((cache['names'][rows] == names) & (cache['sizes'][rows] == sizes) & (cache['mtimes'][rows] == mtimes))
+        hashes[hit] = cache['hashes'][rows[hit]]
+        todo &= ~hit
+
+    missing = np.flatnonzero(todo)
+    chunks = [missing[i:i + chunk_size] for i in range(0, len(missing), chunk_size)]
+    if chunks:
+        executor = pool or ProcessPoolExecutor(workers)
+        try:
+            # Submitted in windows so a million pending futures (and their results) never pile up
+            window = 4 * max(workers, 1)
+            for start in range(0, len(chunks), window):
+                batch = chunks[start:start + window]
+                futures = [executor.submit(_hash_chunk, source, names[rows].tolist()) for rows in batch]
+                for rows, future in zip(batch, futures):
+                    hashes[rows] = future.result()
+        finally:
+            if pool is None:
+                executor.shutdown()
+    if cache_path and (len(missing) or cache is None):
+        save_cache(cache_path, names, sizes, mtimes, hashes)
+    return names, hashes, len(missing)
+
+
+def popcount(values):
+    # Set bits of each uint64 (np.bitwise_count is numpy >= 2 only)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    values = np.ascontiguousarray(values, np.uint64)
+    return np.unpackbits(values[..., None].view(np.uint8), axis=-1).sum(axis=-1)
+
+
+def _chunk_masks(radius):
+    # Every CHUNK_BITS value with at most `radius` bits set
+    masks = [0]
+    for r in range(1, radius + 1):
+        masks += [sum(1 << b for b in bits) for bits in combinations(range(CHUNK_BITS), r)]
+    return np.array(masks, np.int64)
+
+
+def union(parent, i, j):
+    # Merge the sets of every (i, j) edge into a union-find `parent` array (each root is the smallest index
+    # of its set), vectorised: hook the larger root under the smaller one, then compress paths
+    while len(i):
+        ri, rj = parent[i], parent[j]
+        lo, hi = np.minimum(ri, rj), np.maximum(ri, rj)
+        changed = lo != hi
+        if not changed.any():
+            break
+        i, j = i[changed], j[changed]
+        np.minimum.at(parent, hi[changed], lo[changed])
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parent = grand
+    return parent
+
+
+def duplicate_groups(hashes, max_distance, max_candidates=1 << 20):
+    # Root of every row's group: rows whose hashes (the columns of `hashes`) are all within max_distance
+    # bits of each other are linked, transitively. Identical hashes are merged first; the distinct ones are
+    # compared by multi-index hashing instead of all pairs: split into four 16-bit chunks, two hashes within
+    # r bits agree within r // 4 bits on at least one chunk, so every hash is only compared with the hashes
+    # bucketed under its chunk values XOR each mask of at most r // 4 bits.
+    hashes = np.asarray(hashes, np.uint64)
+    if hashes.ndim == 1:
+        hashes = hashes[:, None]
+    if not len(hashes):
+        return np.zeros(0, np.int64)
+    if hashes.shape[1] == 1:
+        unique, first, inverse = np.unique(hashes[:, 0], return_index=True, return_inverse=True)
+        unique = unique[:, None]
+    else:
+        unique, first, inverse = np.unique(hashes, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    parent = np.arange(len(unique))
+
+    key, rest = unique[:, 0], unique[:, 1:]
+    masks = _chunk_masks(max_distance // (64 // CHUNK_BITS))
+    for c in range(64 // CHUNK_BITS):
+        values = ((key >> np.uint64(c * CHUNK_BITS)) & np.uint64((1 << CHUNK_BITS) - 1)).astype(np.uint16)
+        order = np.argsort(values, kind='stable')  # a radix sort for 16-bit values
+        values = values.astype(np.int64)
+        bucketed = key[order]  # candidates of a probe are a contiguous run of this
+        starts = np.concatenate([[0], np.cumsum(np.bincount(values, minlength=1 << CHUNK_BITS))])
+        for mask in masks.tolist():
+            # Each pair of buckets once: from the lower chunk value to the higher one, or within the bucket
+            queries = np.flatnonzero(values < values ^ mask) if mask else np.arange(len(unique))
+            probe = values[queries] ^ mask
+            lo = starts[probe]
+            counts = starts[probe + 1] - lo
+            ends = np.cumsum(counts)
+            # Queries in steps of at most max_candidates candidate pairs (at least one query per step)
+            q = 0
+            while q < len(queries):
+                base = ends[q - 1] if q else 0
+                stop = max(int(np.searchsorted(ends, base + max_candidates, 'right')), q + 1)
+                step_counts, step_ends = counts[q:stop], ends[q:stop] - base
+                total = int(step_ends[-1])
+                if total:
+                    pos = np.arange(total) + np.repeat(lo[q:stop] - (step_ends - step_counts), step_counts)
+                    hits = np.flatnonzero(popcount(np.repeat(key[queries[q:stop]], step_counts) ^ bucketed[pos])
+                                          <= max_distance)
+                    i = queries[q + np.searchsorted(step_ends, hits, 'right')]
+                    j = order[pos[hits]]
+                    close = j > i if not mask else np.ones(len(i), bool)
+                    if rest.shape[1]:
+                        close &= (popcount(rest[i] ^ rest[j]) <= max_distance).all(axis=1)
+                    parent = union(parent, i[close], j[close])
+                q = stop
+
+    # Back to rows: each row gets the first row of its group's root hash
+    return first[parent][inverse]
+
+
+def _load_labels(source, labels_dir):
+    # name -> (class_ids, boxes) lookup (None without a label file)
+    if labels_dir is None and not is_packed(source):
+        return lambda name: None
+    if is_packed(source):
+        dataset = open_packed(source)
+        return dataset.read_label
+    index = AnnotationIndex.load(labels_dir)
+
+    def read(name):
+        label = os.path.splitext(name)[0] + '.txt'
+        try:
+            rows = index.rows_of(label)
+        except KeyError:
+            return None
+        return index.class_ids[rows], index.boxes[rows]
+    return read
+
+
+def label_conflict(a, b, iou_threshold=0.5):
+    # Why two labels of the same picture disagree, or None: one is missing, their per-class box counts
+    # differ, or a box has no same-class box at iou_threshold in the other
+    if a is None or b is None:
+        return None if a is None and b is None else 'missing_label'
+    (classes_a, boxes_a), (classes_b, boxes_b) = a, b
+    if not np.array_equal(np.sort(classes_a), np.sort(classes_b)):
+        return 'class_counts'
+    for c in np.unique(classes_a).tolist():
+        iou = box_overlap(yolo_to_xyxy(boxes_a[classes_a == c]), yolo_to_xyxy(boxes_b[classes_b == c]))
+        if (iou.max(axis=1) < iou_threshold).any() or (iou.max(axis=0) < iou_threshold).any():
+            return 'boxes'
+    return None
+
+
+def find_duplicates(source, labels_dir=None, hash_name='phash', max_distance=6, conflicts='keep',
+                    iou_threshold=0.5, workers=8, cache_path=None, pool=None):
+    # Manifest of the near-duplicate groups of a directory (with labels_dir) or packed dataset. Members are
+    # ranked by having a label file, then most boxes, then most pixels, then name; the first is kept and
+    # each next one is dropped as [name, distance, kept image it duplicates] when a kept image within
+    # max_distance has agreeing labels. Members whose labels disagree are listed under 'conflicts' and,
+    # with conflicts='keep', kept under 'also_keep' (consumers keep a group together, e.g. in one split).
+    start = time.perf_counter()
+    names, hashes, hashed = hash_images(source, workers, cache_path, pool=pool)
+    readable = np.flatnonzero(hashes[:, 2] > 0)
+    columns = [HASHES.index(hash_name)] if hash_name in HASHES else [1, 0]  # 'both': phash, checked by dhash
+    roots = duplicate_groups(hashes[readable][:, columns], max_distance)
+
+    # Only the rows of groups with more than one member are split into (Python) groups
+    order = np.argsort(roots, kind='stable')
+    sorted_roots = roots[order]
+    same = np.diff(sorted_roots) == 0
+    grouped = np.zeros(len(roots), bool)
+    grouped[1:] |= same
+    grouped[:-1] |= same
+    order, sorted_roots = order[grouped], sorted_roots[grouped]
+    read_label = _load_labels(source, labels_dir)
+    groups, dropped, conflicting = [], 0, 0
+    for members in np.split(order, np.flatnonzero(np.diff(sorted_roots)) + 1) if len(order) else []:
+        rows = readable[members]
+        labels = [read_label(name) for name in names[rows].tolist()]
+        pixels = (hashes[rows, 2] * hashes[rows, 3]).astype(np.int64)
+        rank = sorted(range(len(rows)), key=lambda k: (labels[k] is None, -(len(labels[k][0]) if labels[k] else 0),
+                                                        -pixels[k], names[rows[k]]))
+        # Linked pairs can chain (e.g. a panning camera), so a member is only dropped for an image that is
+        # kept and within max_distance of it itself; otherwise it is kept too, still in the group
+        kept = [rank[0]]
+        group = {'keep': str(names[rows[rank[0]]]), 'also_keep': [], 'drop': [], 'conflicts': {}}
+        for k in rank[1:]:
+            name = str(names[rows[k]])
+            distances = popcount(hashes[rows[kept]][:, columns] ^ hashes[rows[k], columns]).max(axis=1)
+            near = [(kept[m], int(distances[m])) for m in np.flatnonzero(distances <= max_distance).tolist()]
+            reasons = [label_conflict(labels[other], labels[k], iou_threshold) for other, _ in near]
+            if None in reasons:
+                other, distance = near[reasons.index(None)]
+                group['drop'].append([name, distance, str(names[rows[other]])])
+                dropped += 1
+            elif near and conflicts == 'drop':
+                group['conflicts'][name] = reasons[0]
+                group['drop'].append([name, near[0][1], str(names[rows[near[0][0]]])])
+                conflicting += 1
+                dropped += 1
+            else:
+                if near:
+                    group['conflicts'][name] = reasons[0]
+                    conflicting += 1
+                group['also_keep'].append([name, int(distances.min())])
+                kept.append(k)
+        groups.append(group)
+
+    return {
+        'version': MANIFEST_VERSION,
+        'source': os.path.abspath(source),
+        'hash': hash_name,
+        'max_distance': max_distance,
+        'conflicts': conflicts,
+        'summary': {
+            'images': len(names),
+            'hashed': hashed,
+            'unreadable': int(len(names) - len(readable)),
+            'groups': len(groups),
+            'dropped': dropped,
+            'label_conflicts': conflicting,
+            'seconds': round(time.perf_counter() - start, 3),
+        },
+        'unreadable': names[hashes[:, 2] == 0].tolist(),
+        'groups': groups,
+    }
+
+
+def base_stem(file_name):
+    # Stem without the f_ prefixes of data_augmentation.py's flips
+    stem = os.path.splitext(os.path.basename(file_name))[0]
+    while stem.startswith('f_'):
+        stem = stem[2:]
+    return stem
+
+
+def load_manifest(path):
+    # (stems of the dropped images, {source id: source id of the group's kept image}) of a manifest, the
+    # stems without f_ prefixes so derived files can be matched with is_dropped()
+    from split_dataset import source_id
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    dropped, aliases = set(), {}
+    for group in manifest['groups']:
+        dropped.update(base_stem(name) for name, *_ in group['drop'])
+        for name, _ in group['also_keep']:
+            aliases[source_id(name)] = source_id(group['keep'])
+    return dropped, aliases
+
+
+def is_dropped(file_name, dropped):
+    # A dropped image, or a flip or crop made from one
+    from split_dataset import source_id
+    return base_stem(file_name) in dropped or source_id(file_name) in dropped
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find near-duplicate images by perceptual hashes, flag label '
+                                                 'conflicts between them and write a keep/drop manifest.')
+    parser.add_argument('images', type=str, help='Image directory, or a packed dataset (shards.py).')
+    parser.add_argument('labels', type=str, help='Label directory (unused for a packed dataset).')
+    parser.add_argument('--output', type=str, default='dedup_manifest.json', help='Manifest file.')
+    parser.add_argument('--hash', choices=HASHES + ('both',), default='phash',
+                        help="Hash to compare; 'both' needs pHash and dHash within --max_distance.")
+    parser.add_argument('--max_distance', type=int, default=6,
+                        help='Largest Hamming distance (of 64 bits) between near-duplicates (default: 6).')
+    parser.add_argument('--conflicts', choices=('keep', 'drop'), default='keep',
+                        help='Keep (default) or drop duplicates whose labels disagree with the kept image.')
+    parser.add_argument('--iou', type=float, default=0.5, help='Box IoU for labels to agree.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Hashing processes.')
+    parser.add_argument('--cache', type=str, default=None,
+                        help='Hash cache (default: hidden file next to the image directory).')
+    parser.add_argument('--no_cache', action='store_true', help='Rehash every image.')
+    args = parser.parse_args()
+
+    cache_path = None
+    if not args.no_cache and not is_packed(args.images):
+        cache_path = args.cache or default_cache_path(args.images)
+    manifest = find_duplicates(args.images, args.labels, args.hash, args.max_distance, args.conflicts, args.iou,
+                               args.workers, cache_path)
+    with open(args.output, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    for key, value in manifest['summary'].items():
+        print(f"{key}: {value}")
+    for group in manifest['groups']:
+        for name, conflict in group['conflicts'].items():
+            print(f"label conflict ({conflict}): {group['keep']} ~ {name}")
+
+
+if __name__ == '__main__':
+    main()
+
+# python dedup.py datasets/images datasets/labels --output dedup_manifest.json
+# python dedup.py augmented_data/cropped/images augmented_data/cropped/labels --hash both --max_distance 8 --conflicts drop
+# python split_dataset.py augmented_data/images augmented_data/labels person_dataset --dedup dedup_manifest.json
@@ -0,0 +1,191 @@
+import os
+
+import cv2
+import numpy as np
+
+from annotation_index import parse_label_file
+from image_io import IMAGE_EXTENSIONS
+from tiling import paired_iou
+
+IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+RECALL_POINTS = np.linspace(0, 1, 101)
+
+
+def yolo_to_xyxy(boxes, shape=(1, 1)):
+    # Normalised (xc, yc, w, h) label boxes -> xyxy, in pixels of `shape` (normalised by default)
+    h, w = shape[:2]
+    boxes = np.asarray(boxes, np.float32).reshape(-1, 4)
+    xc, yc, bw, bh = boxes[:, 0] * w, boxes[:, 1] * h, boxes[:, 2] * w, boxes[:, 3] * h
+    return np.stack([xc - bw / 2, yc - bh / 2, xc + bw / 2, yc + bh / 2], axis=1)
+
+
+def group_pairs(pred_keys, truth_keys):
+    # Every (prediction, truth) index pair sharing a key (e.g. image * num_classes + class), without
+    # a loop over images: truths sorted by key, each prediction expanded over its key's range
+    truth_order = np.argsort(truth_keys, kind='stable')
+    sorted_keys = np.asarray(truth_keys)[truth_order]
+    start = np.searchsorted(sorted_keys, pred_keys, 'left')
+    counts = np.searchsorted(sorted_keys, pred_keys, 'right') - start
+    pred_index = np.repeat(np.arange(len(pred_keys)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return pred_index, truth_order[np.repeat(start, counts) + offsets]
+
+
+def greedy_match(pred_index, truth_index, iou, threshold):
+    # One-to-one matches among candidate pairs, highest IoU first (as ultralytics' validator does)
+    ok = iou >= threshold
+    order = np.argsort(-iou[ok], kind='stable')
+    p, t = pred_index[ok][order], truth_index[ok][order]
+    first = np.sort(np.unique(p, return_index=True)[1])
+    p, t = p[first], t[first]
+    first = np.unique(t, return_index=True)[1]
+    return p[first], t[first]
+
+
+def match_all(pred_image, pred_boxes, pred_classes, truth_image, truth_boxes, truth_classes,
+              iou_thresholds=IOU_THRESHOLDS):
+    # (N, T) true positive flags of all predictions of a dataset against same-image, same-class truth
+    num_classes = int(max(np.max(pred_classes, initial=0), np.max(truth_classes, initial=0))) + 1
+    p, t = group_pairs(np.asarray(pred_image) * num_classes + pred_classes,
+                       np.asarray(truth_image) * num_classes + truth_classes)
+    iou = paired_iou(pred_boxes[p], truth_boxes[t])
+    keep = iou >= iou_thresholds.min()
+    p, t, iou = p[keep], t[keep], iou[keep]
+    tp = np.zeros((len(pred_image), len(iou_thresholds)), bool)
+    for k, threshold in enumerate(iou_thresholds):
+        tp[greedy_match(p, t, iou, threshold)[0], k] = True
+    return tp
+
+
+def precision_recall(tp, scores, num_truth):
+    # Precision and recall after each prediction in descending score order, one column per threshold
+    order = np.argsort(-scores, kind='stable')
+    tps = np.cumsum(tp[order], axis=0)
+    return tps / np.arange(1, len(tp) + 1)[:, None], tps / max(num_truth, 1), scores[order]
+
+
+def interpolated_precision(precision, recall):
+    # Precision envelope, then the best precision reachable at each of the 101 recall points
+    if len(precision) == 0:
+        return np.zeros(len(RECALL_POINTS))
+    envelope = np.maximum.accumulate(precision[::-1])[::-1]
+    index = np.searchsorted(recall, RECALL_POINTS, side='left')
+    return np.where(index < len(envelope), envelope[np.minimum(index, len(envelope) - 1)], 0)
+
+
+def average_precision(tp, scores, num_truth):
+    # Area under the interpolated precision/recall curve (101 recall points), one value per column of tp
+    if num_truth == 0:
+        return np.full(tp.shape[1], np.nan)
+    precision, recall, _ = precision_recall(tp, scores, num_truth)
+    return np.array([interpolated_precision(precision[:, t], recall[:, t]).mean() for t in range(tp.shape[1])])
+
+
+class DetectionEvaluator:
+    # Accumulates predictions and ground truth, then matches the whole dataset at once for per-class
+    # AP, PR curves and the confusion matrix. Boxes only need to be in the same units per image
+    # (pixels, or normalised since IoU doesn't change when an axis is scaled).
+    def __init__(self, iou_thresholds=IOU_THRESHOLDS):
+        self.iou_thresholds = np.asarray(iou_thresholds)
+        self.parts = []
+        self.images = 0
+        self._arrays = None
+
+    def add(self, dets, truth_boxes, truth_classes):
+        # One image
+        self.add_arrays(np.zeros(len(dets.scores), int), dets.boxes, dets.scores, dets.classes,
+                        np.zeros(len(truth_classes), int), truth_boxes, truth_classes, images=1)
+
+    def add_arrays(self, pred_image, pred_boxes, pred_scores, pred_classes, truth_image, truth_boxes, truth_classes,
+                   images):
+        # Many images at once, image indices in [0, images)
+        self.parts.append((np.asarray(pred_image, int) + self.images, np.asarray(pred_boxes, np.float32).reshape(-1, 4),
+                           np.asarray(pred_scores, np.float32), np.asarray(pred_classes, int),
+                           np.asarray(truth_image, int) + self.images,
+                           np.asarray(truth_boxes, np.float32).reshape(-1, 4), np.asarray(truth_classes, int)))
+        self.images += images
+        self._arrays = None
+
+    def arrays(self):
+        if self._arrays is None:
+            columns = list(zip(*self.parts)) if self.parts else [[np.zeros(0, int)], [np.zeros((0, 4), np.float32)],
+                                                                 [np.zeros(0, np.float32)], [np.zeros(0, int)],
+                                                                 [np.zeros(0, int)], [np.zeros((0, 4), np.float32)],
+                                                                 [np.zeros(0, int)]]
+            self._arrays = [np.concatenate(c) for c in columns]
+            self.parts = [tuple(self._arrays)]
+        return self._arrays
+
+    def _matched(self):
+        pred_image, pred_boxes, scores, classes, truth_image, truth_boxes, truth_classes = self.arrays()
+        tp = match_all(pred_image, pred_boxes, classes, truth_image, truth_boxes, truth_classes, self.iou_thresholds)
+        return tp, scores, classes, truth_classes
+
+    def summary(self, names=None):
+        tp, scores, classes, truth = self._matched()
+        per_class = {}
+        for class_id in np.union1d(np.unique(truth), np.unique(classes)):
+            mask = classes == class_id
+            num_truth = int((truth == class_id).sum())
+            ap = average_precision(tp[mask], scores[mask], num_truth)
+            name = names[int(class_id)] if names else int(class_id)
+            per_class[name] = {'truth': num_truth, 'predictions': int(mask.sum()),
+                               'ap50': float(ap[0]), 'ap50_95': float(ap.mean())}
+        aps = [v for v in per_class.values() if v['truth']]
+        return {'map50': float(np.mean([v['ap50'] for v in aps])) if aps else 0.0,
+                'map50_95': float(np.mean([v['ap50_95'] for v in aps])) if aps else 0.0,
+                'images': self.images, 'per_class': per_class}
+
+    def pr_curves(self, names=None, threshold_index=0):
+        # {class: (recall points, interpolated precision)} at one IoU threshold (0.5 by default)
+        tp, scores, classes, truth = self._matched()
+        curves = {}
+        for class_id in np.unique(truth):
+            mask = classes == class_id
+            precision, recall, _ = precision_recall(tp[mask][:, threshold_index:threshold_index + 1], scores[mask],
+                                                    int((truth == class_id).sum()))
+            curves[names[int(class_id)] if names else int(class_id)] = (
+                RECALL_POINTS, interpolated_precision(precision[:, 0], recall[:, 0]))
+        return curves
+
+    def confusion_matrix(self, num_classes, iou_threshold=0.45, conf=0.25):
+        # (C + 1, C + 1) counts, rows predicted class and columns true class, the last row/column is
+        # background (false positives in the last column, missed objects in the last row)
+        pred_image, pred_boxes, scores, classes, truth_image, truth_boxes, truth_classes = self.arrays()
+        keep = scores >= conf
+        pred_image, pred_boxes, classes = pred_image[keep], pred_boxes[keep], classes[keep]
+        p, t = group_pairs(pred_image, truth_image)
+        p, t = greedy_match(p, t, paired_iou(pred_boxes[p], truth_boxes[t]), iou_threshold)
+        matrix = np.zeros((num_classes + 1, num_classes + 1), np.int64)
+        np.add.at(matrix, (classes[p], truth_classes[t]), 1)
+        unmatched = np.ones(len(classes), bool)
+        unmatched[p] = False
+        np.add.at(matrix, (classes[unmatched], num_classes), 1)
+        missed = np.ones(len(truth_classes), bool)
+        missed[t] = False
+        np.add.at(matrix, (num_classes, truth_classes[missed]), 1)
+        return matrix
+
+
+def evaluate_detector(detector, image_dir, label_dir, batch_size=16, limit=None):
+    # mAP of a detector callable on a YOLO-format split (images without a label file have no objects).
+    # Images that can't be read are reported and left out, ground truth included.
+    image_names = sorted(f for f in os.listdir(image_dir) if f.lower().endswith(IMAGE_EXTENSIONS))[:limit]
+    evaluator = DetectionEvaluator()
+    for start in range(0, len(image_names), batch_size):
+        batch = [(name, cv2.imread(os.path.join(image_dir, name))) for name in image_names[start:start + batch_size]]
+        for name, image in batch:
+            if image is None:
+                print(f"Warning: skipping unreadable image {os.path.join(image_dir, name)}")
+        batch = [(name, image) for name, image in batch if image is not None]
+        if not batch:
+            continue
+        batch_names, images = zip(*batch)
+        for name, image, dets in zip(batch_names, images, detector(list(images))):
+            label_path = os.path.join(label_dir, os.path.splitext(name)[0] + '.txt')
+            if os.path.exists(label_path):
+                class_ids, boxes, _ = parse_label_file(label_path)
+            else:
+                class_ids, boxes = np.zeros(0, int), np.zeros((0, 4), np.float32)
+            evaluator.add(dets, yolo_to_xyxy(boxes, image.shape), class_ids)
+    return evaluator.summary(getattr(detector, 'names', None))
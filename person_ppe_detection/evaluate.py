@@ -0,0 +1,263 @@
+import os
+import json
+import time
+import argparse
+
+import cv2
+import numpy as np
+
+from annotation_index import AnnotationIndex
+from detection_metrics import DetectionEvaluator, yolo_to_xyxy
+from image_io import IMAGE_EXTENSIONS
+
+
+def load_names(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def split_images(image_dir, label_dir):
+    # Stems of the images of a split; the label files when the images aren't at hand
+    if os.path.isdir(image_dir):
+        names = sorted(f for f in os.listdir(image_dir) if f.lower().endswith(IMAGE_EXTENSIONS))
+    else:
+        names = sorted(f for f in os.listdir(label_dir) if f.endswith('.txt'))
+    return names, [os.path.splitext(name)[0] for name in names]
+
+
+def truth_arrays(label_dir, stems):
+    # (image index, normalised xyxy box, class) of every ground truth box of the split's images
+    index = AnnotationIndex.load(label_dir)
+    lookup = {stem: i for i, stem in enumerate(stems)}
+    image_of_file = np.array([lookup.get(os.path.splitext(name)[0], -1) for name in index.names.tolist()], int)
+    image = image_of_file[index.image_ids] if len(index) else np.zeros(0, int)
+    keep = image >= 0
+    return image[keep], yolo_to_xyxy(np.asarray(index.boxes)[keep]), np.asarray(index.class_ids)[keep].astype(int)
+
+
+def sink_predictions(path, stems, end_to_end=False, stage=None):
+    # Predictions recorded by a sinks.py sink (.jsonl/.parquet/.arrow), boxes normalised by the
+    # recorded frame size. end_to_end maps two-stage rows to the full-frame label ids of classes.txt:
+    # persons are 0 and PPE classes are shifted by one (the inverse of crop_images.py).
+    from sinks import read_rows
+    rows = read_rows(path)
+    keep = rows['box_id'] >= 0
+    if stage:
+        keep &= rows['stage'].astype(str) == stage
+    lookup = {stem: i for i, stem in enumerate(stems)}
+    names = rows['image'][keep].astype(str)
+    image = np.array([lookup.get(os.path.splitext(os.path.basename(name))[0], -1) for name in names], int)
+    size = np.stack([rows['width'][keep], rows['height'][keep]] * 2, axis=1).astype(np.float32)
+    boxes = np.stack([rows[c][keep] for c in ('x1', 'y1', 'x2', 'y2')], axis=1).astype(np.float32) / size
+    classes = rows['class_id'][keep].astype(int)
+    if end_to_end:
+        classes = np.where(rows['stage'][keep].astype(str) == 'ppe', classes + 1, 0)
+    ok = image >= 0
+    return image[ok], boxes[ok], rows['score'][keep][ok].astype(np.float32), classes[ok]
+
+
+def yolo_predictions(label_dir, stems):
+    # Predictions as YOLO label files with a trailing confidence ("class xc yc w h conf")
+    images, boxes, scores, classes = [], [], [], []
+    for i, stem in enumerate(stems):
+        path = os.path.join(label_dir, stem + '.txt')
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            values = np.array(f.read().split(), np.float32).reshape(-1, 6)
+        images.append(np.full(len(values), i))
+        classes.append(values[:, 0].astype(int))
+        boxes.append(yolo_to_xyxy(values[:, 1:5]))
+        scores.append(values[:, 5])
+    if not images:
+        return np.zeros(0, int), np.zeros((0, 4), np.float32), np.zeros(0, np.float32), np.zeros(0, int)
+    return np.concatenate(images), np.concatenate(boxes), np.concatenate(scores), np.concatenate(classes)
+
+
+def model_predictions(detect, image_dir, image_names, batch_size=16):
+    # Run `detect` (list of images -> list of Detections in pixels) over the split's images. Returns the
+    # predictions and the indices of the images that couldn't be read (reported, and not run).
+    images, boxes, scores, classes, unreadable = [], [], [], [], []
+    for start in range(0, len(image_names), batch_size):
+        batch = []
+        for i in range(start, min(start + batch_size, len(image_names))):
+            frame = cv2.imread(os.path.join(image_dir, image_names[i]))
+            if frame is None:
+                print(f"Warning: skipping unreadable image {os.path.join(image_dir, image_names[i])}")
+                unreadable.append(i)
+            else:
+                batch.append((i, frame))
+        if not batch:
+            continue
+        indices, frames = zip(*batch)
+        for i, frame, dets in zip(indices, frames, detect(list(frames))):
+            h, w = frame.shape[:2]
+            images.append(np.full(len(dets.scores), i))
+            boxes.append(np.asarray(dets.boxes, np.float32).reshape(-1, 4) / np.array([w, h, w, h], np.float32))
+            scores.append(np.asarray(dets.scores, np.float32))
+            classes.append(np.asarray(dets.classes, int))
+    if not images:
+        return (np.zeros(0, int), np.zeros((0, 4), np.float32), np.zeros(0, np.float32), np.zeros(0, int)), unreadable
+    return (np.concatenate(images), np.concatenate(boxes), np.concatenate(scores), np.concatenate(classes)), unreadable
+
+
+def end_to_end_detector(pipeline):
+    # Full-frame Detections of a two-stage pipeline with the label ids of classes.txt (persons 0,
+    # PPE shifted by one), PPE boxes mapped back from the person crops
+    from two_stage import Detections
+
+    def detect(frames):
+        results = []
+        for frame in frames:
+            result = pipeline(frame)
+            people = result.people
+            results.append(Detections(
+                np.concatenate([result.persons.boxes] + [p.ppe_frame_boxes for p in people]).reshape(-1, 4),
+                np.concatenate([result.persons.scores] + [p.ppe.scores for p in people]),
+                np.concatenate([np.zeros(len(result.persons.scores), int)] + [p.ppe.classes + 1 for p in people])))
+        return results
+
+    return detect
+
+
+def print_summary(summary):
+    print(f"{'class':<16} {'truth':>7} {'preds':>8} {'AP50':>7} {'AP50-95':>8}")
+    for name, m in summary['per_class'].items():
+        print(f"{str(name):<16} {m['truth']:>7} {m['predictions']:>8} {m['ap50']:>7.4f} {m['ap50_95']:>8.4f}")
+    print(f"{'all':<16} {'':>7} {'':>8} {summary['map50']:>7.4f} {summary['map50_95']:>8.4f}   "
+          f"({summary['images']} images)")
+
+
+def save_plots(output_dir, curves, matrix, names):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(8, 6))
+    for name, (recall, precision) in curves.items():
+        ax.plot(recall, precision, label=str(name))
+    ax.set_xlabel('Recall')
+    ax.set_ylabel('Precision')
+    ax.set_xlim(0, 1)
+    ax.set_ylim(0, 1.01)
+    ax.set_title('Precision-Recall @ IoU 0.5')
+    ax.legend(loc='lower left', fontsize=8)
+    fig.savefig(os.path.join(output_dir, 'pr_curves.png'), dpi=150, bbox_inches='tight')
+    plt.close(fig)
+
+    labels = list(names) + ['background']
+    normalised = matrix / np.maximum(matrix.sum(axis=0, keepdims=True), 1)
+    fig, ax = plt.subplots(figsize=(9, 8))
+    ax.imshow(normalised, cmap='Blues', vmin=0, vmax=1)
+    ax.set_xticks(range(len(labels)), labels, rotation=90)
+    ax.set_yticks(range(len(labels)), labels)
+    ax.set_xlabel('True')
+    ax.set_ylabel('Predicted')
+    for (row, col), value in np.ndenumerate(matrix):
+        if value:
+            ax.text(col, row, str(value), ha='center', va='center', fontsize=7,
+                    color='white' if normalised[row, col] > 0.5 else 'black')
+    fig.savefig(os.path.join(output_dir, 'confusion_matrix.png'), dpi=150, bbox_inches='tight')
+    plt.close(fig)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score predictions against a YOLO-format test split (mAP, PR curves, '
+                                                 'confusion matrix).')
+    parser.add_argument('split', type=str, help='Split directory written by split_dataset.py (with images/ and labels/).')
+    parser.add_argument('--images', type=str, default=None, help='Image directory (default: <split>/images).')
+    parser.add_argument('--labels', type=str, default=None, help='Ground truth label directory (default: <split>/labels).')
+    parser.add_argument('--predictions', type=str, default=None,
+                        help='Recorded predictions: a .jsonl/.parquet/.arrow sink file or a directory of YOLO label '
+                             'files with confidences, e.g. from predict.py --label_dir.')
+    parser.add_argument('--weights', type=str, default=None, help='Run this model instead (.pt, .onnx or OpenVINO).')
+    parser.add_argument('--person_weights', type=str, default=None,
+                        help='With --ppe_weights, run the two-stage pipeline and score it on full-frame labels.')
+    parser.add_argument('--ppe_weights', type=str, default=None)
+    parser.add_argument('--end_to_end', action='store_true',
+                        help='The recorded predictions are two-stage results to score on full-frame labels.')
+    parser.add_argument('--stage', choices=('object', 'person', 'ppe'), default=None,
+                        help='Only score the sink rows of this stage.')
+    parser.add_argument('--classes_file', type=str, default=None,
+                        help='Class names (default: classes.txt end-to-end, cropped_classes.txt otherwise).')
+    parser.add_argument('--conf', type=float, default=0.001, help='Confidence threshold when running a model.')
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads per model.')
+    parser.add_argument('--batch_size', type=int, default=16, help='Images per model call.')
+    parser.add_argument('--cache', type=str, default=None,
+                        help='Result cache database: images already scored with the same weights and settings '
+                             'skip inference (use --conf 0.25 to reuse the results cached by predict.py).')
+    parser.add_argument('--output', type=str, default=None, help='Write metrics.json (and plots) to this directory.')
+    parser.add_argument('--plots', action='store_true', help='Also save pr_curves.png and confusion_matrix.png.')
+    args = parser.parse_args()
+
+    end_to_end = args.end_to_end or bool(args.person_weights)
+    if sum(bool(v) for v in (args.predictions, args.weights, args.person_weights)) != 1:
+        parser.error('give exactly one of --predictions, --weights or --person_weights/--ppe_weights')
+    if args.person_weights and not args.ppe_weights:
+        parser.error('--person_weights needs --ppe_weights')
+    image_dir = args.images or os.path.join(args.split, 'images')
+    label_dir = args.labels or os.path.join(args.split, 'labels')
+    names = load_names(args.classes_file or ('classes.txt' if end_to_end else 'cropped_classes.txt'))
+    image_names, stems = split_images(image_dir, label_dir)
+
+    start = time.perf_counter()
+    unreadable = []
+    if args.predictions and os.path.isdir(args.predictions):
+        predictions = yolo_predictions(args.predictions, stems)
+    elif args.predictions:
+        predictions = sink_predictions(args.predictions, stems, args.end_to_end, args.stage)
+    else:
+        from backends import load_detector
+        if args.weights:
+            detect = load_detector(args.weights, threads=args.threads, conf=args.conf)
+            if args.cache:
+                from result_cache import ResultCache, cache_namespace, cached_detector
+                # Same namespace as predict.py for the same settings
+                detect = cached_detector(detect, ResultCache(args.cache), cache_namespace(
+                    args.weights, backend=None, conf=args.conf, iou=0.7, imgsz='default', tile_size=None,
+                    tile_overlap=0.2, full_frame=True, merge='nms'))
+        else:
+            from two_stage import TwoStagePipeline
+            # Persons at the operating threshold, every PPE box for the full PR curve
+            pipeline = TwoStagePipeline(load_detector(args.person_weights, threads=args.threads),
+                                        load_detector(args.ppe_weights, threads=args.threads, conf=args.conf))
+            detect = end_to_end_detector(pipeline)
+        predictions, unreadable = model_predictions(detect, image_dir, image_names, args.batch_size)
+    loaded = time.perf_counter()
+
+    # Unreadable images were not run: they are left out, ground truth included, rather than counted as missed
+    truth = truth_arrays(label_dir, stems)
+    if unreadable:
+        readable = np.ones(len(stems), bool)
+        readable[unreadable] = False
+        renumber = np.cumsum(readable) - 1
+        keep = readable[truth[0]]
+        truth = (renumber[truth[0][keep]],) + tuple(column[keep] for column in truth[1:])
+        predictions = (renumber[predictions[0]],) + tuple(predictions[1:])
+        print(f'{len(unreadable)} unreadable images left out of the evaluation')
+    evaluator = DetectionEvaluator()
+    evaluator.add_arrays(*predictions, *truth, images=len(stems) - len(unreadable))
+    summary = evaluator.summary(names)
+    curves = evaluator.pr_curves(names)
+    matrix = evaluator.confusion_matrix(len(names))
+    scored = time.perf_counter()
+
+    print_summary(summary)
+    print(f'{len(predictions[0])} predictions loaded in {loaded - start:.2f}s, scored in {scored - loaded:.2f}s')
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+        with open(os.path.join(args.output, 'metrics.json'), 'w') as f:
+            json.dump({**summary, 'confusion_matrix': {'labels': names + ['background'], 'matrix': matrix.tolist()},
+                       'pr_curves': {str(name): precision.round(4).tolist() for name, (_, precision) in curves.items()}},
+                      f, indent=2)
+        if args.plots:
+            save_plots(args.output, curves, matrix, names)
+
+
+if __name__ == '__main__':
+    main()
+
+# python evaluate.py ppe_dataset/test --predictions ppe_predictions/labels --output eval/ppe --plots
+# python evaluate.py ppe_dataset/test --weights ppe_detection_int8.onnx --threads 4
+# python evaluate.py dataset/test --predictions test_two_stage.parquet --end_to_end --output eval/two_stage
+# python evaluate.py dataset/test --person_weights person_detection.onnx --ppe_weights ppe_detection.onnx
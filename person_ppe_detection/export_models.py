@@ -0,0 +1,47 @@
+import os
+import argparse
+
+from backends import export_model, quantize_onnx_int8, quantize_openvino_int8
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the YOLO models for CPU inference with ONNX Runtime or '
+                                                 'OpenVINO, optionally with static INT8 quantisation.')
+    parser.add_argument('weights', nargs='+', help='Weights to export, e.g. person_detection.pt ppe_detection.pt.')
+    parser.add_argument('--backend', choices=('onnx', 'openvino'), default='onnx', help='Export format.')
+    parser.add_argument('--imgsz', type=int, default=640, help='Export input size (default: 640).')
+    parser.add_argument('--static_batch', action='store_true',
+                        help='Export with a fixed batch size of 1 instead of a dynamic batch dimension.')
+    parser.add_argument('--int8', action='store_true', help='Also write an INT8 quantised copy of each model.')
+    parser.add_argument('--calibration_dirs', nargs='+', default=None,
+                        help='One directory of calibration images per weights file, in the same order '
+                             '(e.g. full frames for the person model, crop_images.py crops for the PPE model).')
+    parser.add_argument('--calibration_samples', type=int, default=300, help='Images sampled for calibration.')
+    parser.add_argument('--quantize_head', action='store_true',
+                        help='ONNX only: also quantise the detect head (faster, usually less accurate).')
+    args = parser.parse_args()
+
+    if args.int8 and (not args.calibration_dirs or len(args.calibration_dirs) != len(args.weights)):
+        parser.error('--int8 needs one --calibration_dirs entry per weights file')
+
+    for i, weights in enumerate(args.weights):
+        exported = export_model(weights, args.backend, args.imgsz, dynamic=not args.static_batch)
+        print(f'{weights} -> {exported}')
+        if not args.int8:
+            continue
+        if args.backend == 'onnx':
+            output = quantize_onnx_int8(exported, os.path.splitext(exported)[0] + '_int8.onnx',
+                                        args.calibration_dirs[i], args.imgsz, args.calibration_samples,
+                                        quantize_head=args.quantize_head)
+        else:
+            output = quantize_openvino_int8(exported, exported.rstrip('/\\') + '_int8', args.calibration_dirs[i],
+                                            args.imgsz, args.calibration_samples)
+        print(f'{weights} -> {output} (INT8)')
+
+
+if __name__ == '__main__':
+    main()
+
+# python export_models.py person_detection.pt ppe_detection.pt
+# python export_models.py person_detection.pt ppe_detection.pt --int8 --calibration_dirs datasets/images cropped/images
+# python export_models.py person_detection.pt ppe_detection.pt --backend openvino --int8 --calibration_dirs datasets/images cropped/images
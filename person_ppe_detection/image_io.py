@@ -0,0 +1,151 @@
+import io
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+# File extensions (lowercase) of the images every tool picks up from a directory
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+# cv2.imread flags per downscale factor. For JPEG, libjpeg scales the DCT blocks while decoding, so a
+# 1/2, 1/4 or 1/8 decode skips most of the full-resolution IDCT and colour conversion work and never
+# allocates the full-size image; other formats are decoded in full and then downsampled.
+REDUCED_COLOR = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4,
+                 8: cv2.IMREAD_REDUCED_COLOR_8}
+REDUCED_GRAYSCALE = {1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                     8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+# JPEG start-of-frame markers carry the image size (C4, C8 and CC are other segments)
+_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def read_image(path, scale=1, grayscale=False):
+    # cv2.imread at 1/scale of the full resolution (scale 1, 2, 4 or 8); None when the file can't be read
+    if scale not in REDUCED_COLOR:
+        raise ValueError(f'scale must be one of {sorted(REDUCED_COLOR)}, not {scale}')
+    return cv2.imread(path, (REDUCED_GRAYSCALE if grayscale else REDUCED_COLOR)[scale])
+
+
+def decode_image(data, scale=1, grayscale=False):
+    # read_image for encoded bytes (e.g. from a packed dataset)
+    if scale not in REDUCED_COLOR:
+        raise ValueError(f'scale must be one of {sorted(REDUCED_COLOR)}, not {scale}')
+    return cv2.imdecode(np.frombuffer(data, np.uint8), (REDUCED_GRAYSCALE if grayscale else REDUCED_COLOR)[scale])
+
+
+def _jpeg_size(f):
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        while marker[1] == 0xFF:  # fill bytes
+            marker = marker[1:] + f.read(1)
+        if marker[1] == 0x01 or 0xD0 <= marker[1] <= 0xD7:  # segments without a length
+            continue
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        if marker[1] in _SOF_MARKERS:
+            header = f.read(5)
+            if len(header) < 5:
+                return None
+            height, width = struct.unpack('>xHH', header)
+            return width, height
+        f.seek(struct.unpack('>H', length)[0] - 2, os.SEEK_CUR)
+
+
+def image_size(source):
+    # (width, height) of an image file or encoded bytes from the header only, as stored (before any EXIF
+    # rotation); (0, 0) when it can't be read. JPEG and PNG headers are parsed here, other formats by PIL.
+    try:
+        with (io.BytesIO(source) if isinstance(source, (bytes, bytearray, memoryview)) else open(source, 'rb')) as f:
+            head = f.read(24)
+            if head[:2] == b'\xff\xd8':
+                size = _jpeg_size(f)
+                if size is not None:
+                    return size
+            elif head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+                return struct.unpack('>II', head[16:24])
+            f.seek(0)
+            from PIL import Image
+            with Image.open(f) as img:
+                return img.size
+    except Exception:
+        return 0, 0
+
+
+class LRUCache:
+    # Values (arrays) by key, evicted least recently used first once their total nbytes exceeds max_bytes;
+    # values larger than max_bytes aren't kept. Safe to share between threads.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return self.items[key]
+            self.misses += 1
+        # Loaded outside the lock so decodes run in parallel; a key loaded twice at once is stored once
+        value = load(key)
+        if value is not None and self.max_bytes and value.nbytes <= self.max_bytes:
+            with self.lock:
+                if key not in self.items:
+                    self.items[key] = value
+                    self.bytes += value.nbytes
+                while self.bytes > self.max_bytes:
+                    _, evicted = self.items.popitem(last=False)
+                    self.bytes -= evicted.nbytes
+        return value
+
+    def resize(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            while self.items and self.bytes > max_bytes:
+                _, evicted = self.items.popitem(last=False)
+                self.bytes -= evicted.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.bytes = 0
+
+
+# Decoded images shared by everything running in this process (e.g. the stages of build.py in one worker)
+image_cache = LRUCache(512 << 20)
+
+
+def file_key(path, scale=1, grayscale=False):
+    # Identity of a file's current contents: hardlinked copies (as staged by staging.py) share it and a
+    # rewritten file gets a new one
+    st = os.stat(path)
+    return st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size, scale, grayscale
+
+
+def load_image(path, scale=1, grayscale=False, cache=image_cache):
+    # read_image through the shared cache. The returned array is read-only since other callers get the
+    # same one: copy it before drawing on it.
+    if cache is None:
+        return read_image(path, scale, grayscale)
+    try:
+        key = file_key(path, scale, grayscale)
+    except OSError:
+        return None
+
+    def load(_):
+        image = read_image(path, scale, grayscale)
+        if image is not None:
+            image.flags.writeable = False
+        return image
+
+    return cache.get(key, load)
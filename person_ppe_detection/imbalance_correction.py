@@ -1,9 +1,10 @@
 import os
 import matplotlib.pyplot as plt
-from collections import defaultdict
 import argparse
 import numpy as np
 
+from annotation_index import AnnotationIndex
+
 
 def load_class_names(classes_file):
     with open(classes_file, 'r') as file:
@@ -11,16 +12,11 @@ def load_class_names(classes_file):
 
 
 def count_annotations(annotations_dir, class_names):
-    class_counts = defaultdict(int)
-    for file_name in os.listdir(annotations_dir):
-        if file_name.endswith('.txt'):
-            with open(os.path.join(annotations_dir, file_name), 'r') as file:
-                for line in file:
-                    class_id = int(line.split()[0])
-                    class_counts[class_id] += 1
+    # Counts come from the cached annotation index, only changed label files are reparsed
+    counts = AnnotationIndex.load(annotations_dir).class_counts(len(class_names))
 
     # Include classes with 0 annotations
-    return {class_name: class_counts[id] for id, class_name in enumerate(class_names)}
+    return {class_name: int(counts[id]) for id, class_name in enumerate(class_names)}
 
 
 def plot_class_distribution(class_distribution, title, exclude_zero=False):
@@ -44,19 +40,21 @@ def plot_class_distribution(class_distribution, title, exclude_zero=False):
 
 def remove_low_annotation_classes(annotations_dir, class_distribution, threshold, class_names):
     classes_to_remove = {class_name for class_name, count in class_distribution.items() if count <= threshold}
-
-    for file_name in os.listdir(annotations_dir):
-        if file_name.endswith('.txt'):
-            file_path = os.path.join(annotations_dir, file_name)
-            with open(file_path, 'r') as file:
-                lines = file.readlines()
-
-            with open(file_path, 'w') as file:
-                for line in lines:
-                    class_id = int(line.split()[0])
-                    class_name = class_names[class_id]
-                    if class_name not in classes_to_remove:
-                        file.write(line)
+    class_ids_to_remove = {class_names.index(class_name) for class_name in classes_to_remove}
+
+    # Only rewrite the files that actually contain a removed class
+    index = AnnotationIndex.load(annotations_dir)
+    for file_name in index.files_with_classes(class_ids_to_remove):
+        file_path = os.path.join(annotations_dir, file_name)
+        with open(file_path, 'r') as file:
+            lines = file.readlines()
+
+        with open(file_path, 'w') as file:
+            for line in lines:
+                class_id = int(line.split()[0])
+                class_name = class_names[class_id]
+                if class_name not in classes_to_remove:
+                    file.write(line)
 
     return classes_to_remove
 
@@ -66,6 +64,9 @@ def main():
         description="Count, plot, and optionally remove low-annotation classes in YOLO annotation files.")
     parser.add_argument('annotations_dir', type=str, help="Directory containing YOLO annotation files")
     parser.add_argument('classes_file', type=str, help="File containing class names")
+    parser.add_argument('--remove_threshold', type=int, default=None,
+                        help="Remove classes with at most this many annotations without asking (-1: remove none)")
+    parser.add_argument('--no_plot', action='store_true', help="Don't show the class distribution plots")
 
     args = parser.parse_args()
 
@@ -76,21 +77,26 @@ def main():
     class_distribution = count_annotations(args.annotations_dir, class_names)
 
     # Plot class distribution including all classes
-    plot_class_distribution(class_distribution, title="Class Distribution (All Classes)", exclude_zero=False)
-
-    # Ask user if they want to remove low-annotation classes
-    remove_classes = input("Do you want to remove classes with low annotations? (yes/no): ").strip().lower()
-
-    if remove_classes == 'yes':
-        threshold = int(
-            input("Enter the threshold for removal (classes with annotations <= threshold will be removed): "))
+    if not args.no_plot:
+        plot_class_distribution(class_distribution, title="Class Distribution (All Classes)", exclude_zero=False)
+
+    # Ask user if they want to remove low-annotation classes, unless a threshold was given
+    threshold = args.remove_threshold
+    if threshold is None:
+        remove_classes = input("Do you want to remove classes with low annotations? (yes/no): ").strip().lower()
+        if remove_classes == 'yes':
+            threshold = int(
+                input("Enter the threshold for removal (classes with annotations <= threshold will be removed): "))
+
+    if threshold is not None and threshold >= 0:
         removed_classes = remove_low_annotation_classes(args.annotations_dir, class_distribution, threshold,
                                                         class_names)
         print(f"Removed annotations for classes with counts <= {threshold}: {', '.join(removed_classes)}")
 
         # Re-count annotations and plot distribution again
         class_distribution = count_annotations(args.annotations_dir, class_names)
-        plot_class_distribution(class_distribution, title="Class Distribution (After removal of low data classes)", exclude_zero=True)
+        if not args.no_plot:
+            plot_class_distribution(class_distribution, title="Class Distribution (After removal of low data classes)", exclude_zero=True)
     else:
         print("No classes were removed.")
 
@@ -100,4 +106,5 @@ if __name__ == "__main__":
 
 # python imbalance_correction.py yolo_labels classes.txt
 # python imbalance_correction.py augmented_data/all_labels classes.txt
-# python imbalance_correction.py augmented_data/cropped/labels cropped_classes.txt
\ No newline at end of file
+# python imbalance_correction.py augmented_data/cropped/labels cropped_classes.txt
+# python imbalance_correction.py augmented_data/cropped/labels cropped_classes.txt --remove_threshold 50 --no_plot
@@ -1,76 +1,112 @@
 import cv2
-from ultralytics import YOLO
 import os
 from pathlib import Path
 
-# Paths to model weights
+import numpy as np
+
+from render import PERSON_COLOR, draw_detections
+from two_stage import TwoStagePipeline
+from backends import load_detector
+from tiling import sliced_detector
+from sinks import open_sink, result_rows
+
+# Paths to model weights (.pt, or an .onnx / OpenVINO export from export_models.py for CPU inference)
 person_model_path = 'person_detection.pt'
 ppe_model_path = 'ppe_detection.pt'
+cpu_threads = None  # Threads per model, None for the runtime's default
 output_folder = 'inference'
 input_image_path = 'test/005268.jpg'
-
-
-# Load models
-person_model = YOLO(person_model_path)
-ppe_model = YOLO(ppe_model_path)
+max_batch_size = 32  # Maximum number of person crops per PPE forward pass
+server_url = None  # e.g. 'http://127.0.0.1:8765' to use the models of a running model_server.py
+tile_size = None  # e.g. 640 to detect persons on overlapping tiles of high resolution frames
+tile_overlap = 0.2  # Overlap between neighbouring tiles
+tile_full_frame = True  # Also run the person model on the whole frame to catch people larger than a tile
+save_crops = False  # Also write every person crop, before and after drawing its PPE, to output_folder
+cache_path = None  # e.g. 'detections.cache' to reuse person and PPE results for images and crops seen before
+results_path = None  # e.g. 'detections.jsonl' or 'detections.parquet' to append the detections to
+render_output = True  # Draw the detections and write original_with_persons.jpg
+compliance_rules = None  # e.g. 'site_rules.json' (see compliance.py) to report the required PPE each worker misses
+
+
+# Load models, or connect to the model server that already has them loaded
+if server_url:
+    from model_client import ModelClient
+    client = ModelClient(server_url)
+    pipeline = client.detect
+    ppe_names = client.ppe_names
+else:
+    person_detector = load_detector(person_model_path, threads=cpu_threads)
+    ppe_detector = load_detector(ppe_model_path, threads=cpu_threads)
+    if tile_size:
+        person_detector = sliced_detector(person_detector, tile_size, tile_overlap, tile_full_frame)
+    if cache_path:
+        from result_cache import ResultCache, cache_namespace, cached_detector
+        cache = ResultCache(cache_path)
+        person_detector = cached_detector(person_detector, cache,
+                                          cache_namespace(person_model_path, **person_detector.params))
+        # Keyed on the crop contents, so unchanged crops hit the cache even in a new frame
+        ppe_detector = cached_detector(ppe_detector, cache, cache_namespace(ppe_model_path, **ppe_detector.params))
+    pipeline = TwoStagePipeline(person_detector, ppe_detector, max_batch_size=max_batch_size)
+    ppe_names = ppe_detector.names
 
 # Ensure output folder exists
 Path(output_folder).mkdir(parents=True, exist_ok=True)
 
 # Load and preprocess the image
 image = cv2.imread(input_image_path)
-original_image = image.copy()
-
-# Perform inference using the person detection model
-results = person_model(image)
-results = results[0]  # The output is a list of results, get the first result
-
-# Extract bounding boxes
-person_bboxes = results.boxes.xyxy.cpu().numpy()  # (x1, y1, x2, y2)
-person_scores = results.boxes.conf.cpu().numpy()  # Confidence scores
-person_classes = results.boxes.cls.cpu().numpy().astype(int)  # Class IDs
-
-# For each detected person
-for i, bbox in enumerate(person_bboxes):
-    x1, y1, x2, y2 = bbox
-    conf = person_scores[i]
-    cls = person_classes[i]
-    person_image = original_image[int(y1):int(y2), int(x1):int(x2)]
-
-    # Save the cropped person image
-    person_image_path = os.path.join(output_folder, f'person_{i}.jpg')
-    cv2.imwrite(person_image_path, person_image)
-
-    # Perform PPE detection on the cropped person image
-    ppe_results = ppe_model(person_image)
-    ppe_results = ppe_results[0]  # The output is a list of results, get the first result
-
-    # Extract bounding boxes for PPE
-    ppe_bboxes = ppe_results.boxes.xyxy.cpu().numpy()  # (x1, y1, x2, y2)
-    ppe_scores = ppe_results.boxes.conf.cpu().numpy()  # Confidence scores
-    ppe_classes = ppe_results.boxes.cls.cpu().numpy().astype(int)  # Class IDs
-
-    # Draw bounding boxes and confidence scores on the cropped person image
-    for ppe_bbox in zip(ppe_bboxes, ppe_scores, ppe_classes):
-        bbox, score, class_id = ppe_bbox
-        x1, y1, x2, y2 = bbox
-        cv2.rectangle(person_image, (int(x1), int(y1)), (int(x2), int(y2)), (0, 255, 0), 2)
-        cv2.putText(person_image, f'{ppe_model.names[int(class_id)]} {score:.2f}', (int(x1), int(y1) - 10),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
-
-    # Save the output image with PPE detection results
-    output_person_image_path = os.path.join(output_folder, f'person_{i}_with_ppe.jpg')
-    cv2.imwrite(output_person_image_path, person_image)
-
-# Draw bounding boxes and confidence scores on the original image
-for bbox, conf, cls in zip(person_bboxes, person_scores, person_classes):
-    x1, y1, x2, y2 = bbox
-    cv2.rectangle(original_image, (int(x1), int(y1)), (int(x2), int(y2)), (255, 0, 0), 2)
-    cv2.putText(original_image, f'Person {conf:.2f}', (int(x1), int(y1) - 10),
-                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 0), 2)
-
-# Save the original image with person detection results
-output_original_image_path = os.path.join(output_folder, 'original_with_persons.jpg')
-cv2.imwrite(output_original_image_path, original_image)
-
-print("Inference complete. Results saved in:", output_folder)
\ No newline at end of file
+
+# Person detection on the full frame, then one batched PPE pass over all person crops
+result = pipeline(image)
+original_image = image  # detection is done, draw on the frame itself
+
+# Record the detections (one row per box, PPE linked to its person) for analytics without the images
+if results_path:
+    sink = open_sink(results_path)
+    sink.write(result_rows(os.path.basename(input_image_path), image.shape, result, ppe_names))
+    sink.close()
+
+# Which PPE item belongs to whom, and who misses what the rules require
+if compliance_rules:
+    from compliance import ComplianceEngine, ComplianceRules, frame_detections, load_class_names
+    engine = ComplianceEngine(ComplianceRules.load(compliance_rules, load_class_names('cropped_classes.txt')))
+    for line in engine.describe(engine.evaluate(*frame_detections(result))) or ['All workers compliant']:
+        print(line)
+
+if render_output:
+    person_bboxes = result.persons.boxes  # (x1, y1, x2, y2)
+    person_scores = result.persons.scores  # Confidence scores
+    person_classes = result.persons.classes  # Class IDs
+
+    # For each detected person
+    for i, person in enumerate(result.people):
+        x1, y1, x2, y2 = person.crop_box
+        if x2 <= x1 or y2 <= y1:
+            continue
+        person_image = original_image[y1:y2, x1:x2]  # a view: PPE drawn on it shows on the full frame too
+
+        # Save the cropped person image
+        if save_crops:
+            person_image_path = os.path.join(output_folder, f'person_{i}.jpg')
+            cv2.imwrite(person_image_path, person_image)
+
+        # Draw bounding boxes and confidence scores on the cropped person image
+        draw_detections(person_image, person.ppe.boxes, person.ppe.classes, ppe_names, person.ppe.scores)
+
+        # Save the output image with PPE detection results
+        if save_crops:
+            output_person_image_path = os.path.join(output_folder, f'person_{i}_with_ppe.jpg')
+            cv2.imwrite(output_person_image_path, person_image)
+
+    # Draw bounding boxes and confidence scores on the original image
+    draw_detections(original_image, person_bboxes, np.zeros(len(person_classes), int), ['Person'], person_scores,
+                    PERSON_COLOR)
+
+    # Save the original image with person detection results
+    output_original_image_path = os.path.join(output_folder, 'original_with_persons.jpg')
+    cv2.imwrite(output_original_image_path, original_image)
+
+if cache_path and not server_url:
+    stats = cache.stats()
+    print(f"Result cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%})")
+
+print("Inference complete. Results saved in:", output_folder)
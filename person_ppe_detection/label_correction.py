@@ -2,6 +2,10 @@
 import os
 import argparse
 
+import numpy as np
+
+from annotation_index import AnnotationIndex
+
 
 def load_classes(class_file):
     with open(class_file, 'r') as f:
@@ -19,22 +23,20 @@ def main(label_dir, valid_class_name, classes, output_dir):
         print(f"Class name '{valid_class_name}' not found in classes file.")
         return
 
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    for label_file in os.listdir(label_dir):
-        file_path = os.path.join(label_dir, label_file)
-        output_path = os.path.join(output_dir, label_file)
-
-        with open(file_path, 'r') as f:
-            lines = f.readlines()
-        with open(output_path, 'w') as f:
-            for line in lines:
-                parts = line.strip().split()
-                if parts[0] == valid_class_index:
-                    # Replace class index with class name
-                    #parts[0] = valid_class_name
-                    f.write(" ".join(parts) + "\n")
+    # The original lines of the kept class are written unchanged. The cached annotation index tells which
+    # files have none (and no malformed lines that might), so those are written empty without being read.
+    os.makedirs(output_dir, exist_ok=True)
+    index = AnnotationIndex.load(label_dir)
+    has_class = np.zeros(index.num_files, dtype=bool)
+    has_class[index.image_ids[index.class_ids == int(valid_class_index)]] = True
+    for name, keep, bad_lines in zip(index.names.tolist(), has_class.tolist(), index.bad_lines.tolist()):
+        lines = []
+        if keep or bad_lines:
+            with open(os.path.join(label_dir, name), 'r') as f:
+                lines = [line if line.endswith('\n') else line + '\n' for line in f
+                         if line.split()[:1] == [valid_class_index]]
+        with open(os.path.join(output_dir, name), 'w') as f:
+            f.writelines(lines)
 
 
 if __name__ == "__main__":
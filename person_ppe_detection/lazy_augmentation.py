@@ -0,0 +1,202 @@
+import os
+import argparse
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from annotation_index import AnnotationIndex, parse_label_file
+from data_augmentation import select_target_classes
+from image_io import IMAGE_EXTENSIONS, LRUCache
+
+# An augmented sample: where it comes from and the transforms to apply, in order.
+# Each transform is a (name, params) tuple, e.g. ('hflip', None), ('scale', 0.8),
+# ('brightness', 20.0) or ('mosaic', [(image_path, label_path), ...]) for the other three tiles.
+Recipe = namedtuple('Recipe', ['image_path', 'label_path', 'transforms'])
+
+
+def load_labels(label_path):
+    # (N, 5) float32 array of class_id, x_center, y_center, width, height
+    if not os.path.exists(label_path):
+        return np.zeros((0, 5), dtype=np.float32)
+    class_ids, boxes, _ = parse_label_file(label_path)
+    return np.column_stack([class_ids.astype(np.float32), boxes])
+
+
+def hflip(image, labels):
+    labels = labels.copy()
+    labels[:, 1] = 1.0 - labels[:, 1]
+    return cv2.flip(image, 1), labels
+
+
+def scale(image, labels, factor):
+    # Labels are normalised, so resizing the whole image leaves them unchanged
+    h, w = image.shape[:2]
+    size = (max(int(round(w * factor)), 1), max(int(round(h * factor)), 1))
+    return cv2.resize(image, size, interpolation=cv2.INTER_LINEAR), labels
+
+
+def brightness(image, labels, delta):
+    # Saturating shift: a negative delta clips dark pixels to 0
+    return np.clip(image.astype(np.int16) + int(round(delta)), 0, 255).astype(np.uint8), labels
+
+
+def mosaic(tiles):
+    # 2x2 grid of (image, labels) tiles, each resized to half of the first tile's size
+    h, w = tiles[0][0].shape[:2]
+    th, tw = max(h // 2, 1), max(w // 2, 1)
+    out = np.zeros((th * 2, tw * 2, 3), dtype=np.uint8)
+    all_labels = []
+    for k, (image, labels) in enumerate(tiles[:4]):
+        row, col = divmod(k, 2)
+        out[row * th:(row + 1) * th, col * tw:(col + 1) * tw] = cv2.resize(image, (tw, th))
+        labels = labels.copy()
+        labels[:, 1] = (labels[:, 1] + col) / 2
+        labels[:, 2] = (labels[:, 2] + row) / 2
+        labels[:, 3:] /= 2
+        all_labels.append(labels)
+    return out, np.concatenate(all_labels)
+
+
+class LazyAugmentedDataset:
+    # Dataset of recipes that are only decoded and transformed when a sample is read. Instead of
+    # writing flipped copies of every file containing a minority class, those files get a higher
+    # sampling weight (`boost`) and every sample draws a random transform chain from a seeded RNG.
+    def __init__(self, labels_dir, images_dir, ratio_threshold=0.5, target_class_ids=None, boost=2.0,
+                 hflip_prob=0.5, scale_range=(1.0, 1.0), brightness_range=(0.0, 0.0), mosaic_prob=0.0,
+                 seed=0, cache_bytes=512 << 20):
+        self.labels_dir = labels_dir
+        self.images_dir = images_dir
+        self.hflip_prob = hflip_prob
+        self.scale_range = scale_range
+        self.brightness_range = brightness_range
+        self.mosaic_prob = mosaic_prob
+        self.seed = seed
+        self.cache = LRUCache(cache_bytes)
+
+        images = {os.path.splitext(f)[0]: f for f in os.listdir(images_dir)
+                  if f.lower().endswith(IMAGE_EXTENSIONS)}
+        self.index = AnnotationIndex.load(labels_dir)
+        stems = [os.path.splitext(name)[0] for name in self.index.names.tolist()]
+        has_image = np.array([stem in images for stem in stems], dtype=bool)
+        self.sources = [(os.path.join(images_dir, images[stem]), os.path.join(labels_dir, stem + '.txt'))
+                        for stem, ok in zip(stems, has_image) if ok]
+
+        # Same minority-class selection as data_augmentation.py, turned into per-file weights
+        counts = self.index.class_counts()
+        if target_class_ids is None:
+            total_class_counts = {class_id: int(count) for class_id, count in enumerate(counts) if count}
+            target_class_ids = set()
+            if total_class_counts:
+                _, target_class_ids = select_target_classes(total_class_counts, ratio_threshold)
+        self.target_class_ids = set(target_class_ids)
+        file_counts = self.index.file_class_counts(len(counts))
+        targets = sorted(c for c in self.target_class_ids if c < file_counts.shape[1])
+        has_target = file_counts[:, targets].sum(axis=1) > 0 if targets else np.zeros(self.index.num_files, bool)
+        self.weights = np.where(has_target, boost, 1.0)[has_image]
+
+        self.set_epoch(0)
+
+    def __len__(self):
+        return len(self.plan)
+
+    def set_epoch(self, epoch):
+        # Draw this epoch's samples and their transform chains; the same seed and epoch give the same plan
+        rng = np.random.default_rng((self.seed, epoch))
+        num_samples = int(round(self.weights.sum()))
+        if not len(self.sources):
+            self.plan = []
+            return
+        picks = rng.choice(len(self.sources), size=num_samples, p=self.weights / self.weights.sum())
+        self.plan = [self.make_recipe(int(i), rng) for i in picks]
+
+    def make_recipe(self, source, rng):
+        image_path, label_path = self.sources[source]
+        transforms = []
+        if self.mosaic_prob and rng.random() < self.mosaic_prob:
+            others = rng.choice(len(self.sources), size=3)
+            transforms.append(('mosaic', [self.sources[int(i)] for i in others]))
+        if rng.random() < self.hflip_prob:
+            transforms.append(('hflip', None))
+        if self.scale_range[0] != self.scale_range[1] or self.scale_range[0] != 1.0:
+            transforms.append(('scale', float(rng.uniform(*self.scale_range))))
+        if self.brightness_range[0] != self.brightness_range[1] or self.brightness_range[0] != 0.0:
+            transforms.append(('brightness', float(rng.uniform(*self.brightness_range))))
+        return Recipe(image_path, label_path, tuple(transforms))
+
+    def load_source(self, image_path, label_path):
+        image = self.cache.get(image_path, cv2.imread)
+        if image is None:
+            raise IOError(f"Could not read image {image_path}")
+        return image, load_labels(label_path)
+
+    def apply(self, recipe):
+        image, labels = self.load_source(recipe.image_path, recipe.label_path)
+        for name, params in recipe.transforms:
+            if name == 'mosaic':
+                image, labels = mosaic([(image, labels)] + [self.load_source(*source) for source in params])
+            elif name == 'hflip':
+                image, labels = hflip(image, labels)
+            elif name == 'scale':
+                image, labels = scale(image, labels, params)
+            elif name == 'brightness':
+                image, labels = brightness(image, labels, params)
+            else:
+                raise ValueError(f"Unknown transform '{name}'")
+        return image, labels
+
+    def __getitem__(self, i):
+        return self.apply(self.plan[i])
+
+    def effective_class_counts(self):
+        # Expected boxes per class in one epoch, given the sampling weights
+        counts = self.index.file_class_counts()
+        names = {os.path.join(self.labels_dir, name): i for i, name in enumerate(self.index.names.tolist())}
+        rows = [names[label_path] for _, label_path in self.sources]
+        expected = self.weights / self.weights.sum() * len(self.plan)
+        return (counts[rows] * expected[:, None]).sum(axis=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Preview lazy, on-the-fly augmentation for YOLO datasets.")
+    parser.add_argument("labels_dir", type=str, help="Directory containing YOLO label files.")
+    parser.add_argument("images_dir", type=str, help="Directory containing image files.")
+    parser.add_argument("classes_file", type=str, help="File containing class names.")
+    parser.add_argument("--ratio_threshold", type=float, default=0.5,
+                        help="Ratio threshold to select classes with extremely low data (default: 0.5).")
+    parser.add_argument("--boost", type=float, default=2.0, help="Sampling weight of files with minority classes.")
+    parser.add_argument("--mosaic_prob", type=float, default=0.0, help="Probability of a 2x2 mosaic sample.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    parser.add_argument("--preview_dir", type=str, default=None, help="Write a few augmented samples here.")
+    parser.add_argument("--num_preview", type=int, default=16, help="Number of samples to preview.")
+    args = parser.parse_args()
+
+    with open(args.classes_file, 'r') as file:
+        class_names = [line.strip() for line in file.readlines()]
+
+    dataset = LazyAugmentedDataset(args.labels_dir, args.images_dir, args.ratio_threshold, boost=args.boost,
+                                   scale_range=(0.8, 1.2), brightness_range=(-30, 30), mosaic_prob=args.mosaic_prob,
+                                   seed=args.seed)
+    print(f"Classes oversampled: {[class_names[i] for i in sorted(dataset.target_class_ids)]}")
+    print(f"{len(dataset.sources)} source images, {len(dataset)} samples per epoch")
+    for class_name, raw, expected in zip(class_names, dataset.index.class_counts(len(class_names)),
+                                         dataset.effective_class_counts()):
+        print(f"  {class_name}: {raw} annotations, ~{expected:.0f} per epoch")
+
+    if args.preview_dir:
+        os.makedirs(args.preview_dir, exist_ok=True)
+        for i in range(min(args.num_preview, len(dataset))):
+            image, labels = dataset[i]
+            name = f"sample_{i:04d}"
+            cv2.imwrite(os.path.join(args.preview_dir, name + '.jpg'), image)
+            with open(os.path.join(args.preview_dir, name + '.txt'), 'w') as f:
+                for class_id, x, y, w, h in labels:
+                    f.write(f"{int(class_id)} {x:.6f} {y:.6f} {w:.6f} {h:.6f}\n")
+        print(f"Preview samples saved to {args.preview_dir}")
+
+
+if __name__ == "__main__":
+    main()
+
+# python lazy_augmentation.py yolo_labels images classes.txt --preview_dir augmentation_preview
+# python lazy_augmentation.py augmented_data/cropped/labels augmented_data/cropped/images cropped_classes.txt --mosaic_prob 0.2
@@ -0,0 +1,144 @@
+import json
+import socket
+import argparse
+import http.client
+from urllib.parse import urlparse
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from two_stage import detections_from_dict, result_from_dict
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=30):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class ModelClient:
+    # Client for model_server.py. Images can be sent as encoded bytes (a file's contents are sent as-is,
+    # arrays are PNG/JPEG encoded) or, on the same host, through a shared memory block with no encoding.
+    def __init__(self, url='http://127.0.0.1:8765', unix_socket=None, timeout=30, use_shared_memory=False,
+                 encode_ext='.jpg'):
+        self.url = urlparse(url)
+        self.unix_socket = unix_socket
+        self.timeout = timeout
+        self.use_shared_memory = use_shared_memory
+        self.encode_ext = encode_ext
+        self.last_timing = None
+        self._conn = None
+        info = self._request('GET', '/health')
+        self.person_names = {int(k): v for k, v in info['person_names'].items()}
+        self.ppe_names = {int(k): v for k, v in info['ppe_names'].items()}
+
+    def _connection(self):
+        if self._conn is None:
+            if self.unix_socket:
+                self._conn = UnixHTTPConnection(self.unix_socket, self.timeout)
+            else:
+                self._conn = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=self.timeout)
+        return self._conn
+
+    def _request(self, method, path, body=None, content_type=None):
+        headers = {'Content-Type': content_type} if content_type else {}
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                payload = json.loads(response.read())
+                break
+            except (ConnectionError, http.client.HTTPException):
+                # The keep-alive connection was dropped by the server, reconnect once
+                conn.close()
+                self._conn = None
+                if attempt:
+                    raise
+        if response.status != 200:
+            raise RuntimeError(f"Model server error {response.status}: {payload.get('error')}")
+        self.last_timing = payload.get('timing')
+        return payload
+
+    def _post_image(self, path, image):
+        if isinstance(image, (bytes, bytearray)):
+            return self._request('POST', path, bytes(image), 'application/octet-stream')
+        image = np.ascontiguousarray(image)
+        if not self.use_shared_memory:
+            ok, encoded = cv2.imencode(self.encode_ext, image)
+            if not ok:
+                raise ValueError('could not encode image')
+            return self._request('POST', path, encoded.tobytes(), 'application/octet-stream')
+
+        shm = shared_memory.SharedMemory(create=True, size=max(image.nbytes, 1))
+        try:
+            np.ndarray(image.shape, dtype=image.dtype, buffer=shm.buf)[...] = image
+            body = json.dumps({'shm': shm.name, 'shape': list(image.shape), 'dtype': image.dtype.str})
+            return self._request('POST', path, body.encode(), 'application/json')
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def detect(self, image):
+        # Person + PPE detection, returns a two_stage.FrameResult
+        return result_from_dict(self._post_image('/detect', image))
+
+    def detect_file(self, path):
+        # Send the encoded file as-is: no decode on the client side
+        with open(path, 'rb') as f:
+            return self.detect(f.read())
+
+    def detect_persons(self, image):
+        return detections_from_dict(self._post_image('/detect/person', image)['persons'])
+
+    def detect_ppe(self, image):
+        return detections_from_dict(self._post_image('/detect/ppe', image)['ppe'])
+
+    def detector(self, stage='person'):
+        # A detector callable (list of images -> list of Detections) backed by the server,
+        # usable wherever a local yolo_detector is expected
+        detect_one = self.detect_persons if stage == 'person' else self.detect_ppe
+
+        def detect(images):
+            return [detect_one(image) for image in images]
+
+        detect.names = self.person_names if stage == 'person' else self.ppe_names
+        return detect
+
+    def stats(self):
+        return self._request('GET', '/stats')
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Send images to a running model_server.py.')
+    parser.add_argument('images', nargs='+', help='Image files to detect.')
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8765', help='Server url.')
+    parser.add_argument('--unix_socket', type=str, default=None, help='Server Unix socket.')
+    args = parser.parse_args()
+
+    client = ModelClient(args.url, args.unix_socket)
+    for path in args.images:
+        result = client.detect_file(path)
+        ppe_count = sum(len(person.ppe.scores) for person in result.people)
+        timing = client.last_timing
+        print(f"{path}: {len(result.persons.scores)} persons, {ppe_count} PPE items "
+              f"(queue {timing['queue_ms']:.1f} ms, inference {timing['inference_ms']:.1f} ms)")
+    print(client.stats())
+
+
+if __name__ == '__main__':
+    main()
+
+# python model_client.py test/005268.jpg
+# python model_client.py --unix_socket /tmp/ppe_models.sock inference_on_sample_test_set/*.jpg
@@ -0,0 +1,297 @@
+import os
+import json
+import time
+import queue
+import asyncio
+import argparse
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingUnixStreamServer
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from two_stage import TwoStagePipeline, StubDetector, detections_to_dict, result_to_dict
+
+def attach_shared_array(name, shape, dtype='uint8'):
+    # Attach to a shared memory block created by a client. The block belongs to the client: we must
+    # not let this process' resource tracker unlink it when we exit.
+    try:
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13
+        shm = shared_memory.SharedMemory(name=name)
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm, np.ndarray(tuple(shape), dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+class InferenceWorker:
+    # The models live on a single thread; request handlers queue jobs and wait for their futures.
+    # Time spent waiting in the queue is reported separately from inference time.
+    def __init__(self, pipeline, ppe_names):
+        self.pipeline = pipeline
+        self.ppe_names = ppe_names
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.queue_time = 0.0
+        self.inference_time = 0.0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def warmup(self, size=640, runs=2):
+        frame = np.zeros((size, size, 3), dtype=np.uint8)
+        for _ in range(runs):
+            self.submit('two_stage', frame).result()
+
+    def submit(self, stage, image):
+        future = Future()
+        self.jobs.put((stage, image, time.perf_counter(), future))
+        return future
+
+    def run_stage(self, stage, image):
+        if stage == 'person':
+            return {'persons': detections_to_dict(self.pipeline.detect_persons(image))}
+        if stage == 'ppe':
+            return {'ppe': detections_to_dict(self.pipeline.detect_ppe([image])[0], self.ppe_names)}
+        return result_to_dict(self.pipeline(image), self.ppe_names)
+
+    def _run(self):
+        while True:
+            stage, image, queued, future = self.jobs.get()
+            started = time.perf_counter()
+            try:
+                response = self.run_stage(stage, image)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            finally:
+                del image  # may be a view of a client's shared memory block
+            finished = time.perf_counter()
+            response['timing'] = {'queue_ms': (started - queued) * 1000, 'inference_ms': (finished - started) * 1000}
+            with self.lock:
+                self.requests += 1
+                self.queue_time += started - queued
+                self.inference_time += finished - started
+            future.set_result(response)
+
+    def stats(self):
+        with self.lock:
+            n = max(self.requests, 1)
+            return {'requests': self.requests, 'queued': self.jobs.qsize(),
+                    'mean_queue_ms': self.queue_time / n * 1000, 'mean_inference_ms': self.inference_time / n * 1000}
+
+
+class BatchedInferenceWorker(InferenceWorker):
+    # The models sit behind a batch_scheduler.TwoStageScheduler running on its own event loop thread:
+    # concurrent requests are batched for the person model, and their person crops for the PPE model.
+    # Batches mix requests, so queue_ms is estimated as the latency beyond the mean batch time.
+    def __init__(self, pipeline, ppe_names, max_wait=0.005, ppe_max_wait=0.002, max_batch_size=16):
+        from batch_scheduler import TwoStageScheduler
+        self.pipeline = pipeline
+        self.ppe_names = ppe_names
+        self.scheduler = TwoStageScheduler(pipeline.person_detector, pipeline.ppe_detector, pipeline.imgsz,
+                                           max_batch_size, pipeline.max_batch_size, max_wait, ppe_max_wait)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.queue_time = 0.0
+        self.inference_time = 0.0
+        self.in_flight = 0
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+
+    async def _start(self):
+        self.scheduler.start()
+
+    def submit(self, stage, image):
+        with self.lock:
+            self.in_flight += 1
+        return asyncio.run_coroutine_threadsafe(self._serve(stage, image, time.perf_counter()), self.loop)
+
+    async def _serve(self, stage, image, queued):
+        try:
+            if stage == 'person':
+                response = {'persons': detections_to_dict(await self.scheduler.detect_persons(image))}
+            elif stage == 'ppe':
+                response = {'ppe': detections_to_dict((await self.scheduler.detect_ppe([image]))[0], self.ppe_names)}
+            else:
+                response = result_to_dict(await self.scheduler.detect(image), self.ppe_names)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        latency = time.perf_counter() - queued
+        inference = 0.0
+        for batcher in ((self.scheduler.person,) if stage == 'person' else (self.scheduler.ppe,) if stage == 'ppe'
+                        else (self.scheduler.person, self.scheduler.ppe)):
+            inference += batcher.metrics.busy / max(len(batcher.metrics.batch_sizes), 1)
+        inference = min(inference, latency)
+        response['timing'] = {'queue_ms': (latency - inference) * 1000, 'inference_ms': inference * 1000}
+        with self.lock:
+            self.requests += 1
+            self.queue_time += latency - inference
+            self.inference_time += inference
+        return response
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.scheduler.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def stats(self):
+        with self.lock:
+            n = max(self.requests, 1)
+            stats = {'requests': self.requests, 'queued': self.in_flight,
+                     'mean_queue_ms': self.queue_time / n * 1000, 'mean_inference_ms': self.inference_time / n * 1000}
+        stats['batching'] = self.scheduler.metrics()
+        return stats
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    # POST /detect, /detect/person or /detect/ppe with either an encoded image as the body, or a JSON
+    # body {"shm": name, "shape": [h, w, 3], "dtype": "uint8"} referring to a shared memory block
+    server_version = 'PPEModelServer/1.0'
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'status': 'ok', 'person_names': self.server.person_names,
+                                 'ppe_names': self.server.ppe_names})
+        elif self.path == '/stats':
+            self.send_json(200, self.server.worker.stats())
+        else:
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+
+    def do_POST(self):
+        stage = {'/detect': 'two_stage', '/detect/person': 'person', '/detect/ppe': 'ppe'}.get(self.path)
+        if stage is None:
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+            return
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        shm = None
+        try:
+            start = time.perf_counter()
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                request = json.loads(body)
+                shm, image = attach_shared_array(request['shm'], request['shape'], request.get('dtype', 'uint8'))
+            else:
+                image = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)
+                if image is None:
+                    raise ValueError('could not decode image')
+            decode_ms = (time.perf_counter() - start) * 1000
+            response = self.server.worker.submit(stage, image).result()
+            response['timing']['decode_ms'] = decode_ms
+        except (ValueError, KeyError, FileNotFoundError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self.send_json(500, {'error': f'{type(e).__name__}: {e}'})
+            return
+        finally:
+            if shm is not None:
+                image = None
+                shm.close()
+        self.send_json(200, response)
+
+
+class _ServerMixin:
+    def setup_models(self, worker, person_names, ppe_names, verbose=False):
+        self.worker = worker
+        self.person_names = {int(k): v for k, v in dict(person_names).items()}
+        self.ppe_names = {int(k): v for k, v in dict(ppe_names).items()}
+        self.verbose = verbose
+
+
+class HTTPModelServer(_ServerMixin, ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class UnixModelServer(_ServerMixin, ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(pipeline, person_names, ppe_names, host='127.0.0.1', port=8765, unix_socket=None, warmup=True,
+                verbose=False, batch_wait=None):
+    # With a batch_wait (seconds) concurrent requests are micro-batched, otherwise they run one at a time
+    worker = (InferenceWorker(pipeline, ppe_names) if batch_wait is None else
+              BatchedInferenceWorker(pipeline, ppe_names, batch_wait, min(batch_wait, 0.002)))
+    if warmup:
+        worker.warmup(pipeline.imgsz)
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixModelServer(unix_socket, RequestHandler)
+    else:
+        server = HTTPModelServer((host, port), RequestHandler)
+    server.setup_models(worker, person_names, ppe_names, verbose)
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the person and PPE models from a long-lived process.')
+    parser.add_argument('--person_weights', type=str, default='person_detection.pt',
+                        help='Person model: .pt weights, .onnx file or OpenVINO model directory.')
+    parser.add_argument('--ppe_weights', type=str, default='ppe_detection.pt',
+                        help='PPE model: .pt weights, .onnx file or OpenVINO model directory.')
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads per model (default: runtime default).')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='HTTP host (default: 127.0.0.1).')
+    parser.add_argument('--port', type=int, default=8765, help='HTTP port (default: 8765).')
+    parser.add_argument('--unix_socket', type=str, default=None, help='Serve on a Unix socket instead of TCP.')
+    parser.add_argument('--max_batch_size', type=int, default=32, help='Maximum person crops per PPE pass.')
+    parser.add_argument('--batch_wait_ms', type=float, default=None,
+                        help='Micro-batch concurrent requests (batch_scheduler.py), waiting at most this long '
+                             'to fill a batch (default: no batching across requests).')
+    parser.add_argument('--stub', action='store_true', help='Serve stub detectors (no weights needed).')
+    parser.add_argument('--verbose', action='store_true', help='Log every request.')
+    args = parser.parse_args()
+
+    if args.stub:
+        person_detector = StubDetector(boxes_per_image=3, names={0: 'person'})
+        ppe_detector = StubDetector(boxes_per_image=2, num_classes=9)
+    else:
+        from backends import load_detector
+        person_detector = load_detector(args.person_weights, threads=args.threads)
+        ppe_detector = load_detector(args.ppe_weights, threads=args.threads)
+    pipeline = TwoStagePipeline(person_detector, ppe_detector, max_batch_size=args.max_batch_size)
+
+    server = make_server(pipeline, person_detector.names, ppe_detector.names, args.host, args.port,
+                         args.unix_socket, verbose=args.verbose,
+                         batch_wait=None if args.batch_wait_ms is None else args.batch_wait_ms / 1000)
+    print(f"Models loaded, serving on {args.unix_socket or f'http://{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if isinstance(server.worker, BatchedInferenceWorker):
+            server.worker.close()
+        if args.unix_socket and os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+
+
+if __name__ == '__main__':
+    main()
+
+# python model_server.py
+# python model_server.py --unix_socket /tmp/ppe_models.sock
+# python model_server.py --stub --port 8766
+# python model_server.py --batch_wait_ms 5
+# python model_server.py --person_weights person_detection_int8.onnx --ppe_weights ppe_detection_int8.onnx --threads 4
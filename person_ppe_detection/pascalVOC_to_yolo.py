@@ -1,64 +1,190 @@
+import io
 import os
-import xml.etree.ElementTree as ET
+import tarfile
+import zipfile
 import argparse
-
-
-def convert_voc_to_yolo(input_dir, output_dir):
-    classes_path = os.path.join(input_dir, "classes.txt") # path to classes file
+from collections import Counter, deque
+from multiprocessing import Pool
+
+try:
+    from lxml.etree import iterparse  # faster C parser when available
+except ImportError:
+    from xml.etree.ElementTree import iterparse
+
+BOUNDS_MODES = ('clip', 'flag', 'drop')
+
+
+def parse_voc(source):
+    # Stream one PascalVOC file: returns (width, height, [(class_name, xmin, ymin, xmax, ymax), ...])
+    width = height = None
+    objects = []
+    path = []
+    name, box = None, {}
+    for event, elem in iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            path.append(elem.tag)
+            continue
+        parent = path[-2] if len(path) > 1 else None
+        if parent == 'size' and elem.tag in ('width', 'height'):
+            if elem.tag == 'width':
+                width = int(float(elem.text))
+            else:
+                height = int(float(elem.text))
+        elif parent == 'object' and elem.tag == 'name':
+            name = elem.text.strip()
+        elif parent == 'bndbox' and len(path) > 2 and path[-3] == 'object':
+            box[elem.tag] = int(float(elem.text))
+        elif elem.tag == 'object':
+            objects.append((name, box.get('xmin'), box.get('ymin'), box.get('xmax'), box.get('ymax')))
+            name, box = None, {}
+            elem.clear()
+        path.pop()
+    return width, height, objects
+
+
+def convert_annotation(source, class_ids, bounds='clip'):
+    # Returns (yolo_lines, stats) for one VOC annotation
+    stats = Counter(files=1)
+    width, height, objects = parse_voc(source)
+    yolo_annotations = []
+    for class_name, xmin, ymin, xmax, ymax in objects:
+        stats['objects'] += 1
+        class_id = class_ids.get(class_name)
+        if class_id is None:
+            stats[f'unknown_class:{class_name}'] += 1
+            continue
+
+        if xmin < 0 or ymin < 0 or xmax > width or ymax > height or xmax <= xmin or ymax <= ymin:
+            stats['out_of_bounds'] += 1
+            if bounds == 'drop':
+                continue
+            if bounds == 'clip':
+                xmin, ymin = max(xmin, 0), max(ymin, 0)
+                xmax, ymax = min(xmax, width), min(ymax, height)
+                if xmax <= xmin or ymax <= ymin:
+                    stats['dropped_empty'] += 1
+                    continue
+                stats['clipped'] += 1
+
+        # convert to YOLO format
+        x_center = (xmin + xmax) / 2.0 / width
+        y_center = (ymin + ymax) / 2.0 / height
+        box_width = (xmax - xmin) / width
+        box_height = (ymax - ymin) / height
+
+        yolo_annotations.append(f"{class_id} {x_center} {y_center} {box_width} {box_height}")
+        stats['boxes'] += 1
+    return yolo_annotations, stats
+
+
+def convert_batch(args):
+    # Worker: convert a batch of (label_name, path_or_bytes) and hand the texts back for writing
+    batch, class_ids, bounds = args
+    outputs = []
+    stats = Counter()
+    for label_name, data in batch:
+        source = io.BytesIO(data) if isinstance(data, bytes) else data
+        try:
+            yolo_annotations, file_stats = convert_annotation(source, class_ids, bounds)
+        except Exception as e:
+            stats['errors'] += 1
+            stats[f'error:{label_name}:{type(e).__name__}'] += 1
+            continue
+        stats.update(file_stats)
+        outputs.append((os.path.splitext(os.path.basename(label_name))[0] + '.txt', "\n".join(yolo_annotations)))
+    return outputs, stats
+
+
+def iter_sources(input_path):
+    # (name, path or bytes) for every XML file in a directory (labels/ subfolder) or a tar/zip archive,
+    # archives are streamed without being extracted to disk
+    if os.path.isdir(input_path):
+        labels_dir = os.path.join(input_path, "labels")     # Path to labels
+        for label_file in sorted(os.listdir(labels_dir)):
+            if label_file.endswith(".xml"):
+                yield label_file, os.path.join(labels_dir, label_file)
+    elif zipfile.is_zipfile(input_path):
+        with zipfile.ZipFile(input_path) as archive:
+            for info in archive.infolist():
+                if info.filename.endswith('.xml') and not info.is_dir():
+                    yield info.filename, archive.read(info)
+    else:
+        with tarfile.open(input_path, 'r:*') as archive:
+            for member in archive:
+                if member.isfile() and member.name.endswith('.xml'):
+                    yield member.name, archive.extractfile(member).read()
+
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def convert_voc_to_yolo(input_dir, output_dir, classes_path=None, workers=None, batch_size=256, bounds='clip'):
+    classes_path = classes_path or os.path.join(input_dir, "classes.txt") # path to classes file
 
     with open(classes_path, "r") as f:
         class_names = f.read().strip().splitlines()
+    class_ids = {name: i for i, name in enumerate(class_names)}
 
     os.makedirs(output_dir, exist_ok=True)
 
-    labels_dir = os.path.join(input_dir, "labels")     # Path to labels
+    stats = Counter()
 
-    for label_file in os.listdir(labels_dir):
-        if label_file.endswith(".xml"):
-            tree = ET.parse(os.path.join(labels_dir, label_file))
-            root = tree.getroot()
+    def write(result):
+        outputs, batch_stats = result
+        stats.update(batch_stats)
+        for output_name, text in outputs:  # Write the YOLO annotations to the output file
+            with open(os.path.join(output_dir, output_name), "w") as f:
+                f.write(text)
 
-            size = root.find("size") # get image dimensions
-            width = int(size.find("width").text)
-            height = int(size.find("height").text)
-
-            yolo_annotations = []
-
-            for obj in root.iter("object"):
-                class_name = obj.find("name").text
-                if class_name not in class_names:
-                    continue
-
-                class_id = class_names.index(class_name)
-                bndbox = obj.find("bndbox")
-                xmin = int(bndbox.find("xmin").text)
-                ymin = int(bndbox.find("ymin").text)
-                xmax = int(bndbox.find("xmax").text)
-                ymax = int(bndbox.find("ymax").text)
-
-                # convert to YOLO format
-                x_center = (xmin + xmax) / 2.0 / width
-                y_center = (ymin + ymax) / 2.0 / height
-                box_width = (xmax - xmin) / width
-                box_height = (ymax - ymin) / height
-
-                yolo_annotations.append(f"{class_id} {x_center} {y_center} {box_width} {box_height}")
-
-            output_file = os.path.join(output_dir, label_file.replace(".xml", ".txt"))  # Write the YOLO annotations to the output file
-            with open(output_file, "w") as f:
-                f.write("\n".join(yolo_annotations))
+    with Pool(workers) as pool:
+        # Keep a bounded number of batches in flight so archives are streamed, not read into memory at once
+        max_pending = 4 * (workers or os.cpu_count() or 1)
+        pending = deque()
+        for batch in batched(iter_sources(input_dir), batch_size):
+            pending.append(pool.apply_async(convert_batch, ((batch, class_ids, bounds),)))
+            while len(pending) >= max_pending or (pending and pending[0].ready()):
+                write(pending.popleft().get())
+        while pending:
+            write(pending.popleft().get())
+    return stats
 
 
 def main():
     parser = argparse.ArgumentParser(description="Convert PascalVOC annotations to YOLOv8 format.")
-    parser.add_argument("input_dir", type=str, help="Path of input directory containing images and labels.")
+    parser.add_argument("input_dir", type=str,
+                        help="Path of input directory containing images and labels, "
+                             "or a tar/zip archive of XML files.")
     parser.add_argument("output_dir", type=str, help="Path of output directory to save YOLOv8 annotations.")
+    parser.add_argument("--classes_file", type=str, default=None,
+                        help="Class names file (default: classes.txt in input_dir, required for archives).")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: all cores).")
+    parser.add_argument("--batch_size", type=int, default=256, help="XML files per worker task.")
+    parser.add_argument("--bounds", choices=BOUNDS_MODES, default='clip',
+                        help="Boxes outside the image: clip them (default), keep them as-is but count them (flag), "
+                             "or drop them.")
     args = parser.parse_args()
 
-    convert_voc_to_yolo(args.input_dir, args.output_dir)
+    stats = convert_voc_to_yolo(args.input_dir, args.output_dir, args.classes_file, args.workers, args.batch_size,
+                                args.bounds)
+
+    print(f"Converted {stats['files']} files: {stats['boxes']} boxes written out of {stats['objects']} objects")
+    print(f"Out of bounds: {stats['out_of_bounds']} (clipped {stats['clipped']}, "
+          f"dropped as empty after clipping {stats['dropped_empty']}), errors: {stats['errors']}")
+    for key, count in sorted(stats.items()):
+        if key.startswith(('unknown_class:', 'error:')):
+            print(f"  {key}: {count}")
 
 
 if __name__ == "__main__":
     main()
 
-# python pascalVOC_to_yolo.py datasets yolo_labels
\ No newline at end of file
+# python pascalVOC_to_yolo.py datasets yolo_labels
+# python pascalVOC_to_yolo.py voc_export.tar.gz yolo_labels --classes_file classes.txt --workers 16
@@ -1,62 +1,210 @@
-import cv2
-import numpy as np
-from ultralytics import YOLO
 import os
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-# Paths
-weights_path = 'person_detection.pt'  # Path to your YOLOv8 weights file
-input_dir = 'test2'  # Directory containing test images
-output_dir = 'prediction2'  # Directory to save annotated images
-
-# Load the model
-model = YOLO(weights_path)
-
-# Ensure output directory exists
-os.makedirs(output_dir, exist_ok=True)
-
-
-# Function to draw bounding boxes on image
-def draw_boxes(image, detections):
-    for det in detections:
-        # Get bounding box coordinates, confidence score, and class ID
-        x1, y1, x2, y2, conf, cls = det[:6]
-        color = (0, 255, 0)  # Green color for bounding boxes
-        label = f'{model.names[int(cls)]} {conf:.2f}'
-
-        # Draw rectangle
-        cv2.rectangle(image, (int(x1), int(y1)), (int(x2), int(y2)), color, 2)
-        # Put text
-        cv2.putText(image, label, (int(x1), int(y1) - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
-    return image
-
-
-# Process each image in the input directory
-for image_name in os.listdir(input_dir):
-    image_path = os.path.join(input_dir, image_name)
-    output_path = os.path.join(output_dir, image_name)
-
-    # Load image
-    image = cv2.imread(image_path)
-
-    # Predict
-    results = model(image)
-
-    # results is a list of Result objects
-    for result in results:
-        # Get the detections
-        detections = result.boxes.xyxy.cpu().numpy()  # Bounding boxes (x1, y1, x2, y2) in normalized coordinates
-        scores = result.boxes.conf.cpu().numpy()  # Confidence scores
-        class_ids = result.boxes.cls.cpu().numpy()  # Class IDs
-
-        # Combine detections, scores, and class IDs into a single list
-        detections_combined = np.hstack((detections, scores[:, np.newaxis], class_ids[:, np.newaxis]))
-
-        # Draw boxes on image
-        annotated_image = draw_boxes(image, detections_combined)
-
-        # Save the annotated image
-        cv2.imwrite(output_path, annotated_image)
-
-    print(f'Processed {image_name}')
+import cv2
+import numpy as np
 
-print('Processing complete.')
\ No newline at end of file
+from tiling import MERGE_METHODS, sliced_detector
+from sinks import YoloTxtSink, detection_rows, open_sink
+from render import draw_detections
+from shards import is_packed, open_packed
+from image_io import IMAGE_EXTENSIONS
+
+
+# Function to draw bounding boxes on image: rows of (x1, y1, x2, y2, conf, class_id)
+def draw_boxes(image, detections, names):
+    detections = np.asarray(detections, np.float32).reshape(-1, 6)
+    return draw_detections(image, detections[:, :4], detections[:, 5], names, detections[:, 4])
+
+
+def list_images(input_dir, output_dir=None, sinks=(), resume=True):
+    # Image files in input_dir (a directory or packed dataset), minus those a previous (interrupted) run
+    # already recorded in every sink and, when every image is rendered, wrote to output_dir
+    if is_packed(input_dir):
+        image_names = sorted(f for f in open_packed(input_dir).image_names() if f.lower().endswith(IMAGE_EXTENSIONS))
+    else:
+        image_names = sorted(f for f in os.listdir(input_dir) if f.lower().endswith(IMAGE_EXTENSIONS))
+    if not resume or (output_dir is None and not sinks):
+        return image_names, 0
+
+    todo = image_names
+    if output_dir is not None:
+        rendered = set(os.listdir(output_dir)) if os.path.isdir(output_dir) else set()
+        todo = [name for name in todo if name not in rendered]
+    if sinks:
+        done = set.intersection(*(sink.completed() for sink in sinks))
+        todo = [name for name in todo if os.path.splitext(name)[0] not in done]
+    return todo, len(image_names) - len(todo)
+
+
+def write_outputs(image_name, image, detections, names, output_dir):
+    annotated_image = draw_boxes(image, detections, names)
+    cv2.imwrite(os.path.join(output_dir, image_name), annotated_image)
+
+
+def predict_directory(detector, names, input_dir, output_dir=None, label_dir=None, batch_size=16, decode_workers=4,
+                      write_workers=4, prefetch=64, ordered=True, resume=True, sinks=(), render_every=1):
+    # Detections go to the sinks (label_dir is a YOLO txt sink); annotated images are a side output
+    # written for one image in `render_every` (0: none)
+    sinks = list(sinks)
+    if label_dir is not None:
+        sinks.append(YoloTxtSink(label_dir))
+    render = output_dir is not None and render_every > 0
+    if render:
+        os.makedirs(output_dir, exist_ok=True)
+
+    image_names, skipped = list_images(input_dir, output_dir if render and render_every == 1 else None, sinks,
+                                       resume)
+    if skipped:
+        print(f'Skipping {skipped} images already processed')
+
+    dataset = open_packed(input_dir) if is_packed(input_dir) else None
+
+    def decode(image_name):
+        if dataset is not None:
+            return image_name, dataset.read_image(image_name)
+        return image_name, cv2.imread(os.path.join(input_dir, image_name))
+
+    processed = 0
+    with ThreadPoolExecutor(decode_workers) as decoders, ThreadPoolExecutor(write_workers) as writers:
+        names_iter = iter(image_names)
+        in_flight = deque()
+        pending_writes = deque()
+
+        def refill():
+            while len(in_flight) < prefetch:
+                image_name = next(names_iter, None)
+                if image_name is None:
+                    return
+                in_flight.append(decoders.submit(decode, image_name))
+
+        def next_decoded():
+            # Ordered mode takes decodes in listing order, otherwise whichever finishes first
+            if ordered:
+                return in_flight.popleft().result()
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            future = done.pop()
+            in_flight.remove(future)
+            return future.result()
+
+        refill()
+        while in_flight:
+            batch = []
+            while in_flight and len(batch) < batch_size:
+                image_name, image = next_decoded()
+                refill()
+                if image is None:
+                    print(f'Could not read {image_name}, skipping')
+                    continue
+                batch.append((image_name, image))
+            if not batch:
+                continue
+
+            # Predict the whole batch in one forward pass
+            results = detector([image for _, image in batch])
+
+            for (image_name, image), dets in zip(batch, results):
+                rows = detection_rows(image_name, image.shape, dets, names)
+                for sink in sinks:
+                    sink.write(rows)
+                if render and processed % render_every == 0:
+                    # Combine detections, scores, and class IDs into a single array
+                    detections_combined = np.hstack((dets.boxes, dets.scores[:, np.newaxis],
+                                                     dets.classes[:, np.newaxis].astype(np.float32)))
+                    pending_writes.append(writers.submit(write_outputs, image_name, image, detections_combined,
+                                                         names, output_dir))
+                processed += 1
+
+            # Bound the number of annotated images held in memory waiting for the writers
+            while len(pending_writes) > prefetch:
+                pending_writes.popleft().result()
+            print(f'Processed {processed}/{len(image_names)} images')
+
+        for future in pending_writes:
+            future.result()
+    for sink in sinks:
+        sink.close()
+    return processed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run YOLO detection over a directory of images.')
+    parser.add_argument('--weights', type=str, default='person_detection.pt',
+                        help='Path to YOLOv8 weights file, .onnx export or OpenVINO model directory.')
+    parser.add_argument('--backend', choices=('torch', 'onnx', 'openvino'), default=None,
+                        help='Inference backend (default: from the weights file extension).')
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads for the model.')
+    parser.add_argument('--input_dir', type=str, default='test2', help='Directory containing test images, or a packed dataset (shards.py).')
+    parser.add_argument('--output_dir', type=str, default='prediction2', help='Directory to save annotated images.')
+    parser.add_argument('--label_dir', type=str, default=None, help='Optional directory to save YOLO label files.')
+    parser.add_argument('--sink', type=str, action='append', default=[],
+                        help='Also record detections to results.jsonl, results.parquet, results.arrow or '
+                             'yolo:<dir> (repeatable).')
+    parser.add_argument('--render_every', type=int, default=1,
+                        help='Write an annotated image for one image in N (default: 1, every image; 0: none).')
+    parser.add_argument('--batch_size', type=int, default=16, help='Images per forward pass (default: 16).')
+    parser.add_argument('--decode_workers', type=int, default=4, help='Threads decoding images ahead of the model.')
+    parser.add_argument('--write_workers', type=int, default=4, help='Threads encoding and writing outputs.')
+    parser.add_argument('--prefetch', type=int, default=64, help='Maximum images decoded ahead of the model.')
+    parser.add_argument('--unordered', action='store_true',
+                        help='Feed images to the model as soon as they are decoded instead of in listing order.')
+    parser.add_argument('--no_resume', action='store_true', help='Reprocess images whose outputs already exist.')
+    parser.add_argument('--server', type=str, default=None,
+                        help='URL of a running model_server.py to use instead of loading the weights.')
+    parser.add_argument('--server_stage', choices=('person', 'ppe'), default='person',
+                        help='Which of the served models to run (default: person).')
+    parser.add_argument('--tile_size', type=int, default=None,
+                        help='Detect on overlapping tiles of this size instead of the downscaled frame '
+                             '(for small, distant people in high resolution frames).')
+    parser.add_argument('--tile_overlap', type=float, default=0.2, help='Overlap between tiles (default: 0.2).')
+    parser.add_argument('--no_full_frame', action='store_true',
+                        help='With --tile_size, skip the coarse full frame pass that catches large people.')
+    parser.add_argument('--merge', choices=MERGE_METHODS, default='nms',
+                        help='How duplicate detections across tile seams are merged (default: nms).')
+    parser.add_argument('--cache', type=str, default=None,
+                        help='Result cache database: images already scored with the same weights and '
+                             'settings skip inference.')
+    parser.add_argument('--cache_size_mb', type=int, default=512, help='Result cache size limit (default: 512).')
+    args = parser.parse_args()
+    if args.cache and args.server:
+        parser.error('--cache needs local --weights to fingerprint the model')
+
+    if args.server:
+        # Use the models already loaded by a running model_server.py
+        from model_client import ModelClient
+        detector = ModelClient(args.server).detector(args.server_stage)
+    else:
+        from backends import load_detector  # imports this module
+        detector = load_detector(args.weights, args.backend, threads=args.threads)
+    if args.tile_size:
+        detector = sliced_detector(detector, args.tile_size, args.tile_overlap, not args.no_full_frame, args.merge,
+                                   max_batch_size=args.batch_size)
+    if args.cache:
+        from result_cache import ResultCache, cache_namespace, cached_detector
+        namespace = cache_namespace(args.weights, backend=args.backend, **detector.params)
+        detector = cached_detector(detector, ResultCache(args.cache, args.cache_size_mb * 2 ** 20), namespace)
+
+    predict_directory(detector, detector.names, args.input_dir, args.output_dir, args.label_dir,
+                      batch_size=args.batch_size, decode_workers=args.decode_workers,
+                      write_workers=args.write_workers, prefetch=args.prefetch, ordered=not args.unordered,
+                      resume=not args.no_resume, sinks=[open_sink(spec) for spec in args.sink],
+                      render_every=args.render_every)
+    if args.cache:
+        stats = detector.cache.stats()
+        print(f"Result cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%}), "
+              f"{stats['entries']} entries, {stats['bytes'] / 2 ** 20:.1f} MB")
+    print('Processing complete.')
+
+
+if __name__ == '__main__':
+    main()
+
+# python predict.py --input_dir test2 --output_dir prediction2
+# python predict.py --server http://127.0.0.1:8765 --input_dir test2 --output_dir prediction2
+# python predict.py --input_dir site_4k --output_dir site_4k_predictions --tile_size 640 --batch_size 4
+# python predict.py --weights person_detection_int8.onnx --threads 4 --input_dir test2 --output_dir prediction2
+# python predict.py --input_dir inference_on_sample_test_set --output_dir regression --cache detections.cache --no_resume
+# python predict.py --input_dir site_day --output_dir site_day_samples --sink site_day.parquet --render_every 100
+# python predict.py --weights ppe_detection.pt --input_dir ppe_dataset/test/images --output_dir ppe_predictions --label_dir ppe_predictions/labels --batch_size 32
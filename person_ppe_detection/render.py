@@ -0,0 +1,116 @@
+from functools import lru_cache
+
+import cv2
+import numpy as np
+
+# One drawing path for dataset previews (view_annotations.py) and predictions (predict.py, inf.py, stream.py)
+# so both look the same.
+
+# Class colours (BGR) of the dataset previews, cycled when there are more classes
+CLASS_COLORS = [
+    (0, 0, 255),  # Red
+    (0, 255, 255),  # Yellow
+    (255, 0, 0),  # Blue
+    (0, 255, 0),  # Green
+    (255, 0, 255),  # Pink
+    (64, 224, 208),  # Turquoise
+    (128, 0, 128),  # Purple
+    (255, 165, 0),  # Orange
+    (255, 255, 255)  # White
+]
+PERSON_COLOR = (255, 0, 0)
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+
+def class_color(class_id):
+    return CLASS_COLORS[int(class_id) % len(CLASS_COLORS)]
+
+
+@lru_cache(maxsize=1024)
+def label_patch(text, font_scale, color):
+    # A label rasterised once, as (inverse coverage, colour premultiplied by coverage, ascent, pad) patches
+    # that blend_label composites in two saturating cv2 calls. Labels repeat (one per class, or class and
+    # rounded score), so drawing a box no longer rasterises its text.
+    (width, ascent), baseline = cv2.getTextSize(text, FONT, font_scale, 1)
+    pad = 2  # anti-aliasing spills past the measured text box
+    coverage = np.zeros((ascent + baseline + 2 * pad, width + 2 * pad), np.uint8)
+    cv2.putText(coverage, text, (pad, ascent + pad), FONT, font_scale, 255, 1, cv2.LINE_AA)
+    inverse = cv2.merge([255 - coverage] * 3)
+    premultiplied = cv2.merge([cv2.multiply(coverage, float(c), scale=1 / 255) for c in color])
+    return inverse, premultiplied, ascent, pad
+
+
+def blend_label(image, patch, x, y):
+    # Composite a label_patch with its baseline-left corner at (x, y), as cv2.putText would draw it
+    inverse, premultiplied, ascent, pad = patch
+    h, w = image.shape[:2]
+    top, left = y - ascent - pad, x - pad
+    y1, x1 = max(top, 0), max(left, 0)
+    y2, x2 = min(top + inverse.shape[0], h), min(left + inverse.shape[1], w)
+    if y2 <= y1 or x2 <= x1:
+        return
+    if (y2 - y1, x2 - x1) != inverse.shape[:2]:
+        # Clipped by the image border
+        inverse = inverse[y1 - top:y2 - top, x1 - left:x2 - left]
+        premultiplied = premultiplied[y1 - top:y2 - top, x1 - left:x2 - left]
+    region = image[y1:y2, x1:x2]
+    cv2.multiply(region, inverse, dst=region, scale=1 / 255)
+    cv2.add(region, premultiplied, dst=region)
+
+
+def draw_detections(image, boxes, classes, names=None, scores=None, color=None, thickness=2, font_scale=0.5,
+                    labels=True):
+    # Draw xyxy pixel boxes in place, labelled '<name>' (or '<name> <score>') above the box, or just inside
+    # it when there is no room above. color None: the colour of each box's class.
+    boxes = np.asarray(boxes, np.float32).reshape(-1, 4).astype(int)
+    classes = np.asarray(classes).reshape(-1).astype(int).tolist()
+    scores = None if scores is None else np.asarray(scores, np.float32).reshape(-1).tolist()
+    for k, (x1, y1, x2, y2) in enumerate(boxes.tolist()):
+        box_color = tuple(color or class_color(classes[k]))
+        cv2.rectangle(image, (x1, y1), (x2, y2), box_color, thickness)
+        if labels:
+            name = names[classes[k]] if names is not None else str(classes[k])
+            text = name if scores is None else f'{name} {scores[k]:.2f}'
+            patch = label_patch(text, font_scale, box_color)
+            ascent = patch[2]
+            y = y1 - 10 if y1 - 10 >= ascent else y1 + ascent + thickness
+            blend_label(image, patch, x1, y)
+    return image
+
+
+def draw_labels(image, class_ids, boxes, names=None, **kwargs):
+    # YOLO label boxes (normalised x_center, y_center, width, height) onto image, in place
+    h, w = image.shape[:2]
+    boxes = np.asarray(boxes, np.float32).reshape(-1, 4)
+    xyxy = np.concatenate([boxes[:, :2] - boxes[:, 2:] / 2, boxes[:, :2] + boxes[:, 2:] / 2], axis=1)
+    return draw_detections(image, xyxy * np.array([w, h, w, h], np.float32), class_ids, names, **kwargs)
+
+
+def fit_thumbnail(image, cell):
+    # image scaled (INTER_AREA) to fit a (width, height) cell, keeping its aspect ratio
+    cw, ch = cell
+    h, w = image.shape[:2]
+    factor = min(cw / w, ch / h)
+    size = (max(int(w * factor), 1), max(int(h * factor), 1))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+def contact_sheet(thumbnails, grid=(8, 8), cell=(160, 160), captions=None, background=32):
+    # Tile up to cols * rows thumbnails (each at most cell sized) row by row into one image, centred in
+    # their cells, with an optional caption at the bottom of each cell
+    cols, rows = grid
+    cw, ch = cell
+    sheet = np.full((rows * ch, cols * cw, 3), background, np.uint8)
+    for k, thumb in enumerate(thumbnails[:cols * rows]):
+        if thumb is None:
+            continue
+        if thumb.ndim == 2:
+            thumb = cv2.cvtColor(thumb, cv2.COLOR_GRAY2BGR)
+        row, col = divmod(k, cols)
+        h, w = thumb.shape[:2]
+        y, x = row * ch + (ch - h) // 2, col * cw + (cw - w) // 2
+        sheet[y:y + h, x:x + w] = thumb
+        if captions is not None:
+            cv2.putText(sheet, captions[k], (col * cw + 2, (row + 1) * ch - 4), FONT, 0.35, (255, 255, 255), 1,
+                        cv2.LINE_AA)
+    return sheet
@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import threading
+
+import numpy as np
+
+from two_stage import Detections
+
+
+def image_digest(image):
+    # Content hash of a decoded image: pixels, shape and dtype
+    image = np.ascontiguousarray(image)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f'{image.shape}{image.dtype.str}'.encode())
+    h.update(memoryview(image).cast('B'))
+    return h.digest()
+
+
+def weights_fingerprint(path, chunk_size=1 << 20):
+    # Hash of a weights file, or of every file of a model directory (OpenVINO exports)
+    h = hashlib.blake2b(digest_size=16)
+    paths = [path] if os.path.isfile(path) else sorted(
+        os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    for file_path in paths:
+        h.update(os.path.relpath(file_path, path).encode())
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_namespace(weights, **params):
+    # Results are only shared between runs with the same model and inference parameters
+    return f'{weights_fingerprint(weights)}:{json.dumps(params, sort_keys=True, default=str)}'
+
+
+class ResultCache:
+    # Detections stored in SQLite under a content key, as raw float32 boxes/scores and uint16 classes.
+    # When the stored payload exceeds max_bytes the least recently used entries are evicted down to
+    # 90% of it. Safe to share between threads.
+    def __init__(self, path, max_bytes=512 * 2 ** 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS results (key BLOB PRIMARY KEY, boxes BLOB, scores BLOB, '
+                        'classes BLOB, size INTEGER, last_used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+        self.total_bytes = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(namespace, digest):
+        return hashlib.blake2b(namespace.encode() + digest, digest_size=16).digest()
+
+    def get_many(self, keys):
+        # {key: Detections} for the keys present; refreshes their LRU position
+        found = {}
+        with self.lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self.db.execute(f"SELECT key, boxes, scores, classes FROM results WHERE key IN "
+                                       f"({','.join('?' * len(chunk))})", chunk).fetchall()
+                for key, boxes, scores, classes in rows:
+                    found[key] = Detections(np.frombuffer(boxes, np.float32).reshape(-1, 4).copy(),
+                                            np.frombuffer(scores, np.float32).copy(),
+                                            np.frombuffer(classes, np.uint16).astype(int))
+            if found:
+                now = time.time()
+                self.db.executemany('UPDATE results SET last_used = ? WHERE key = ?', [(now, k) for k in found])
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        # items: [(key, Detections)]
+        now = time.time()
+        rows = []
+        for key, dets in items:
+            boxes = np.asarray(dets.boxes, np.float32).tobytes()
+            scores = np.asarray(dets.scores, np.float32).tobytes()
+            classes = np.asarray(dets.classes).astype(np.uint16).tobytes()
+            rows.append((key, boxes, scores, classes, len(key) + len(boxes) + len(scores) + len(classes), now))
+        with self.lock:
+            self.db.execute('BEGIN')
+            for row in rows:
+                old = self.db.execute('SELECT size FROM results WHERE key = ?', (row[0],)).fetchone()
+                self.total_bytes -= old[0] if old else 0
+                self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)', row)
+                self.total_bytes += row[4]
+            self.db.execute('COMMIT')
+            if self.total_bytes > self.max_bytes:
+                self._evict(int(self.max_bytes * 0.9))
+
+    def _evict(self, target_bytes):
+        self.db.execute('BEGIN')
+        while self.total_bytes > target_bytes:
+            rows = self.db.execute('SELECT key, size FROM results ORDER BY last_used LIMIT 1000').fetchall()
+            if not rows:
+                break
+            victims = []
+            for key, size in rows:
+                if self.total_bytes <= target_bytes:
+                    break
+                victims.append((key,))
+                self.total_bytes -= size
+            self.db.executemany('DELETE FROM results WHERE key = ?', victims)
+            self.evictions += len(victims)
+        self.db.execute('COMMIT')
+
+    def stats(self):
+        with self.lock:
+            entries = self.db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'entries': entries, 'bytes': self.total_bytes, 'evictions': self.evictions}
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM results')
+            self.total_bytes = 0
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def cached_detector(detector, cache, namespace):
+    # Wrap a detector callable so only images whose (content, namespace) key is not in the cache
+    # reach the model. The namespace must identify the model and every parameter affecting its output,
+    # e.g. cache_namespace(weights, **detector.params).
+    def detect(images):
+        images = list(images)
+        keys = [cache.key(namespace, image_digest(image)) for image in images]
+        found = cache.get_many(keys)
+        # Identical images within one call are only run once
+        missing = list(dict.fromkeys(key for key in keys if key not in found))
+        if missing:
+            by_key = dict(zip(keys, images))
+            outputs = detector([by_key[key] for key in missing])
+            cache.put_many(list(zip(missing, outputs)))
+            found.update(zip(missing, outputs))
+        return [found[key] for key in keys]
+
+    detect.names = getattr(detector, 'names', None)
+    detect.letterboxes = getattr(detector, 'letterboxes', False)
+    detect.params = getattr(detector, 'params', {})
+    detect.cache = cache
+    return detect
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or clear a detection result cache.')
+    parser.add_argument('cache', type=str, help='Cache database file.')
+    parser.add_argument('--clear', action='store_true', help='Remove every cached result.')
+    args = parser.parse_args()
+
+    cache = ResultCache(args.cache)
+    if args.clear:
+        cache.clear()
+    stats = cache.stats()
+    print(f"{stats['entries']} cached results, {stats['bytes'] / 2 ** 20:.1f} MB")
+    cache.close()
+
+
+if __name__ == '__main__':
+    main()
+
+# python result_cache.py detections.cache
+# python result_cache.py detections.cache --clear
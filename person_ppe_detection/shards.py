@@ -0,0 +1,308 @@
+import io
+import os
+import json
+import mmap
+import tarfile
+import argparse
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from annotation_index import parse_label_text
+from image_io import IMAGE_EXTENSIONS, image_size
+
+PACK_VERSION = 1
+PACK_META = 'pack.json'
+_INDEX_ARRAYS = ('keys', 'exts', 'image_offsets', 'image_sizes', 'label_offsets', 'label_sizes', 'widths', 'heights',
+                 'class_counts')
+
+# A packed dataset is a directory of tar shards (shard-00000.tar, ...) in WebDataset layout: the image
+# and label of a sample are adjacent members named <key>.<ext> and <key>.txt, so shards can be read
+# front to back or untarred with standard tools. Every shard has an index (shard-00000.idx.npz) with
+# the byte offset and size of each member, the image size and the per-class box counts of each sample,
+# and pack.json lists the shards and the dataset totals.
+
+
+def index_path(shard_path):
+    return os.path.splitext(shard_path)[0] + '.idx.npz'
+
+
+def is_packed(path):
+    # A directory written by ShardWriter, or a single shard next to its index
+    if os.path.isdir(path):
+        return os.path.exists(os.path.join(path, PACK_META))
+    return path.endswith('.tar') and os.path.exists(index_path(path))
+
+
+class ShardWriter:
+    # Appends samples to tar shards of about `shard_bytes` each and writes their indexes
+    def __init__(self, output_dir, shard_bytes=512 * 2 ** 20):
+        self.output_dir = output_dir
+        self.shard_bytes = shard_bytes
+        self.shards = []
+        self.tar = None
+        self.rows = []
+        self.keys = set()
+        self.totals = np.zeros(0, np.int64)
+        self.images = 0
+        self.bytes = 0
+        os.makedirs(output_dir, exist_ok=True)
+
+    def _add(self, name, data):
+        # Returns the offset of the member's data in the shard
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mode = 0o644
+        self.tar.addfile(info, io.BytesIO(data))
+        return self.tar.offset - len(data) - (-len(data) % tarfile.BLOCKSIZE)
+
+    def write(self, key, ext, image_bytes, label_bytes=None, size=None):
+        # label_bytes None: the sample has no label file (an empty label file is b'')
+        if key in self.keys:
+            raise ValueError(f"Duplicate sample key '{key}' (images with the same name and different extensions?)")
+        self.keys.add(key)
+        if self.tar is None or self.tar.offset >= self.shard_bytes:
+            self._finish_shard()
+            self.tar = tarfile.open(os.path.join(self.output_dir, f'shard-{len(self.shards):05d}.tar'), 'w',
+                                    format=tarfile.GNU_FORMAT)
+            self.shards.append(os.path.basename(self.tar.name))
+        width, height = size or image_size(image_bytes)
+        image_offset = self._add(key + ext, image_bytes)
+        label_offset = self._add(key + '.txt', label_bytes) if label_bytes is not None else -1
+        class_ids = parse_label_text(label_bytes.decode())[0] if label_bytes else np.zeros(0, np.int32)
+        self.rows.append((key, ext, image_offset, len(image_bytes), label_offset,
+                          len(label_bytes) if label_bytes is not None else 0, width, height, class_ids))
+
+    def _finish_shard(self):
+        if self.tar is None:
+            return
+        self.tar.close()
+        keys, exts, image_offsets, image_sizes, label_offsets, label_sizes, widths, heights, class_ids = zip(*self.rows)
+        num_classes = max((int(c.max()) + 1 for c in class_ids if len(c)), default=0)
+        counts = np.zeros((len(keys), num_classes), np.int32)
+        for i, c in enumerate(class_ids):
+            np.add.at(counts[i], c, 1)
+        np.savez(index_path(self.tar.name), keys=np.array(keys), exts=np.array(exts),
+                 image_offsets=np.array(image_offsets, np.int64), image_sizes=np.array(image_sizes, np.int64),
+                 label_offsets=np.array(label_offsets, np.int64), label_sizes=np.array(label_sizes, np.int64),
+                 widths=np.array(widths, np.int32), heights=np.array(heights, np.int32), class_counts=counts)
+        totals = counts.sum(axis=0)
+        width = max(len(self.totals), len(totals))
+        self.totals = np.pad(self.totals, (0, width - len(self.totals))) + np.pad(totals, (0, width - len(totals)))
+        self.images += len(keys)
+        self.bytes += os.path.getsize(self.tar.name)
+        self.tar = None
+        self.rows = []
+
+    def close(self):
+        self._finish_shard()
+        with open(os.path.join(self.output_dir, PACK_META), 'w') as f:
+            json.dump({'version': PACK_VERSION, 'shards': self.shards, 'images': self.images, 'bytes': self.bytes,
+                       'class_counts': self.totals.tolist()}, f, indent=2)
+
+
+def _read_sample(image_dir, label_dir, name):
+    with open(os.path.join(image_dir, name), 'rb') as f:
+        image_bytes = f.read()
+    label_path = os.path.join(label_dir, os.path.splitext(name)[0] + '.txt') if label_dir else None
+    label_bytes = None
+    if label_path and os.path.exists(label_path):
+        with open(label_path, 'rb') as f:
+            label_bytes = f.read()
+    return name, image_bytes, label_bytes
+
+
+def pack_directory(image_dir, label_dir, output_dir, shard_bytes=512 * 2 ** 20, workers=16):
+    # Pack an image directory and its YOLO labels. Files are read by `workers` threads ahead of the
+    # writer, which is what hides the per-file latency of network storage.
+    names = sorted(f for f in os.listdir(image_dir) if f.lower().endswith(IMAGE_EXTENSIONS))
+    writer = ShardWriter(output_dir, shard_bytes)
+    with ThreadPoolExecutor(workers) as pool:
+        for start in range(0, len(names), 1024):
+            chunk = names[start:start + 1024]
+            for name, image_bytes, label_bytes in pool.map(lambda n: _read_sample(image_dir, label_dir, n), chunk):
+                key, ext = os.path.splitext(name)
+                writer.write(key, ext, image_bytes, label_bytes)
+    writer.close()
+    return writer
+
+
+class PackedDataset:
+    # Reader for a packed dataset (or a single shard). Random access by image name or key maps the
+    # shards into memory (falling back to positional reads where mmap isn't available, e.g. some
+    # network filesystems); iteration streams the shards front to back. Safe to share between threads.
+    def __init__(self, path, use_mmap=True):
+        self.path = path
+        self.use_mmap = use_mmap
+        if os.path.isdir(path):
+            with open(os.path.join(path, PACK_META)) as f:
+                self.meta = json.load(f)
+            shard_paths = [os.path.join(path, name) for name in self.meta['shards']]
+        else:
+            self.meta = None
+            shard_paths = [path]
+        self.shard_paths = shard_paths
+
+        indexes = []
+        for path_ in shard_paths:
+            with np.load(index_path(path_)) as data:
+                indexes.append({name: data[name] for name in _INDEX_ARRAYS})
+        num_classes = max([index['class_counts'].shape[1] for index in indexes], default=0)
+        for index in indexes:
+            index['class_counts'] = np.pad(index['class_counts'],
+                                           ((0, 0), (0, num_classes - index['class_counts'].shape[1])))
+        for name in _INDEX_ARRAYS:
+            setattr(self, name, np.concatenate([index[name] for index in indexes]) if indexes else np.zeros(0))
+        self.shard_ids = np.repeat(np.arange(len(indexes)), [len(index['keys']) for index in indexes])
+        self.lookup = {key: i for i, key in enumerate(self.keys.tolist())}
+        self.lock = threading.Lock()
+        self.handles = [None] * len(shard_paths)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def image_names(self):
+        # '<key><ext>' of every sample, in pack order, as they were in the image directory
+        return [key + ext for key, ext in zip(self.keys.tolist(), self.exts.tolist())]
+
+    @property
+    def names(self):
+        # Label file names of the labelled samples, rows of file_class_counts (as in AnnotationIndex)
+        return np.array([key + '.txt' for key in self.keys[self.label_offsets >= 0].tolist()], dtype=str)
+
+    def file_class_counts(self, num_classes=None):
+        counts = self.class_counts[self.label_offsets >= 0]
+        return np.pad(counts, ((0, 0), (0, max((num_classes or 0) - counts.shape[1], 0))))
+
+    def index_of(self, name):
+        # Sample index of an image name, label name or key
+        key = os.path.splitext(os.path.basename(name))[0] if name not in self.lookup else name
+        return self.lookup[key]
+
+    def _handle(self, shard):
+        # (mmap or None, file descriptor) of a shard, opened on first use
+        if self.handles[shard] is None:
+            with self.lock:
+                if self.handles[shard] is None:
+                    fd = os.open(self.shard_paths[shard], os.O_RDONLY)
+                    mapped = None
+                    if self.use_mmap:
+                        try:
+                            mapped = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+                        except (OSError, ValueError):
+                            mapped = None
+                    self.handles[shard] = (mapped, fd)
+        return self.handles[shard]
+
+    def _read(self, shard, offset, size):
+        mapped, fd = self._handle(shard)
+        if mapped is not None:
+            return memoryview(mapped)[offset:offset + size]
+        return os.pread(fd, size, offset)
+
+    def read_bytes(self, name):
+        i = self.index_of(name)
+        return self._read(self.shard_ids[i], int(self.image_offsets[i]), int(self.image_sizes[i]))
+
+    def read_image(self, name, flags=cv2.IMREAD_COLOR):
+        # Decoded image like cv2.imread: None when the data can't be decoded
+        return cv2.imdecode(np.frombuffer(self.read_bytes(name), np.uint8), flags)
+
+    def read_label_text(self, name):
+        # Contents of the sample's label file, None when it had none
+        i = self.index_of(name)
+        if self.label_offsets[i] < 0:
+            return None
+        return bytes(self._read(self.shard_ids[i], int(self.label_offsets[i]), int(self.label_sizes[i]))).decode()
+
+    def read_label(self, name):
+        # (class_ids, boxes) as parse_label_file returns them, None without a label file
+        text = self.read_label_text(name)
+        return None if text is None else parse_label_text(text)[:2]
+
+    def __iter__(self):
+        # (image name, image bytes, label text or None) of every sample, reading each shard sequentially
+        for shard, shard_path in enumerate(self.shard_paths):
+            rows = np.flatnonzero(self.shard_ids == shard)
+            with open(shard_path, 'rb', buffering=8 * 2 ** 20) as f:
+                for i in rows.tolist():
+                    f.seek(int(self.image_offsets[i]))
+                    image_bytes = f.read(int(self.image_sizes[i]))
+                    label_text = None
+                    if self.label_offsets[i] >= 0:
+                        f.seek(int(self.label_offsets[i]))
+                        label_text = f.read(int(self.label_sizes[i])).decode()
+                    yield self.keys[i] + self.exts[i], image_bytes, label_text
+
+    def write_subset(self, output_dir, names, shard_bytes=512 * 2 ** 20):
+        # Pack the given samples into a new dataset, copying the stored bytes as they are
+        writer = ShardWriter(output_dir, shard_bytes)
+        for i in sorted(self.index_of(name) for name in names):
+            label = None
+            if self.label_offsets[i] >= 0:
+                label = bytes(self._read(self.shard_ids[i], int(self.label_offsets[i]), int(self.label_sizes[i])))
+            writer.write(str(self.keys[i]), str(self.exts[i]),
+                         bytes(self._read(self.shard_ids[i], int(self.image_offsets[i]), int(self.image_sizes[i]))),
+                         label, (int(self.widths[i]), int(self.heights[i])))
+        writer.close()
+        return writer
+
+    def close(self):
+        for handle in self.handles:
+            if handle is not None:
+                mapped, fd = handle
+                if mapped is not None:
+                    mapped.close()
+                os.close(fd)
+        self.handles = [None] * len(self.shard_paths)
+
+
+@lru_cache(maxsize=8)
+def open_packed(path):
+    # One shared reader per path and process (worker processes open their own after forking)
+    return PackedDataset(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack an image/label directory pair into tar shards, or describe a '
+                                                 'packed dataset.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    pack = subparsers.add_parser('pack', help='Pack images and YOLO labels.')
+    pack.add_argument('image_dir', type=str, help='Directory containing images.')
+    pack.add_argument('label_dir', type=str, help='Directory containing YOLO labels.')
+    pack.add_argument('output_dir', type=str, help='Packed dataset directory to create.')
+    pack.add_argument('--shard_size_mb', type=int, default=512, help='Approximate size of each shard (default: 512).')
+    pack.add_argument('--workers', type=int, default=16, help='Threads reading the input files.')
+    info = subparsers.add_parser('info', help='Summarise a packed dataset from its indexes.')
+    info.add_argument('path', type=str, help='Packed dataset directory or shard.')
+    info.add_argument('--classes_file', type=str, default=None, help='Class names for the histogram.')
+    args = parser.parse_args()
+
+    if args.command == 'pack':
+        writer = pack_directory(args.image_dir, args.label_dir, args.output_dir, args.shard_size_mb * 2 ** 20,
+                                args.workers)
+        print(f'Packed {writer.images} images into {len(writer.shards)} shards ({writer.bytes / 2 ** 20:.1f} MB)')
+        return
+
+    dataset = PackedDataset(args.path)
+    names = None
+    if args.classes_file:
+        with open(args.classes_file) as f:
+            names = [line.strip() for line in f if line.strip()]
+    labelled = int((dataset.label_offsets >= 0).sum())
+    print(f'{len(dataset)} images ({labelled} labelled) in {len(dataset.shard_paths)} shards, '
+          f'{int(dataset.image_sizes.sum()) / 2 ** 20:.1f} MB of images')
+    if len(dataset):
+        print(f'image sizes: {dataset.widths.min()}-{dataset.widths.max()} x {dataset.heights.min()}-{dataset.heights.max()}')
+    for class_id, count in enumerate(dataset.class_counts.sum(axis=0).tolist()):
+        print(f'  {names[class_id] if names and class_id < len(names) else class_id}: {count}')
+
+
+if __name__ == '__main__':
+    main()
+
+# python shards.py pack augmented_data/images augmented_data/all_labels augmented_data/packed --workers 32
+# python shards.py info augmented_data/packed --classes_file classes.txt
@@ -0,0 +1,257 @@
+import os
+import glob
+import json
+import time
+import argparse
+
+import numpy as np
+
+# One row per box. PPE rows point at their person through parent_id (the person's box_id in the same
+# image), persons and single-model detections have parent_id -1. Coordinates are frame pixels.
+# An image without any detection is still recorded, as one row with box_id -1, so readers can count
+# processed images and resume from the sinks alone.
+COLUMNS = ('image', 'timestamp', 'width', 'height', 'box_id', 'parent_id', 'stage', 'class_id', 'class_name',
+           'score', 'x1', 'y1', 'x2', 'y2')
+
+
+def _image_row(image_name, shape, timestamp):
+    return (image_name, timestamp, shape[1], shape[0], -1, -1, '', -1, '', float('nan'),
+            float('nan'), float('nan'), float('nan'), float('nan'))
+
+
+def detection_rows(image_name, shape, dets, names=None, stage='object', timestamp=None):
+    # Rows for the output of a single detector
+    timestamp = time.time() if timestamp is None else timestamp
+    rows = []
+    for i, (box, score, class_id) in enumerate(zip(np.asarray(dets.boxes).tolist(), np.asarray(dets.scores).tolist(),
+                                                   np.asarray(dets.classes).tolist())):
+        name = names[int(class_id)] if names else ''
+        rows.append((image_name, timestamp, shape[1], shape[0], i, -1, stage, int(class_id), name, score, *box))
+    return rows or [_image_row(image_name, shape, timestamp)]
+
+
+def result_rows(image_name, shape, result, ppe_names=None, timestamp=None):
+    # Rows for a two_stage.FrameResult: persons first, then every PPE box linked to its person
+    timestamp = time.time() if timestamp is None else timestamp
+    rows = [(image_name, timestamp, shape[1], shape[0], i, -1, 'person', int(class_id), 'person', score, *box)
+            for i, (box, score, class_id) in enumerate(zip(np.asarray(result.persons.boxes).tolist(),
+                                                           np.asarray(result.persons.scores).tolist(),
+                                                           np.asarray(result.persons.classes).tolist()))]
+    box_id = len(rows)
+    for parent, person in enumerate(result.people):
+        for box, score, class_id in zip(np.asarray(person.ppe_frame_boxes).tolist(),
+                                        np.asarray(person.ppe.scores).tolist(),
+                                        np.asarray(person.ppe.classes).tolist()):
+            name = ppe_names[int(class_id)] if ppe_names else ''
+            rows.append((image_name, timestamp, shape[1], shape[0], box_id, parent, 'ppe', int(class_id), name,
+                         score, *box))
+            box_id += 1
+    return rows or [_image_row(image_name, shape, timestamp)]
+
+
+def _stem(image_name):
+    return os.path.splitext(os.path.basename(image_name))[0]
+
+
+class JsonlSink:
+    # One JSON record per image with its detections nested, appended to `path` in buffered batches.
+    # Reopening an existing file appends to it.
+    def __init__(self, path, buffer_images=256):
+        self.path = path
+        self.buffer_images = buffer_images
+        self.buffer = []
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(path, 'a')
+
+    def completed(self):
+        # Stems of the images already recorded (a line cut short by a crash is ignored)
+        done = set()
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    done.add(_stem(json.loads(line)['image']))
+                except (ValueError, KeyError):
+                    continue
+        return done
+
+    def write(self, rows):
+        image, timestamp, width, height = rows[0][:4]
+        detections = [{'id': r[4], 'parent': r[5], 'stage': r[6], 'class': r[7], 'name': r[8],
+                       'score': round(r[9], 5), 'box': [round(v, 2) for v in r[10:14]]} for r in rows if r[4] >= 0]
+        self.buffer.append(json.dumps({'image': image, 'timestamp': timestamp, 'width': width, 'height': height,
+                                       'detections': detections}))
+        if len(self.buffer) >= self.buffer_images:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write('\n'.join(self.buffer) + '\n')
+            self.file.flush()
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class ArrowSink:
+    # One row per box in Parquet (or Arrow IPC for .arrow paths), written one row group per
+    # `rows_per_group` buffered rows. Parquet files can't be appended to, so when `path` exists the
+    # rows go to the next free `<stem>.<n>.parquet` next to it; read them together with read_rows.
+    # A part is written as `<part>.partial` and renamed on close, so a run killed before close leaves
+    # no footerless part behind: its images are simply not completed and get processed again.
+    def __init__(self, path, rows_per_group=65536):
+        import pyarrow as pa
+        self.pa = pa
+        self.ipc = path.endswith('.arrow')
+        self.base = path
+        self.rows_per_group = rows_per_group
+        self.schema = pa.schema([('image', pa.string()), ('timestamp', pa.float64()), ('width', pa.int32()),
+                                 ('height', pa.int32()), ('box_id', pa.int32()), ('parent_id', pa.int32()),
+                                 ('stage', pa.dictionary(pa.int8(), pa.string())), ('class_id', pa.int16()),
+                                 ('class_name', pa.dictionary(pa.int16(), pa.string())), ('score', pa.float32()),
+                                 ('x1', pa.float32()), ('y1', pa.float32()), ('x2', pa.float32()),
+                                 ('y2', pa.float32())])
+        self.path = path
+        stem, ext = os.path.splitext(path)
+        n = 1
+        while os.path.exists(self.path):
+            self.path = f'{stem}.{n}{ext}'
+            n += 1
+        self.partial_path = self.path + '.partial'
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.writer = None
+        self.rows = []
+
+    def completed(self):
+        return {_stem(name) for name in read_rows(self.base, columns=['image'])['image']}
+
+    def write(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.rows_per_group:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        columns = list(zip(*self.rows))
+        table = self.pa.Table.from_arrays([self.pa.array(list(c)).cast(f.type) if f.name in ('stage', 'class_name')
+                                           else self.pa.array(c, f.type) for c, f in zip(columns, self.schema)],
+                                          schema=self.schema)
+        if self.writer is None:
+            if self.ipc:
+                self.writer = self.pa.ipc.new_file(self.partial_path, self.schema)
+            else:
+                import pyarrow.parquet as pq
+                self.writer = pq.ParquetWriter(self.partial_path, self.schema, compression='zstd')
+        self.writer.write_table(table)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            os.replace(self.partial_path, self.path)
+            self.writer = None
+
+
+class YoloTxtSink:
+    # A YOLO label file per image ("class xc yc w h conf", normalised), for the rows of `stages`
+    # (all rows by default). Images without boxes get an empty file.
+    def __init__(self, label_dir, stages=None):
+        self.label_dir = label_dir
+        self.stages = stages
+        os.makedirs(label_dir, exist_ok=True)
+
+    def completed(self):
+        return {os.path.splitext(name)[0] for name in os.listdir(self.label_dir) if name.endswith('.txt')}
+
+    def write(self, rows):
+        lines = []
+        for r in rows:
+            if r[4] < 0 or (self.stages and r[6] not in self.stages):
+                continue
+            w, h = r[2], r[3]
+            x1, y1, x2, y2 = r[10:14]
+            lines.append(f"{r[7]} {(x1 + x2) / 2 / w:.6f} {(y1 + y2) / 2 / h:.6f} "
+                         f"{(x2 - x1) / w:.6f} {(y2 - y1) / h:.6f} {r[9]:.4f}\n")
+        with open(os.path.join(self.label_dir, _stem(rows[0][0]) + '.txt'), 'w') as f:
+            f.writelines(lines)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def open_sink(spec, stages=None):
+    # 'results.jsonl', 'results.parquet', 'results.arrow', or 'yolo:<label_dir>'
+    if spec.startswith('yolo:'):
+        return YoloTxtSink(spec[len('yolo:'):], stages)
+    if spec.endswith('.jsonl'):
+        return JsonlSink(spec)
+    if spec.endswith(('.parquet', '.arrow')):
+        return ArrowSink(spec)
+    raise ValueError(f"Unknown sink '{spec}', expected .jsonl, .parquet, .arrow or yolo:<dir>")
+
+
+def read_rows(path, columns=None):
+    # Columns (dict of NumPy arrays) of every row written to a sink path, including the numbered parts
+    # of a Parquet/Arrow sink. No image is touched.
+    columns = list(columns or COLUMNS)
+    if path.endswith('.jsonl'):
+        rows = []
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                base = (record['image'], record['timestamp'], record['width'], record['height'])
+                for d in record['detections'] or [None]:
+                    rows.append(_image_row(record['image'], (base[3], base[2]), base[1]) if d is None else
+                                base + (d['id'], d['parent'], d['stage'], d['class'], d['name'], d['score'],
+                                        *d['box']))
+        data = dict(zip(COLUMNS, (np.array(c) for c in zip(*rows)))) if rows else {c: np.array([]) for c in COLUMNS}
+        return {c: data[c] for c in columns}
+
+    stem, ext = os.path.splitext(path)
+    paths = sorted(p for p in [path] + glob.glob(f'{glob.escape(stem)}.*{ext}') if os.path.exists(p))
+    if not paths:
+        return {c: np.array([]) for c in columns}
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    tables = []
+    for p in paths:
+        # A part cut short by a crash (no footer) is skipped; its images count as not processed
+        try:
+            tables.append(pa.ipc.open_file(p).read_all().select(columns) if ext == '.arrow' else
+                          pq.read_table(p, columns=columns))
+        except (pa.ArrowInvalid, OSError) as e:
+            print(f"Warning: skipping unreadable results part {p}: {e}")
+    if not tables:
+        return {c: np.array([]) for c in columns}
+    table = pa.concat_tables(tables)
+    return {c: table.column(c).to_numpy(zero_copy_only=False) for c in columns}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarise detections recorded by a results sink.')
+    parser.add_argument('path', type=str, help='A .jsonl, .parquet or .arrow results file.')
+    args = parser.parse_args()
+
+    rows = read_rows(args.path, ['image', 'box_id', 'stage', 'class_name'])
+    boxes = rows['box_id'] >= 0
+    print(f"{len(np.unique(rows['image']))} images, {int(boxes.sum())} boxes")
+    names, counts = np.unique(np.char.add(np.char.add(rows['stage'][boxes].astype(str), ':'),
+                                          rows['class_name'][boxes].astype(str)), return_counts=True)
+    for name, count in zip(names, counts):
+        print(f'  {name}: {count}')
+
+
+if __name__ == '__main__':
+    main()
+
+# python sinks.py detections.parquet
+# python sinks.py detections.jsonl
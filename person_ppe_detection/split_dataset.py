@@ -1,40 +1,221 @@
 import os
-import shutil
-from sklearn.model_selection import train_test_split
+import re
+import json
 import argparse
+import numpy as np
 
-def split_dataset(images_dir, annotations_dir, output_dir, test_size=0.2):  # get all image files
+from annotation_index import AnnotationIndex
+from shards import PackedDataset, is_packed
+from staging import LINK_MODES, stage_files, write_list_file
 
-    image_files = [f for f in os.listdir(images_dir) if os.path.isfile(os.path.join(images_dir, f))]
+# Derived files share the id of the image they came from: f_005000.jpg (flip from data_augmentation.py),
+# 005000_p1.jpg (person crop from crop_images.py) and f_005000_p2.jpg all belong to 005000
+SOURCE_ID_PATTERN = re.compile(r'^(?:f_)*(?P<id>.+?)(?:_p\d+)?$')
 
-    train_files, test_files = train_test_split(image_files, test_size=test_size, random_state=42) # Split into train and test
 
-    os.makedirs(os.path.join(output_dir, 'train', 'images'), exist_ok=True)
-    os.makedirs(os.path.join(output_dir, 'train', 'labels'), exist_ok=True)
-    os.makedirs(os.path.join(output_dir, 'test', 'images'), exist_ok=True)
-    os.makedirs(os.path.join(output_dir, 'test', 'labels'), exist_ok=True)
+def source_id(file_name):
+    return SOURCE_ID_PATTERN.match(os.path.splitext(file_name)[0]).group('id')
 
-    for file_name in train_files:  # copy train files
-        shutil.copy(os.path.join(images_dir, file_name), os.path.join(output_dir, 'train', 'images', file_name))
-        annotation_file = os.path.splitext(file_name)[0] + ".txt"
-        if os.path.exists(os.path.join(annotations_dir, annotation_file)):
-            shutil.copy(os.path.join(annotations_dir, annotation_file), os.path.join(output_dir, 'train', 'labels', annotation_file))
 
-    for file_name in test_files:  # copy test files
-        shutil.copy(os.path.join(images_dir, file_name), os.path.join(output_dir, 'test', 'images', file_name))
-        annotation_file = os.path.splitext(file_name)[0] + ".txt"
-        if os.path.exists(os.path.join(annotations_dir, annotation_file)):
-            shutil.copy(os.path.join(annotations_dir, annotation_file), os.path.join(output_dir, 'test', 'labels', annotation_file))
+def group_class_counts(image_files, index, aliases=None):
+    # Group image files by source id and sum the per-class box counts of every group. aliases maps source
+    # ids onto the one of another group to merge them (e.g. near-duplicates kept by dedup.py).
+    aliases = aliases or {}
+    file_counts = index.file_class_counts()
+    row_of_stem = {os.path.splitext(name)[0]: i for i, name in enumerate(index.names.tolist())}
+
+    group_of_id = {}
+    groups = np.empty(len(image_files), dtype=np.int64)
+    rows = np.full(len(image_files), -1, dtype=np.int64)
+    for i, file_name in enumerate(image_files):
+        key = source_id(file_name)
+        groups[i] = group_of_id.setdefault(aliases.get(key, key), len(group_of_id))
+        rows[i] = row_of_stem.get(os.path.splitext(file_name)[0], -1)
+
+    counts = np.zeros((len(group_of_id), file_counts.shape[1]), dtype=np.int64)
+    labelled = rows >= 0
+    np.add.at(counts, groups[labelled], file_counts[rows[labelled]])
+    sizes = np.bincount(groups, minlength=len(group_of_id))
+    return groups, counts, sizes
+
+
+def assign_groups(counts, sizes, fractions, seed=42):
+    # Iterative stratification over groups. Groups are ordered by the rarest class they contain (rarest
+    # first, random within ties) and then assigned in one pass, each to the split that is furthest behind
+    # its target share of that rarest class. The share of images breaks ties and places unlabelled groups.
+    fractions = np.asarray(fractions, dtype=np.float64)
+    num_groups = len(counts)
+    totals = counts.sum(axis=0)
+    weights = 1.0 / np.maximum(totals, 1)
+    desired = fractions[:, None] * totals[None, :]
+    desired_images = fractions * sizes.sum()
+    total_images = max(sizes.sum(), 1)
+
+    never = np.iinfo(np.int64).max  # groups without labels go last
+    masked_totals = np.where(counts > 0, totals[None, :], never)
+    rarest = masked_totals.argmin(axis=1) if counts.shape[1] else np.zeros(num_groups, dtype=np.int64)
+    rarity = masked_totals.min(axis=1, initial=never)
+    rng = np.random.default_rng(seed)
+    order = np.lexsort((rng.random(num_groups), rarity))
+
+    assigned = np.zeros_like(desired)
+    assigned_images = np.zeros(len(fractions))
+    split_of_group = np.empty(num_groups, dtype=np.int64)
+    for g in order:
+        deficit = 1e-3 * (desired_images - assigned_images) / total_images
+        if rarity[g] != never:
+            c = rarest[g]
+            deficit = deficit + (desired[:, c] - assigned[:, c]) * weights[c]
+        s = int(np.argmax(deficit))
+        split_of_group[g] = s
+        assigned[s] += counts[g]
+        assigned_images[s] += sizes[g]
+    return split_of_group
+
+
+def split_report(split_names, split_of_group, counts, sizes, class_names=None):
+    report = {}
+    for s, name in enumerate(split_names):
+        mask = split_of_group == s
+        per_class = counts[mask].sum(axis=0)
+        labels = class_names or [str(c) for c in range(len(per_class))]
+        report[name] = {'groups': int(mask.sum()), 'images': int(sizes[mask].sum()),
+                        'classes': {label: int(n) for label, n in zip(labels, per_class)}}
+    return report
+
+
+def print_report(report):
+    split_names = list(report)
+    class_names = list(report[split_names[0]]['classes'])
+    print(f"{'':<16}" + ''.join(f"{name:>12}" for name in split_names))
+    for key in ('groups', 'images'):
+        print(f"{key:<16}" + ''.join(f"{report[name][key]:>12}" for name in split_names))
+    for class_name in class_names:
+        print(f"{class_name:<16}" + ''.join(f"{report[name]['classes'][class_name]:>12}" for name in split_names))
+
+
+def split_dataset(images_dir, annotations_dir, output_dir, test_size=0.2, val_size=0.0, folds=0, seed=42,
+                  classes_file=None, link_mode='auto', list_only=False, workers=8,
+                  dedup_manifest=None):  # get all image files
+
+    # A packed dataset (shards.py) is its own annotation index, and its splits are written as packed datasets
+    packed = PackedDataset(images_dir) if is_packed(images_dir) else None
+    if packed is not None:
+        if folds or list_only:
+            raise ValueError('--folds and --list_only need an image directory, not a packed dataset')
+        image_files = sorted(packed.image_names())
+        index = packed
+    else:
+        image_files = sorted(f for f in os.listdir(images_dir) if os.path.isfile(os.path.join(images_dir, f)))
+        index = AnnotationIndex.load(annotations_dir)
+    class_names = None
+    if classes_file:
+        with open(classes_file, 'r') as f:
+            class_names = [line.strip() for line in f.readlines()]
+
+    # Near-duplicates (dedup.py) are left out, along with their flips and crops; the ones kept because
+    # their labels disagree share a group so they can't leak across splits
+    aliases = None
+    if dedup_manifest:
+        from dedup import is_dropped, load_manifest
+        dropped, aliases = load_manifest(dedup_manifest)
+        kept = [f for f in image_files if not is_dropped(f, dropped)]
+        print(f"Leaving out {len(image_files) - len(kept)} near-duplicate images listed in {dedup_manifest}")
+        image_files = kept
+
+    groups, counts, sizes = group_class_counts(image_files, index, aliases)
+    if class_names and counts.shape[1] < len(class_names):
+        counts = np.pad(counts, ((0, 0), (0, len(class_names) - counts.shape[1])))
+
+    if folds:
+        split_names = [f'fold_{k}' for k in range(folds)]
+        fractions = [1.0 / folds] * folds
+    else:
+        split_names = ['train', 'val', 'test'] if val_size else ['train', 'test']
+        fractions = [1.0 - test_size - val_size, val_size, test_size] if val_size else [1.0 - test_size, test_size]
+
+    split_of_group = assign_groups(counts, sizes, fractions, seed)
+    split_of_file = split_of_group[groups]
+    files_by_split = {name: [f for f, s in zip(image_files, split_of_file) if s == k]
+                      for k, name in enumerate(split_names)}
+
+    os.makedirs(output_dir, exist_ok=True)
+    report = split_report(split_names, split_of_group, counts, sizes, class_names)
+    with open(os.path.join(output_dir, 'split_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    print_report(report)
+
+    if folds:
+        # Folds are always list files: materialising k copies of the dataset defeats the purpose
+        for k, name in enumerate(split_names):
+            val_files = files_by_split[name]
+            train_files = [f for other in split_names if other != name for f in files_by_split[other]]
+            write_list_file([os.path.join(images_dir, f) for f in train_files],
+                            os.path.join(output_dir, name, 'train.txt'))
+            write_list_file([os.path.join(images_dir, f) for f in val_files],
+                            os.path.join(output_dir, name, 'val.txt'))
+        return files_by_split
+
+    if list_only:
+        # Reference the original images instead of materialising the split
+        for name, files in files_by_split.items():
+            write_list_file([os.path.join(images_dir, f) for f in files], os.path.join(output_dir, f'{name}.txt'))
+        return files_by_split
+
+    if packed is not None:
+        for split, files in files_by_split.items():
+            writer = packed.write_subset(os.path.join(output_dir, split), files)
+            print(f"{split}: packed {writer.images} images into {len(writer.shards)} shards")
+        return files_by_split
+
+    image_pairs, label_pairs = [], []
+    for split, files in files_by_split.items():
+        os.makedirs(os.path.join(output_dir, split, 'images'), exist_ok=True)
+        os.makedirs(os.path.join(output_dir, split, 'labels'), exist_ok=True)
+
+        for file_name in files:
+            image_pairs.append((os.path.join(images_dir, file_name),
+                                os.path.join(output_dir, split, 'images', file_name)))
+            annotation_file = os.path.splitext(file_name)[0] + ".txt"
+            if os.path.exists(os.path.join(annotations_dir, annotation_file)):
+                label_pairs.append((os.path.join(annotations_dir, annotation_file),
+                                    os.path.join(output_dir, split, 'labels', annotation_file)))
+
+    # Images are linked where possible; labels are always real copies because later steps
+    # (e.g. imbalance_correction.py) rewrite them in place, which would also change a linked original
+    staging_report = stage_files(image_pairs, link_mode, workers)
+    staging_report.update(stage_files(label_pairs, 'copy', workers))
+    print(staging_report.summary())
+    return files_by_split
+
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Split dataset into train and test sets.")
-    parser.add_argument("images_dir", help="Directory containing images.")
-    parser.add_argument("annotations_dir", help="Directory containing annotations.")
+    parser = argparse.ArgumentParser(
+        description="Split dataset into stratified train/val/test sets or folds, keeping derived files together.")
+    parser.add_argument("images_dir", help="Directory containing images, or a packed dataset (shards.py).")
+    parser.add_argument("annotations_dir", help="Directory containing annotations (unused for a packed dataset).")
     parser.add_argument("output_dir", help="Directory to save split datasets.")
     parser.add_argument("--test_size", type=float, default=0.2, help="Test split size.")
+    parser.add_argument("--val_size", type=float, default=0.0, help="Optional validation split size.")
+    parser.add_argument("--folds", type=int, default=0, help="Write k-fold list files instead of a single split.")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed.")
+    parser.add_argument("--classes_file", type=str, default=None, help="Class names for the split report.")
+    parser.add_argument("--link_mode", choices=LINK_MODES, default='auto',
+                        help="How to materialise split images: reflink/hardlink with copy fallback (auto), "
+                             "a single method, or plain copies.")
+    parser.add_argument("--list_only", action='store_true',
+                        help="Only write train.txt/test.txt listing the original images (labels must sit in a "
+                             "sibling 'labels' directory, as ultralytics expects).")
+    parser.add_argument("--workers", type=int, default=8, help="Parallel copies when a copy is unavoidable.")
+    parser.add_argument("--dedup", type=str, default=None,
+                        help="Manifest from dedup.py: leave out the near-duplicates it drops.")
     args = parser.parse_args()
 
-    split_dataset(args.images_dir, args.annotations_dir, args.output_dir, args.test_size)
+    split_dataset(args.images_dir, args.annotations_dir, args.output_dir, args.test_size, args.val_size, args.folds,
+                  args.seed, args.classes_file, args.link_mode, args.list_only, args.workers, args.dedup)
 
 # python split_dataset.py augmented_data/images augmented_data/labels person_dataset
-# python split_dataset.py augmented_data/cropped/aug_crop_data/images augmented_data/cropped/aug_crop_data/labels ppe_dataset
+# python split_dataset.py augmented_data/cropped/aug_crop_data/images augmented_data/cropped/aug_crop_data/labels ppe_dataset --classes_file cropped_classes.txt
+# python split_dataset.py augmented_data/images augmented_data/labels person_folds --folds 5
+# python split_dataset.py augmented_data/packed - person_dataset_packed
+# python split_dataset.py augmented_data/images augmented_data/labels person_dataset --dedup dedup_manifest.json
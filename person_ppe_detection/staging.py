@@ -0,0 +1,127 @@
+import os
+import shutil
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+LINK_MODES = ('auto', 'reflink', 'hardlink', 'symlink', 'copy')
+
+FICLONE = 0x40049409  # Linux ioctl to share extents between files (btrfs, XFS, overlayfs on those)
+
+
+def reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+
+
+def _is_source(src, dst):
+    # dst is the very file src resolves to (not just another link to the same data), so removing it
+    # would remove the only copy. An existing symlink or hardlink at dst is safe to replace.
+    return (os.path.exists(dst) and not os.path.islink(dst) and os.path.samefile(src, dst)
+            and os.path.realpath(src) == os.path.realpath(dst))
+
+
+def _replace_existing(dst):
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+
+def stage_file(src, dst, mode='auto'):
+    # Materialise src at dst without copying bytes where possible. Returns the method used.
+    # 'auto' tries a reflink, then a hardlink, then falls back to a real copy (e.g. across filesystems).
+    if _is_source(src, dst):
+        raise shutil.SameFileError(f"{src!r} and {dst!r} are the same file")
+    _replace_existing(dst)
+    if mode == 'copy':
+        shutil.copy(src, dst)
+        return 'copy'
+    if mode == 'symlink':
+        os.symlink(os.path.abspath(src), dst)
+        return 'symlink'
+
+    attempts = ('reflink', 'hardlink') if mode == 'auto' else (mode,)
+    for method in attempts:
+        try:
+            if method == 'reflink':
+                reflink(src, dst)
+            else:
+                os.link(src, dst)
+            return method
+        except (OSError, ImportError):
+            # Not supported here (other filesystem, no reflink support, ...): try the next method
+            _replace_existing(dst)
+    shutil.copy(src, dst)
+    return 'copy'
+
+
+class StagingReport:
+    def __init__(self):
+        self.methods = Counter()
+        self.bytes_saved = 0
+        self.bytes_copied = 0
+
+    def add(self, method, size):
+        self.methods[method] += 1
+        if method == 'copy':
+            self.bytes_copied += size
+        else:
+            self.bytes_saved += size
+
+    def update(self, other):
+        self.methods.update(other.methods)
+        self.bytes_saved += other.bytes_saved
+        self.bytes_copied += other.bytes_copied
+
+    def summary(self):
+        methods = ', '.join(f"{count} {method}" for method, count in sorted(self.methods.items()))
+        return (f"Staged {sum(self.methods.values())} files ({methods or 'none'}): "
+                f"{self.bytes_saved / 1e6:.1f} MB saved, {self.bytes_copied / 1e6:.1f} MB copied")
+
+
+def stage_files(pairs, mode='auto', workers=8):
+    # Stage (src, dst) pairs in parallel; real copies are I/O bound so threads overlap them well
+    report = StagingReport()
+
+    def stage(pair):
+        src, dst = pair
+        return stage_file(src, dst, mode), os.path.getsize(src)
+
+    with ThreadPoolExecutor(workers) as pool:
+        for method, size in pool.map(stage, pairs):
+            report.add(method, size)
+    return report
+
+
+def write_list_file(paths, list_path):
+    # YOLO-style list file: one absolute image path per line, the labels are found next to the images
+    # by ultralytics (images/ -> labels/), so nothing needs to be copied
+    os.makedirs(os.path.dirname(os.path.abspath(list_path)), exist_ok=True)
+    with open(list_path, 'w') as f:
+        for path in paths:
+            f.write(os.path.abspath(path) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stage a directory with hardlinks, reflinks or symlinks.')
+    parser.add_argument('src_dir', type=str, help='Directory to stage.')
+    parser.add_argument('dst_dir', type=str, help='Destination directory.')
+    parser.add_argument('--link_mode', choices=LINK_MODES, default='auto', help='How to materialise files.')
+    parser.add_argument('--workers', type=int, default=8, help='Parallel copies when a copy is unavoidable.')
+    args = parser.parse_args()
+
+    os.makedirs(args.dst_dir, exist_ok=True)
+    pairs = [(os.path.join(args.src_dir, f), os.path.join(args.dst_dir, f)) for f in os.listdir(args.src_dir)
+             if os.path.isfile(os.path.join(args.src_dir, f))]
+    print(stage_files(pairs, args.link_mode, args.workers).summary())
+
+
+if __name__ == '__main__':
+    main()
+
+# python staging.py augmented_data/images person_dataset/all_images --link_mode hardlink
@@ -0,0 +1,316 @@
+import os
+import time
+import queue
+import argparse
+import threading
+
+import cv2
+import numpy as np
+
+from two_stage import TwoStagePipeline, StubDetector, draw_result
+from sinks import open_sink, result_rows
+
+DROP_POLICIES = ('block', 'latest', 'every_nth')
+
+_DONE = object()  # end-of-stream marker passed down the queues
+
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.processed = 0
+        self.dropped = 0
+        self.busy = 0.0
+        self.started = None
+        self.finished = None
+
+    def fps(self):
+        # Throughput over the stage's wall-clock lifetime
+        if not self.processed or self.started is None:
+            return 0.0
+        return self.processed / max((self.finished or time.perf_counter()) - self.started, 1e-9)
+
+    def ms_per_frame(self):
+        return 1000 * self.busy / self.processed if self.processed else 0.0
+
+
+class StreamReport:
+    def __init__(self, stages, latencies, elapsed):
+        self.stages = stages
+        self.latencies = np.asarray(latencies, dtype=np.float64)
+        self.elapsed = elapsed
+
+    def fps(self):
+        return len(self.latencies) / self.elapsed if self.elapsed else 0.0
+
+    def latency_ms(self, percentile):
+        return float(np.percentile(self.latencies, percentile) * 1000) if len(self.latencies) else 0.0
+
+    def summary(self):
+        lines = [f"{'stage':<10} {'frames':>7} {'dropped':>8} {'fps':>8} {'ms/frame':>9}"]
+        for s in self.stages:
+            lines.append(f"{s.name:<10} {s.processed:>7} {s.dropped:>8} {s.fps():>8.1f} {s.ms_per_frame():>9.1f}")
+        lines.append(f"end-to-end: {len(self.latencies)} frames, {self.fps():.1f} fps, latency "
+                     f"p50 {self.latency_ms(50):.1f} ms, p95 {self.latency_ms(95):.1f} ms, "
+                     f"max {self.latency_ms(100):.1f} ms")
+        return '\n'.join(lines)
+
+
+def video_frames(source):
+    # Yield frames from a video file, camera index or RTSP url
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise IOError(f"Cannot open video source: {source}")
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            yield frame
+    finally:
+        capture.release()
+
+
+def video_fps(source, default=25.0):
+    capture = cv2.VideoCapture(source)
+    fps = capture.get(cv2.CAP_PROP_FPS) if capture.isOpened() else 0
+    capture.release()
+    return fps if fps and fps > 0 else default
+
+
+class StreamPipeline:
+    # decode -> person -> ppe -> encode, each in its own thread, connected by bounded queues.
+    # With drop_policy 'block' a slow stage stalls the decoder (backpressure); 'latest' keeps only
+    # the newest undetected frame so the detector always works on the most recent one; 'every_nth'
+    # forwards every nth decoded frame.
+    def __init__(self, pipeline, ppe_names, queue_size=4, drop_policy='block', every_nth=1,
+                 pace_fps=None, writer=None, on_frame=None, encode_ext='.jpg', sink=None, render_every=1,
+                 source_name='frame'):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy '{drop_policy}', expected one of {DROP_POLICIES}")
+        self.pipeline = pipeline
+        self.ppe_names = ppe_names
+        self.queue_size = queue_size
+        self.drop_policy = drop_policy
+        self.every_nth = max(every_nth, 1)
+        self.pace_fps = pace_fps
+        self.writer = writer
+        self.on_frame = on_frame
+        self.encode_ext = encode_ext
+        self.sink = sink  # a sinks.py sink recording every frame's detections
+        self.render_every = render_every  # frames drawn and encoded when there is no video writer (0: none)
+        self.source_name = source_name
+
+    def _put(self, q, item, stop):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _put_latest(self, q, item):
+        # Replace whatever is waiting in the queue with the newest frame, returns the number of frames replaced
+        replaced = 0
+        while True:
+            try:
+                q.put_nowait(item)
+                return replaced
+            except queue.Full:
+                try:
+                    q.get_nowait()
+                    replaced += 1
+                except queue.Empty:
+                    pass
+
+    def _decode(self, frames, out_q, stats, stop, errors):
+        stats.started = time.perf_counter()
+        interval = 1.0 / self.pace_fps if self.pace_fps else 0.0
+        next_due = time.perf_counter()
+        index = 0
+        try:
+            frames = iter(frames)
+        except TypeError as e:
+            errors.append(e)
+            frames = iter(())
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                frame = next(frames, None)
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+                break
+            if frame is None:
+                break
+            stats.busy += time.perf_counter() - start
+            captured = time.perf_counter()
+
+            item = (index, captured, frame)
+            if self.drop_policy == 'every_nth' and index % self.every_nth:
+                stats.dropped += 1
+            elif self.drop_policy == 'latest':
+                # A frame replaced before the person stage picked it up was never processed
+                replaced = self._put_latest(out_q, item)
+                stats.processed += 1 - replaced
+                stats.dropped += replaced
+            else:
+                stats.processed += 1
+                if not self._put(out_q, item, stop):
+                    break
+            index += 1
+
+            if interval:
+                # Emulate a live camera: frames arrive on the clock whether or not we keep up
+                next_due += interval
+                time.sleep(max(next_due - time.perf_counter(), 0))
+        self._put(out_q, _DONE, stop)
+        stats.finished = time.perf_counter()
+
+    def _stage(self, work, in_q, out_q, stats, stop, errors):
+        stats.started = time.perf_counter()
+        try:
+            while not stop.is_set():
+                try:
+                    item = in_q.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is _DONE:
+                    break
+                start = time.perf_counter()
+                item = work(item)
+                stats.busy += time.perf_counter() - start
+                stats.processed += 1
+                if out_q is not None and not self._put(out_q, item, stop):
+                    break
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        if out_q is not None:
+            self._put(out_q, _DONE, stop)
+        stats.finished = time.perf_counter()
+
+    def run(self, frames):
+        stats = [StageStats(name) for name in ('decode', 'person', 'ppe', 'encode')]
+        queues = [queue.Queue(maxsize=1 if self.drop_policy == 'latest' else self.queue_size)]
+        queues += [queue.Queue(maxsize=self.queue_size) for _ in range(2)]
+        latencies = []
+        errors = []
+        stop = threading.Event()
+
+        def person(item):
+            index, captured, frame = item
+            return index, captured, frame, self.pipeline.detect_persons(frame)
+
+        def ppe(item):
+            index, captured, frame, persons = item
+            return index, captured, frame, self.pipeline.attach_ppe(frame, persons)
+
+        def encode(item):
+            index, captured, frame, result = item
+            if self.sink is not None:
+                self.sink.write(result_rows(f'{self.source_name}_{index:08d}', frame.shape, result, self.ppe_names))
+            encoded = None
+            if self.writer is not None:
+                self.writer.write(draw_result(frame.copy(), result, self.ppe_names))
+            elif self.render_every and index % self.render_every == 0:
+                encoded = cv2.imencode(self.encode_ext, draw_result(frame.copy(), result, self.ppe_names))[1]
+            latencies.append(time.perf_counter() - captured)
+            if self.on_frame is not None:
+                self.on_frame(index, result, encoded)
+
+        threads = [threading.Thread(target=self._decode, args=(frames, queues[0], stats[0], stop, errors), daemon=True)]
+        for work, in_q, out_q, s in ((person, queues[0], queues[1], stats[1]),
+                                     (ppe, queues[1], queues[2], stats[2]),
+                                     (encode, queues[2], None, stats[3])):
+            threads.append(threading.Thread(target=self._stage, args=(work, in_q, out_q, s, stop, errors), daemon=True))
+
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        try:
+            for t in threads:
+                while t.is_alive():
+                    t.join(timeout=0.1)
+        except KeyboardInterrupt:
+            stop.set()
+        elapsed = time.perf_counter() - start
+
+        if errors:
+            raise errors[0]
+        return StreamReport(stats, latencies, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run person + PPE detection on a video file or stream.')
+    parser.add_argument('source', type=str, help='Video file, RTSP url or camera index.')
+    parser.add_argument('--output', type=str, default=None, help='Optional annotated output video (.mp4).')
+    parser.add_argument('--person_weights', type=str, default='person_detection.pt',
+                        help='Person model: .pt weights, .onnx file or OpenVINO model directory.')
+    parser.add_argument('--ppe_weights', type=str, default='ppe_detection.pt',
+                        help='PPE model: .pt weights, .onnx file or OpenVINO model directory.')
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads per model (default: runtime default).')
+    parser.add_argument('--stub', action='store_true', help='Use stub detectors instead of YOLO models.')
+    parser.add_argument('--queue_size', type=int, default=4, help='Capacity of each inter-stage queue.')
+    parser.add_argument('--drop_policy', choices=DROP_POLICIES, default='block',
+                        help='What to do when inference falls behind (default: block).')
+    parser.add_argument('--every_nth', type=int, default=1, help='Frame stride for the every_nth policy.')
+    parser.add_argument('--realtime', action='store_true',
+                        help='Pace a video file at its native FPS, as a live camera would deliver it.')
+    parser.add_argument('--max_batch_size', type=int, default=32, help='Maximum person crops per PPE pass.')
+    parser.add_argument('--sink', type=str, default=None,
+                        help='Record every frame\'s detections to a .jsonl, .parquet or .arrow file.')
+    parser.add_argument('--track', action='store_true',
+                        help='Track persons and reuse their PPE results across frames (see tracker.py).')
+    parser.add_argument('--refresh_interval', type=int, default=15,
+                        help='With --track, frames a person\'s PPE result is reused at most.')
+    args = parser.parse_args()
+
+    source = int(args.source) if args.source.isdigit() else args.source
+
+    if args.stub:
+        person_detector = StubDetector(boxes_per_image=5, latency=0.02)
+        ppe_detector = StubDetector(boxes_per_image=3, num_classes=9, latency=0.01, per_image_latency=0.002)
+    else:
+        from backends import load_detector
+        person_detector = load_detector(args.person_weights, threads=args.threads)
+        ppe_detector = load_detector(args.ppe_weights, threads=args.threads)
+    pipeline = TwoStagePipeline(person_detector, ppe_detector, max_batch_size=args.max_batch_size)
+    if args.track:
+        from tracker import TrackedPipeline
+        pipeline = TrackedPipeline(pipeline, refresh_interval=args.refresh_interval)
+
+    fps = video_fps(source)
+    writer = None
+    if args.output:
+        capture = cv2.VideoCapture(source)
+        size = (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        capture.release()
+        out_fps = fps / args.every_nth if args.drop_policy == 'every_nth' else fps
+        writer = cv2.VideoWriter(args.output, cv2.VideoWriter_fourcc(*'mp4v'), out_fps, size)
+
+    sink = open_sink(args.sink) if args.sink else None
+    stream = StreamPipeline(pipeline, ppe_detector.names, queue_size=args.queue_size,
+                            drop_policy=args.drop_policy, every_nth=args.every_nth,
+                            pace_fps=fps if args.realtime else None, writer=writer, sink=sink,
+                            render_every=1 if args.output else 0, source_name=os.path.splitext(os.path.basename(str(source)))[0])
+    report = stream.run(video_frames(source))
+    if writer is not None:
+        writer.release()
+    if sink is not None:
+        sink.close()
+    print(report.summary())
+    if args.track:
+        stats = pipeline.stats()
+        print(f"tracking: PPE run on {stats['ppe_runs']} of {stats['crops']} person crops ({stats['saved']:.1%} saved)")
+
+
+if __name__ == '__main__':
+    main()
+
+# python stream.py site_camera.mp4 --output annotated.mp4
+# python stream.py rtsp://camera/stream --drop_policy latest --sink camera1_2024-05-02.parquet
+# python stream.py rtsp://camera/stream --drop_policy latest
+# python stream.py rtsp://camera/stream --drop_policy latest --track --refresh_interval 30
+# python stream.py site_camera.mp4 --stub --realtime --drop_policy every_nth --every_nth 3
@@ -0,0 +1,94 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from annotation_index import AnnotationIndex, load_npz_mmap, malformed_lines, parse_label_text
+
+
+def test_parse_label_text():
+    class_ids, boxes, bad_lines = parse_label_text("0 0.5 0.5 0.1 0.2\n\n3 0.25 0.75 0.5 0.5\n")
+    assert class_ids.tolist() == [0, 3]
+    np.testing.assert_allclose(boxes, [[0.5, 0.5, 0.1, 0.2], [0.25, 0.75, 0.5, 0.5]])
+    assert bad_lines == 0
+
+
+def test_parse_label_text_mixed_column_counts():
+    # 4 + 6 tokens add up to 2 * 5, which must not be reshaped into two boxes
+    class_ids, boxes, bad_lines = parse_label_text("0 0.5 0.5 0.1\n0 1 0.5 0.1 0.2 0.9\n1 0.5 0.5 0.2 0.2\n")
+    assert class_ids.tolist() == [1]
+    np.testing.assert_allclose(boxes, [[0.5, 0.5, 0.2, 0.2]])
+    assert bad_lines == 2
+
+
+def test_parse_label_text_non_numeric():
+    class_ids, boxes, bad_lines = parse_label_text("x 0.5 0.5 0.1 0.2\n2 0.5 0.5 0.1 0.2\n")
+    assert class_ids.tolist() == [2]
+    assert bad_lines == 1
+
+
+def test_malformed_lines():
+    assert malformed_lines("0 0.5 0.5 0.1\n\n0 1 0.5 0.1 0.2 0.9\nx 1 1 1 1\n0 1 1 1 1\n") == [
+        (1, '4 columns, expected 5'), (3, '6 columns, expected 5'), (4, 'non-numeric value')]
+
+
+def test_index_matches_parser(tmp_path):
+    labels = tmp_path / 'labels'
+    labels.mkdir()
+    (labels / 'a.txt').write_text("0 0.5 0.5 0.1\n0 1 0.5 0.1 0.2 0.9\n")
+    (labels / 'b.txt').write_text("1 0.1 0.2 0.3 0.4\n2 0.5 0.5 0.5 0.5\n")
+    index = AnnotationIndex.load(str(labels))
+    assert index.names.tolist() == ['a.txt', 'b.txt']
+    assert index.bad_lines.tolist() == [2, 0]
+    assert index.class_ids.tolist() == [1, 2]
+    assert index.image_ids.tolist() == [1, 1]
+
+
+def test_index_cache_roundtrip(tmp_path):
+    labels = tmp_path / 'labels'
+    labels.mkdir()
+    (labels / 'a.txt').write_text("0 0.5 0.5 0.1 0.1\n")
+    AnnotationIndex.load(str(labels))
+    assert os.listdir(tmp_path / '.labels.index') == ['index.npz']
+    cached = AnnotationIndex.load(str(labels))
+    assert cached.reparsed == 0 and cached.class_ids.tolist() == [0]
+    assert isinstance(cached.boxes, np.memmap) and isinstance(cached.names, np.memmap)
+    np.testing.assert_allclose(cached.boxes, [[0.5, 0.5, 0.1, 0.1]])
+
+    (labels / 'b.txt').write_text("3 0.5 0.5 0.1 0.1\n")
+    updated = AnnotationIndex.load(str(labels))
+    assert updated.reparsed == 1 and updated.class_ids.tolist() == [0, 3]
+
+
+def test_index_cache_unwritable(tmp_path):
+    labels = tmp_path / 'labels'
+    labels.mkdir()
+    (labels / 'a.txt').write_text("0 0.5 0.5 0.1 0.1\n")
+    # A file where the cache directory should be makes every save fail
+    (tmp_path / '.labels.index').write_text('')
+    assert AnnotationIndex.load(str(labels)).class_ids.tolist() == [0]
+    assert AnnotationIndex.load(str(labels)).reparsed == 1
+
+
+def test_index_concurrent_loads(tmp_path):
+    labels = tmp_path / 'labels'
+    labels.mkdir()
+    for i in range(50):
+        (labels / f'{i}.txt').write_text(f"{i % 10} 0.5 0.5 0.1 0.1\n" * (i + 1))
+    with ThreadPoolExecutor(8) as pool:
+        indexes = list(pool.map(lambda _: AnnotationIndex.load(str(labels)), range(32)))
+    assert all(len(index) == 50 * 51 // 2 for index in indexes)
+    assert os.listdir(tmp_path / '.labels.index') == ['index.npz']
+    assert AnnotationIndex.load(str(labels)).reparsed == 0
+
+
+def test_load_npz_mmap(tmp_path):
+    path = str(tmp_path / 'arrays.npz')
+    arrays = {'scalar': np.int64(7), 'empty': np.zeros((0, 4), np.float32), 'names': np.array(['a.txt', 'bb.txt']),
+              'fortran': np.asfortranarray(np.arange(12, dtype=np.int32).reshape(3, 4))}
+    np.savez(path, **arrays)
+    loaded = load_npz_mmap(path)
+    assert sorted(loaded) == sorted(arrays)
+    for name, array in arrays.items():
+        assert loaded[name].dtype == np.asarray(array).dtype
+        np.testing.assert_array_equal(loaded[name], array)
@@ -0,0 +1,17 @@
+import cv2
+import numpy as np
+
+from corrupt_files_detection import scan_images
+
+
+def test_scan_images_unwritable_cache(tmp_path, capsys):
+    images = tmp_path / 'images'
+    images.mkdir()
+    cv2.imwrite(str(images / 'good.jpg'), np.zeros((16, 16, 3), np.uint8))
+    (images / 'bad.jpg').write_bytes(b'not a jpeg')
+    # A file where the cache's directory should be makes the save fail, as on a read-only dataset
+    (tmp_path / 'blocked').write_text('')
+    results, checked = scan_images(str(images), workers=2, cache_path=str(tmp_path / 'blocked' / 'cache.json'))
+    assert checked == 2
+    assert results['good.jpg']['ok'] and not results['bad.jpg']['ok']
+    assert 'could not write the integrity cache' in capsys.readouterr().out
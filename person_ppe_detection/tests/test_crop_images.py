@@ -0,0 +1,112 @@
+import os
+
+import cv2
+import numpy as np
+
+from crop_images import adjust_bbox, adjust_bboxes, crop_dataset, process_image
+
+
+def loop_process_image(image_path, annotation_path, output_image_dir, output_label_dir, person_class_id=0):
+    # process_image as it was before adjust_bboxes: one adjust_bbox call per (person, PPE box) pair
+    image = cv2.imread(image_path)
+    h, w, _ = image.shape
+    annotations = []
+    with open(annotation_path, 'r') as f:
+        for line in f:
+            class_id, x_center, y_center, width, height = map(float, line.strip().split())
+            annotations.append([int(class_id), x_center * w, y_center * h, width * w, height * h])
+
+    person_bboxes = [ann for ann in annotations if ann[0] == person_class_id]
+    for i, person_bbox in enumerate(person_bboxes):
+        px_center, py_center, p_width, p_height = person_bbox[1:]
+        x1 = max(int(px_center - p_width / 2), 0)
+        y1 = max(int(py_center - p_height / 2), 0)
+        x2 = min(int(px_center + p_width / 2), w)
+        y2 = min(int(py_center + p_height / 2), h)
+        if x2 - x1 > 0 and y2 - y1 > 0:
+            new_annotations = []
+            for ann in annotations:
+                if ann[0] != person_class_id:
+                    adjusted_bbox = adjust_bbox(ann[1:], person_bbox[1:])
+                    if adjusted_bbox:
+                        new_annotations.append([ann[0] - 1] + adjusted_bbox)
+            if new_annotations:
+                stem = os.path.splitext(os.path.basename(image_path))[0]
+                cv2.imwrite(os.path.join(output_image_dir, f"{stem}_p{i + 1}.jpg"), image[y1:y2, x1:x2])
+                label_stem = os.path.splitext(os.path.basename(annotation_path))[0]
+                with open(os.path.join(output_label_dir, f"{label_stem}_p{i + 1}.txt"), 'w') as f:
+                    for ann in new_annotations:
+                        f.write(f"{ann[0]} {ann[1]:.6f} {ann[2]:.6f} {ann[3]:.6f} {ann[4]:.6f}\n")
+
+
+def write_fixture(directory, seed, ext='.png', label_directory=None):
+    # A noisy image with persons (some partly or fully off the image, one without PPE) and PPE boxes
+    # inside, on the border of and outside them
+    rng = np.random.default_rng(seed)
+    image_path = os.path.join(directory, f'sample{seed}{ext}')
+    cv2.imwrite(image_path, rng.integers(0, 256, (240, 320, 3), dtype=np.uint8))
+    persons = [[0.3, 0.5, 0.2, 0.8], [0.7, 0.4, 0.3, 0.6], [0.98, 0.5, 0.1, 0.5], [1.2, 0.5, 0.1, 0.2],
+               [0.1, 0.1, 0.05, 0.05]]
+    ppe = np.column_stack([rng.uniform(-0.1, 1.1, (40, 2)), rng.uniform(0.0, 0.3, (40, 2))])
+    ppe[:4] = [[0.3, 0.1, 0.05, 0.05], [0.2, 0.5, 0.02, 0.1], [0.85, 0.4, 0.01, 0.01], [0.5, 0.5, 0.0, 0.1]]
+    annotation_path = os.path.join(label_directory or directory, f'sample{seed}.txt')
+    with open(annotation_path, 'w') as f:
+        for box in persons:
+            f.write("0 " + " ".join(f"{v:.6f}" for v in box) + "\n")
+        for class_id, box in zip(rng.integers(1, 10, len(ppe)), ppe):
+            f.write(f"{class_id} " + " ".join(f"{v:.6f}" for v in box) + "\n")
+    return image_path, annotation_path
+
+
+def test_adjust_bboxes_matches_adjust_bbox():
+    rng = np.random.default_rng(0)
+    boxes = np.column_stack([rng.uniform(-50, 700, (200, 2)), rng.uniform(0, 300, (200, 2))])
+    boxes[:5, 2:] = 0
+    persons = np.column_stack([rng.uniform(0, 640, (30, 2)), rng.uniform(1, 400, (30, 2))])
+    adjusted, keep = adjust_bboxes(boxes, persons)
+    for i, person in enumerate(persons.tolist()):
+        for j, box in enumerate(boxes.tolist()):
+            expected = adjust_bbox(box, person)
+            assert keep[i, j] == (expected is not None)
+            if expected is not None:
+                assert adjusted[i, j].tolist() == expected
+
+
+def test_process_image_matches_loop(tmp_path):
+    new_dir, old_dir = tmp_path / 'new', tmp_path / 'old'
+    for d in (new_dir, old_dir):
+        (d / 'images').mkdir(parents=True)
+        (d / 'labels').mkdir()
+    for seed in range(3):
+        image_path, annotation_path = write_fixture(str(tmp_path), seed)
+        process_image(image_path, annotation_path, str(new_dir / 'images'), str(new_dir / 'labels'))
+        loop_process_image(image_path, annotation_path, str(old_dir / 'images'), str(old_dir / 'labels'))
+
+    for sub in ('images', 'labels'):
+        names = sorted(os.listdir(old_dir / sub))
+        assert names and sorted(os.listdir(new_dir / sub)) == names
+        for name in names:
+            assert (new_dir / sub / name).read_bytes() == (old_dir / sub / name).read_bytes(), name
+
+
+def test_crop_dataset_workers(tmp_path):
+    images, labels = tmp_path / 'images', tmp_path / 'labels'
+    images.mkdir()
+    labels.mkdir()
+    for seed in range(8):
+        write_fixture(str(images), seed, '.jpg', str(labels))
+    os.remove(labels / 'sample6.txt')  # missing labels
+    (images / 'sample7.jpg').write_bytes(b'not a jpeg')  # unreadable
+
+    outputs, summaries = [], []
+    for workers in (1, 2):
+        out = tmp_path / f'workers{workers}'
+        summaries.append(crop_dataset(str(images), str(labels), str(out / 'images'), str(out / 'labels'),
+                                      workers=workers))
+        outputs.append({f'{sub}/{name}': (out / sub / name).read_bytes()
+                        for sub in ('images', 'labels') for name in os.listdir(out / sub)})
+
+    assert summaries[0] == summaries[1]
+    assert summaries[0]['images'] == 8 and summaries[0]['missing_labels'] == 1
+    assert summaries[0]['unreadable_images'] == 1 and summaries[0]['crops_written'] == 16
+    assert outputs[0] == outputs[1]
@@ -0,0 +1,14 @@
+import label_correction
+
+
+def test_keeps_original_lines(tmp_path):
+    labels, output = tmp_path / 'labels', tmp_path / 'output'
+    labels.mkdir()
+    (labels / 'a.txt').write_text("0 0.5 0.5 0.1 0.2\n3 0.1 0.1 0.1 0.1\n0  0.123456789 0.2 0.3 0.4")
+    (labels / 'b.txt').write_text("2 0.1 0.1 0.1 0.1\n")
+    (labels / 'c.txt').write_text("0 0.1 0.1 0.1\nx 1 1 1 1\n")
+    label_correction.main(str(labels), 'person', ['person', 'helmet', 'vest', 'boots'], str(output))
+
+    assert (output / 'a.txt').read_text() == "0 0.5 0.5 0.1 0.2\n0  0.123456789 0.2 0.3 0.4\n"
+    assert (output / 'b.txt').read_text() == ""
+    assert (output / 'c.txt').read_text() == "0 0.1 0.1 0.1\n"
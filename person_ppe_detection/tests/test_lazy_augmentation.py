@@ -0,0 +1,13 @@
+import numpy as np
+
+from lazy_augmentation import brightness
+
+
+def test_brightness_saturates():
+    labels = np.zeros((0, 5), np.float32)
+    image = np.array([[[0, 10, 200], [250, 128, 30]]], dtype=np.uint8)
+    darker, _ = brightness(image, labels, -30.0)
+    assert darker.dtype == np.uint8
+    assert darker.tolist() == [[[0, 0, 170], [220, 98, 0]]]
+    brighter, _ = brightness(image, labels, 30.0)
+    assert brighter.tolist() == [[[30, 40, 230], [255, 158, 60]]]
@@ -0,0 +1,95 @@
+import json
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import pytest
+
+from model_client import ModelClient
+from model_server import BatchedInferenceWorker, make_server
+from two_stage import StubDetector, TwoStagePipeline
+
+PPE_NAMES = {i: f'class_{i}' for i in range(9)}
+
+
+@pytest.fixture(params=[None, 0.005], ids=['single', 'batched'])
+def server(request):
+    pipeline = TwoStagePipeline(StubDetector(boxes_per_image=3, names={0: 'person'}),
+                                StubDetector(boxes_per_image=2, num_classes=9, names=PPE_NAMES), imgsz=64)
+    server = make_server(pipeline, {0: 'person'}, PPE_NAMES, port=0, batch_wait=request.param)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    if isinstance(server.worker, BatchedInferenceWorker):
+        server.worker.close()
+    thread.join()
+
+
+def make_image(seed=0):
+    return np.random.default_rng(seed).integers(0, 256, (240, 320, 3), dtype=np.uint8)
+
+
+def url(server):
+    host, port = server.server_address[:2]
+    return f'http://{host}:{port}'
+
+
+def test_detect_json(server):
+    _, encoded = cv2.imencode('.png', make_image())
+    conn = http.client.HTTPConnection(*server.server_address[:2], timeout=30)
+    conn.request('POST', '/detect', body=encoded.tobytes(), headers={'Content-Type': 'application/octet-stream'})
+    response = conn.getresponse()
+    payload = json.loads(response.read())
+    conn.close()
+
+    assert response.status == 200
+    assert sorted(payload) == ['people', 'persons', 'timing']
+    assert len(payload['persons']) == 3 and len(payload['people']) == 3
+    assert sorted(payload['persons'][0]) == ['box', 'class', 'score']
+    person = payload['people'][0]
+    assert sorted(person) == ['crop_box', 'ppe'] and len(person['crop_box']) == 4 and len(person['ppe']) == 2
+    assert sorted(person['ppe'][0]) == ['box', 'class', 'frame_box', 'name', 'score']
+    timing = payload['timing']
+    assert sorted(timing) == ['decode_ms', 'inference_ms', 'queue_ms']
+    assert all(value >= 0 for value in timing.values())
+
+
+def test_encoded_and_shared_memory_round_trip(server):
+    image = make_image()
+    encoded = ModelClient(url(server), encode_ext='.png')
+    shared = ModelClient(url(server), use_shared_memory=True)
+    assert encoded.person_names == {0: 'person'} and encoded.ppe_names == PPE_NAMES
+
+    results = [encoded.detect(image), shared.detect(image)]
+    for result in results:
+        assert len(result.persons.scores) == 3 and len(result.people) == 3
+        assert set(shared.last_timing) == {'decode_ms', 'queue_ms', 'inference_ms'}
+    np.testing.assert_array_equal(results[0].persons.boxes, results[1].persons.boxes)
+    for a, b in zip(results[0].people, results[1].people):
+        assert a.crop_box == b.crop_box
+        np.testing.assert_array_equal(a.ppe_frame_boxes, b.ppe_frame_boxes)
+
+    assert len(shared.detect_persons(image).scores) == 3
+    assert len(shared.detect_ppe(image).scores) == 2
+    encoded.close()
+    shared.close()
+
+
+def test_concurrent_requests(server):
+    def detect(seed):
+        client = ModelClient(url(server), use_shared_memory=True)
+        try:
+            return len(client.detect(make_image(seed)).people)
+        finally:
+            client.close()
+
+    with ThreadPoolExecutor(8) as pool:
+        assert list(pool.map(detect, range(16))) == [3] * 16
+    stats = ModelClient(url(server)).stats()
+    assert stats['requests'] >= 16 and stats['queued'] == 0
+    if isinstance(server.worker, BatchedInferenceWorker):
+        assert set(stats['batching']) == {'person', 'ppe'}
@@ -0,0 +1,16 @@
+import cv2
+import numpy as np
+
+from render import CLASS_COLORS, FONT, blend_label, label_patch
+
+
+def test_blend_label_matches_put_text():
+    rng = np.random.default_rng(0)
+    for font_scale in (0.35, 0.5, 1.0):
+        for color in CLASS_COLORS:
+            # Inside the image, and clipped by each border
+            for x, y in ((40, 60), (-6, 5), (150, 159), (0, 0)):
+                image = rng.integers(0, 256, (160, 160, 3), dtype=np.uint8)
+                expected = cv2.putText(image.copy(), 'helmet 0.87', (x, y), FONT, font_scale, color, 1, cv2.LINE_AA)
+                blend_label(image, label_patch('helmet 0.87', font_scale, color), x, y)
+                assert np.abs(image.astype(int) - expected).max() <= 1
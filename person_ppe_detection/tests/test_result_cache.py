@@ -0,0 +1,41 @@
+import numpy as np
+
+from result_cache import ResultCache, cache_namespace, cached_detector
+from tiling import sliced_detector
+from two_stage import StubDetector, TwoStagePipeline
+
+
+class LetterboxingStub(StubDetector):
+    # Stands in for an ONNX/OpenVINO detector: records the shapes it is given
+    letterboxes = True
+    params = {'conf': 0.25, 'iou': 0.7, 'imgsz': 64}
+
+    def __call__(self, images):
+        images = list(images)
+        self.shapes = getattr(self, 'shapes', []) + [image.shape for image in images]
+        return super().__call__(images)
+
+
+def test_wrappers_keep_letterboxing_and_params(tmp_path):
+    ppe = LetterboxingStub(boxes_per_image=2)
+    cached = cached_detector(ppe, ResultCache(str(tmp_path / 'results.cache')), 'ns')
+    assert cached.letterboxes and cached.params == ppe.params
+    sliced = sliced_detector(ppe, tile_size=64)
+    assert sliced.letterboxes and sliced.params['conf'] == 0.25 and sliced.params['tile_size'] == 64
+
+    # Crops reach the detector as they are, not letterboxed to imgsz by the pipeline first
+    pipeline = TwoStagePipeline(StubDetector(boxes_per_image=3), cached, imgsz=64)
+    frame = np.random.default_rng(0).integers(0, 256, (240, 320, 3), dtype=np.uint8)
+    result = pipeline(frame)
+    assert [shape[:2] for shape in ppe.shapes] == [
+        (y2 - y1, x2 - x1) for x1, y1, x2, y2 in (person.crop_box for person in result.people)]
+
+
+def test_namespace_follows_detector_params(tmp_path):
+    weights = tmp_path / 'model.onnx'
+    weights.write_bytes(b'weights')
+    a = LetterboxingStub()
+    b = LetterboxingStub()
+    b.params = dict(a.params, conf=0.5)
+    assert cache_namespace(str(weights), **a.params) != cache_namespace(str(weights), **b.params)
+    assert cache_namespace(str(weights), **a.params) == cache_namespace(str(weights), **dict(a.params))
@@ -0,0 +1,26 @@
+import os
+import shutil
+
+import pytest
+
+from staging import stage_file
+
+
+@pytest.mark.parametrize('mode', ['auto', 'copy', 'hardlink', 'symlink'])
+def test_stage_file_onto_itself(tmp_path, mode):
+    src = tmp_path / 'a.txt'
+    src.write_text('data')
+    with pytest.raises(shutil.SameFileError):
+        stage_file(str(src), str(tmp_path / '.' / 'a.txt'), mode)
+    assert src.read_text() == 'data'
+
+
+def test_stage_file_replaces_links(tmp_path):
+    src = tmp_path / 'a.txt'
+    src.write_text('data')
+    hardlink, symlink = tmp_path / 'hard.txt', tmp_path / 'sym.txt'
+    os.link(src, hardlink)
+    os.symlink(src, symlink)
+    assert stage_file(str(src), str(hardlink), 'copy') == 'copy'
+    assert stage_file(str(src), str(symlink), 'symlink') == 'symlink'
+    assert src.read_text() == hardlink.read_text() == symlink.read_text() == 'data'
@@ -0,0 +1,54 @@
+import cv2
+import numpy as np
+import pytest
+
+from stream import StreamPipeline, video_frames
+from two_stage import StubDetector, TwoStagePipeline
+
+FRAMES = 30
+
+
+@pytest.fixture
+def clip(tmp_path):
+    path = str(tmp_path / 'clip.avi')
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 25, (160, 120))
+    for i in range(FRAMES):
+        writer.write(np.full((120, 160, 3), i * 8, np.uint8))
+    writer.release()
+    return path
+
+
+def run_stream(clip, drop_policy, person_latency=0.0, pace_fps=None):
+    pipeline = TwoStagePipeline(StubDetector(boxes_per_image=2, latency=person_latency),
+                                StubDetector(boxes_per_image=3, num_classes=9))
+    seen = []
+    stream = StreamPipeline(pipeline, [f'class_{i}' for i in range(9)], drop_policy=drop_policy, every_nth=3,
+                            pace_fps=pace_fps, render_every=1, on_frame=lambda index, result, encoded: seen.append(
+                                (index, len(result.people), encoded is not None)))
+    return stream.run(video_frames(clip)), seen
+
+
+def test_block_processes_every_frame(clip):
+    report, seen = run_stream(clip, 'block')
+    assert [(s.processed, s.dropped) for s in report.stages] == [(FRAMES, 0)] * 4
+    assert seen == [(i, 2, True) for i in range(FRAMES)]
+    assert len(report.latencies) == FRAMES
+
+
+def test_every_nth(clip):
+    report, seen = run_stream(clip, 'every_nth')
+    assert (report.stages[0].processed, report.stages[0].dropped) == (FRAMES // 3, FRAMES - FRAMES // 3)
+    assert [s.processed for s in report.stages[1:]] == [FRAMES // 3] * 3
+    assert [index for index, _, _ in seen] == list(range(0, FRAMES, 3))
+
+
+def test_latest_counts_replaced_frames_as_dropped(clip):
+    # Frames arrive every 5 ms while the person stage needs 50 ms, so most are replaced while waiting
+    report, seen = run_stream(clip, 'latest', person_latency=0.05, pace_fps=200)
+    decode, person = report.stages[0], report.stages[1]
+    assert decode.processed + decode.dropped == FRAMES
+    assert decode.dropped > 0
+    assert decode.processed == person.processed == len(seen) == len(report.latencies)
+    assert all(s.dropped == 0 for s in report.stages[1:])
+    indices = [index for index, _, _ in seen]
+    assert indices == sorted(indices) and indices[-1] == FRAMES - 1
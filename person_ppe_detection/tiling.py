@@ -0,0 +1,169 @@
+import numpy as np
+
+from two_stage import Detections, empty_detections
+
+MERGE_METHODS = ('nms', 'wbf')
+
+
+def tile_grid(frame_shape, tile_size=640, overlap=0.2):
+    # (T, 4) integer xyxy tiles covering the frame. Neighbouring tiles overlap by at least `overlap`
+    # of the tile size; the last row and column are shifted back so no tile hangs over the edge.
+    h, w = frame_shape[:2]
+
+    def starts(length):
+        if length <= tile_size:
+            return np.array([0])
+        stride = max(int(tile_size * (1 - overlap)), 1)
+        count = int(np.ceil((length - tile_size) / stride)) + 1
+        return np.linspace(0, length - tile_size, count).round().astype(int)
+
+    xs, ys = starts(w), starts(h)
+    x1, y1 = np.meshgrid(xs, ys)
+    x1, y1 = x1.ravel(), y1.ravel()
+    return np.stack([x1, y1, np.minimum(x1 + tile_size, w), np.minimum(y1 + tile_size, h)], axis=1)
+
+
+def box_overlap(a, b, metric='iou'):
+    # Pairwise (len(a), len(b)) overlap of xyxy boxes. 'ios' divides the intersection by the smaller
+    # box, so a person cut in half by a tile seam still matches the whole person from the next tile.
+    a = np.asarray(a, np.float32).reshape(-1, 4)
+    b = np.asarray(b, np.float32).reshape(-1, 4)
+    iw = (np.minimum(a[:, None, 2], b[None, :, 2]) - np.maximum(a[:, None, 0], b[None, :, 0])).clip(0)
+    ih = (np.minimum(a[:, None, 3], b[None, :, 3]) - np.maximum(a[:, None, 1], b[None, :, 1])).clip(0)
+    inter = iw * ih
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    if metric == 'ios':
+        denom = np.minimum(area_a[:, None], area_b[None, :])
+    else:
+        denom = area_a[:, None] + area_b[None, :] - inter
+    return inter / np.maximum(denom, 1e-9)
+
+
+def overlapping_pairs(a, b):
+    # (i, j) index arrays of the xyxy boxes a[i] and b[j] that intersect, without the dense
+    # (len(a), len(b)) matrix: with b sorted by x1, a box of a can only meet those starting before it
+    # ends and less than the widest b before it starts. Sparse scenes (many small boxes) are near linear.
+    a = np.asarray(a, np.float32).reshape(-1, 4)
+    b = np.asarray(b, np.float32).reshape(-1, 4)
+    if len(a) == 0 or len(b) == 0:
+        return np.zeros(0, int), np.zeros(0, int)
+    order = np.argsort(b[:, 0], kind='stable')
+    bx1, by1, bx2, by2 = np.take(b, order, axis=0).T.copy()
+    start = np.searchsorted(bx1, a[:, 0] - (bx2 - bx1).max(), 'right')
+    counts = np.maximum(np.searchsorted(bx1, a[:, 2], 'left') - start, 0)
+    i = np.repeat(np.arange(len(a)), counts)
+    j = np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(len(i))
+    # x1 of b < x2 of a holds by construction; columns are compared one at a time so the temporaries
+    # stay small
+    ax1, ay1, ay2 = a[:, 0].copy(), a[:, 1].copy(), a[:, 3].copy()
+    keep = (np.take(bx2, j) > np.take(ax1, i)) & (np.take(by1, j) < np.take(ay2, i)) & \
+        (np.take(by2, j) > np.take(ay1, i))
+    return i[keep], order[j[keep]]
+
+
+def paired_iou(a, b):
+    # IoU of a[i] with b[i], for (N, 4) xyxy boxes
+    iw = np.maximum(np.minimum(a[:, 2], b[:, 2]) - np.maximum(a[:, 0], b[:, 0]), 0)
+    ih = np.maximum(np.minimum(a[:, 3], b[:, 3]) - np.maximum(a[:, 1], b[:, 1]), 0)
+    inter = iw * ih
+    union = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1]) + (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1]) - inter
+    return inter / np.maximum(union, 1e-6)
+
+
+def _clusters(dets, threshold, metric, sources=None):
+    # Greedy clustering in score order: each remaining box collects every unassigned box of its class
+    # overlapping it by more than `threshold`. With `sources` (the tile each box came from) only boxes
+    # from other tiles are collected: the model already ran NMS within a tile, and overlapping people
+    # in one tile are distinct people. Yields index arrays, leader first.
+    order = np.argsort(-dets.scores, kind='stable')
+    boxes, classes = dets.boxes[order], dets.classes[order]
+    overlap = box_overlap(boxes, boxes, metric)
+    matches = (overlap > threshold) & (classes[:, None] == classes[None, :])
+    if sources is not None:
+        sources = np.asarray(sources)[order]
+        matches &= sources[:, None] != sources[None, :]
+    assigned = np.zeros(len(order), bool)
+    for i in range(len(order)):
+        if assigned[i]:
+            continue
+        members = np.flatnonzero(matches[i] & ~assigned)
+        members = np.concatenate([[i], members[members != i]])
+        assigned[members] = True
+        yield order[members]
+
+
+def nms(dets, threshold=0.5, metric='iou', sources=None):
+    # Class-aware non-maximum suppression: keep the best scoring box of every cluster
+    if len(dets.scores) == 0:
+        return dets
+    keep = np.array([members[0] for members in _clusters(dets, threshold, metric, sources)])
+    return Detections(dets.boxes[keep], dets.scores[keep], dets.classes[keep])
+
+
+def weighted_box_fusion(dets, threshold=0.5, metric='iou', sources=None):
+    # Class-aware box fusion: every cluster becomes its score-weighted mean box with the cluster's
+    # best score, so overlapping tiles refine a box instead of only voting for one of them
+    if len(dets.scores) == 0:
+        return dets
+    boxes, scores, classes = [], [], []
+    for members in _clusters(dets, threshold, metric, sources):
+        weights = dets.scores[members]
+        boxes.append((dets.boxes[members] * weights[:, None]).sum(axis=0) / weights.sum())
+        scores.append(weights.max())
+        classes.append(dets.classes[members[0]])
+    return Detections(np.array(boxes, np.float32), np.array(scores, np.float32), np.array(classes, int))
+
+
+def merge_detections(parts, method='nms', threshold=0.5, metric='ios'):
+    # Concatenate per-tile Detections (already in frame coordinates) and remove the duplicates seen by
+    # more than one tile
+    parts = [part for part in parts if len(part.scores)]
+    if not parts:
+        return empty_detections()
+    sources = np.concatenate([np.full(len(part.scores), i) for i, part in enumerate(parts)])
+    dets = Detections(np.concatenate([p.boxes for p in parts]).astype(np.float32),
+                      np.concatenate([p.scores for p in parts]).astype(np.float32),
+                      np.concatenate([p.classes for p in parts]).astype(int))
+    merge = weighted_box_fusion if method == 'wbf' else nms
+    return merge(dets, threshold, metric, sources)
+
+
+def sliced_detector(detector, tile_size=640, overlap=0.2, full_frame=True, method='nms', threshold=0.5,
+                    metric='ios', max_batch_size=32):
+    # Wrap a detector callable so each image is cut into overlapping tiles that are run through the model
+    # at their native resolution. Tiles of every image in the call (plus, with `full_frame`, the whole
+    # images for large people spanning several tiles) go through the model in batches of
+    # `max_batch_size`; the detections are shifted back into frame coordinates and merged per image.
+    def detect(images):
+        images = list(images)
+        inputs, owners, offsets = [], [], []
+        for index, image in enumerate(images):
+            tiles = tile_grid(image.shape, tile_size, overlap)
+            if full_frame and len(tiles) > 1:
+                inputs.append(image)
+                owners.append(index)
+                offsets.append((0, 0))
+            for x1, y1, x2, y2 in tiles:
+                inputs.append(image[y1:y2, x1:x2])  # views, the detector letterboxes them
+                owners.append(index)
+                offsets.append((x1, y1))
+
+        outputs = []
+        for start in range(0, len(inputs), max_batch_size):
+            outputs.extend(detector(inputs[start:start + max_batch_size]))
+        detect.forward_images += len(inputs)
+
+        parts = [[] for _ in images]
+        for owner, (dx, dy), dets in zip(owners, offsets, outputs):
+            shift = np.array([dx, dy, dx, dy], np.float32)
+            parts[owner].append(Detections(np.asarray(dets.boxes, np.float32).reshape(-1, 4) + shift,
+                                           np.asarray(dets.scores, np.float32), np.asarray(dets.classes)))
+        return [merge_detections(p, method, threshold, metric) for p in parts]
+
+    detect.names = getattr(detector, 'names', None)
+    detect.letterboxes = getattr(detector, 'letterboxes', False)  # tiles are passed on as they are
+    detect.params = dict(getattr(detector, 'params', {}), tile_size=tile_size, overlap=overlap, full_frame=full_frame,
+                         method=method, threshold=threshold, metric=metric)
+    detect.forward_images = 0
+    return detect
@@ -0,0 +1,264 @@
+import time
+import argparse
+
+import numpy as np
+
+from two_stage import Detections, TwoStagePipeline, StubDetector, assemble_result, person_crops
+from tiling import overlapping_pairs, paired_iou
+
+# Constant velocity model over (cx, cy, area, aspect ratio) as in SORT; the aspect ratio has no velocity
+_F = np.eye(7, dtype=np.float64)
+_F[0, 4] = _F[1, 5] = _F[2, 6] = 1
+_H = np.eye(4, 7, dtype=np.float64)
+_Q = np.diag([1, 1, 1, 1, 0.01, 0.01, 1e-4])
+_R = np.diag([1, 1, 10, 10]).astype(np.float64)
+_P0 = np.diag([10, 10, 10, 10, 1e4, 1e4, 1e4]).astype(np.float64)
+
+
+def box_to_z(boxes):
+    # xyxy -> (cx, cy, area, w / h)
+    boxes = np.asarray(boxes, np.float64).reshape(-1, 4)
+    w, h = boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]
+    return np.stack([boxes[:, 0] + w / 2, boxes[:, 1] + h / 2, w * h, w / np.maximum(h, 1e-6)], axis=1)
+
+
+def z_to_box(z):
+    area = np.maximum(z[:, 2], 1e-6)
+    w = np.sqrt(area * np.maximum(z[:, 3], 1e-6))
+    h = area / w
+    return np.stack([z[:, 0] - w / 2, z[:, 1] - h / 2, z[:, 0] + w / 2, z[:, 1] + h / 2], axis=1).astype(np.float32)
+
+
+class SortTracker:
+    # SORT: a Kalman filter per track, predicted boxes matched to the detections by IoU with the
+    # Hungarian algorithm. The filters of all tracks are stored and stepped as stacked arrays.
+    # Unlike the reference implementation every detection gets an id right away (no min_hits) since
+    # callers attach data to each detected person; tracks unmatched for more than max_age frames are dropped.
+    # After an update, `source` holds for every track row the row it came from in the previous update
+    # (-1 for new tracks) and `rows` the track row of every detection, so callers can keep per-track state
+    # in arrays aligned with the rows.
+    def __init__(self, iou_threshold=0.3, max_age=5):
+        from scipy.optimize import linear_sum_assignment  # Hungarian algorithm
+        self.linear_assignment = linear_sum_assignment
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age
+        self.x = np.zeros((0, 7))
+        self.P = np.zeros((0, 7, 7))
+        self.ids = np.zeros(0, int)
+        self.misses = np.zeros(0, int)
+        self.source = np.zeros(0, int)
+        self.rows = np.zeros(0, int)
+        self.next_id = 0
+
+    def predict(self):
+        # Don't let the area go negative
+        self.x[self.x[:, 2] + self.x[:, 6] <= 0, 6] = 0
+        self.x = self.x @ _F.T
+        self.P = _F @ self.P @ _F.T + _Q
+        return z_to_box(self.x[:, :4])
+
+    def match(self, boxes, predicted):
+        # (detection, track) pairs of the Hungarian assignment on IoU, among the pairs overlapping by at
+        # least iou_threshold. A detection and a track with no such pair but each other are their own
+        # optimal assignment; the Hungarian algorithm only runs on the (small, dense) rest.
+        det_index, track_index = overlapping_pairs(boxes, predicted)
+        iou = paired_iou(np.take(boxes, det_index, axis=0), np.take(predicted, track_index, axis=0))
+        keep = iou >= self.iou_threshold
+        det_index, track_index, iou = det_index[keep], track_index[keep], iou[keep]
+        alone = (np.bincount(det_index, minlength=len(boxes))[det_index] == 1) & \
+            (np.bincount(track_index, minlength=len(predicted))[track_index] == 1)
+        if not alone.all():
+            rows, row = np.unique(det_index[~alone], return_inverse=True)
+            cols, col = np.unique(track_index[~alone], return_inverse=True)
+            dense = np.zeros((len(rows), len(cols)), np.float32)
+            dense[row, col] = iou[~alone]
+            r, c = self.linear_assignment(-dense)
+            det_index = np.concatenate([det_index[alone], rows[r]])
+            track_index = np.concatenate([track_index[alone], cols[c]])
+            # Rows and columns without a valid pair left get a zero entry
+            keep = np.concatenate([np.ones(alone.sum(), bool), dense[r, c] > 0])
+            det_index, track_index = det_index[keep], track_index[keep]
+        return det_index, track_index
+
+    def update(self, boxes):
+        # Track id of every detection, in the order of `boxes`
+        boxes = np.asarray(boxes, np.float32).reshape(-1, 4)
+        predicted = self.predict()
+        det_index, track_index = self.match(boxes, predicted)
+
+        # Kalman update of the matched tracks, all at once
+        # _H selects the first four state entries, so H P H^T and P H^T are slices of P. F, Q, R and P0
+        # never couple (cx, vx), (cy, vy), (area, va) and the aspect ratio, so P stays block diagonal
+        # and S = H P H^T + R is diagonal: no matrix inverse is needed.
+        if len(det_index):
+            x, P = np.take(self.x, track_index, axis=0), np.take(self.P, track_index, axis=0)
+            K = P[:, :, :4] / (np.diagonal(P[:, :4, :4], axis1=1, axis2=2) + _R.diagonal())[:, None, :]
+            residual = box_to_z(np.take(boxes, det_index, axis=0)) - x[:, :4]
+            self.x[track_index] = x + (K @ residual[:, :, None])[:, :, 0]
+            self.P[track_index] = P - K @ P[:, :4, :]
+
+        ids = np.full(len(boxes), -1)
+        ids[det_index] = self.ids[track_index]
+        self.misses += 1
+        self.misses[track_index] = 0
+
+        # Unmatched detections start new tracks
+        new = np.flatnonzero(ids < 0)
+        ids[new] = np.arange(self.next_id, self.next_id + len(new))
+        self.next_id += len(new)
+        z = box_to_z(np.take(boxes, new, axis=0))
+        keep = self.misses <= self.max_age
+        kept = np.flatnonzero(keep)
+        self.source = np.concatenate([kept, np.full(len(new), -1)])
+        self.rows = np.zeros(len(boxes), int)
+        self.rows[det_index] = (np.cumsum(keep) - 1)[track_index]
+        self.rows[new] = len(kept) + np.arange(len(new))
+        self.x = np.concatenate([np.take(self.x, kept, axis=0), np.hstack([z, np.zeros((len(new), 3))])])
+        self.P = np.concatenate([np.take(self.P, kept, axis=0), np.broadcast_to(_P0, (len(new), 7, 7))])
+        self.ids = np.concatenate([self.ids[kept], ids[new]])
+        self.misses = np.concatenate([self.misses[kept], np.zeros(len(new), int)])
+        return ids
+
+
+class TrackedPipeline:
+    # Two-stage pipeline that tracks persons across frames and reuses a track's PPE detections until
+    # its box moves (IoU with the box the PPE model last saw below `min_iou`) or the result gets
+    # stale: `refresh_interval` frames, or `low_conf_interval` frames when any of its PPE scores is
+    # below `low_conf`. Reused boxes are scaled to the person's current crop. Same interface as
+    # TwoStagePipeline (detect_persons / attach_ppe / __call__), so it drops into StreamPipeline.
+    def __init__(self, pipeline, tracker=None, refresh_interval=15, min_iou=0.85, low_conf=0.5,
+                 low_conf_interval=3):
+        self.pipeline = pipeline
+        self.tracker = tracker or SortTracker()
+        self.refresh_interval = refresh_interval
+        self.min_iou = min_iou
+        self.low_conf = low_conf
+        self.low_conf_interval = low_conf_interval
+        self.cache = {}  # track id -> (crop region, frame index, interval, PPE boxes relative to the crop, scores, classes)
+        self.frame_index = 0
+        self.track_ids = np.zeros(0, int)  # of the persons of the last frame
+        self.crops = 0
+        self.ppe_runs = 0
+
+    def detect_persons(self, frame):
+        return self.pipeline.detect_persons(frame)
+
+    def __call__(self, frame):
+        return self.attach_ppe(frame, self.detect_persons(frame))
+
+    def attach_ppe(self, frame, persons):
+        ids = self.tracker.update(persons.boxes)
+        regions, valid, crops = person_crops(frame, persons)
+        valid = np.asarray(valid, int)
+        cached = [self.cache.get(track_id) for track_id in ids[valid].tolist()]
+
+        # Which crops still have a fresh enough PPE result
+        fresh = np.array([entry is not None for entry in cached], bool)
+        if fresh.any():
+            known = np.flatnonzero(fresh)
+            then = np.array([cached[k][0] for k in known], np.float32)
+            age = self.frame_index - np.array([cached[k][1] for k in known])
+            interval = np.array([cached[k][2] for k in known])
+            moved = paired_iou(regions[valid[known]].astype(np.float32), then) < self.min_iou
+            fresh[known] = (age < interval) & ~moved
+
+        ppe_by_person = {}
+        for k in np.flatnonzero(fresh).tolist():
+            _, _, _, relative, scores, classes = cached[k]
+            i = int(valid[k])
+            x1, y1, x2, y2 = regions[i]
+            ppe_by_person[i] = Detections(relative * np.array([x2 - x1, y2 - y1] * 2, np.float32),
+                                          scores, classes)
+        stale = np.flatnonzero(~fresh).tolist()
+        for k, dets in zip(stale, self.pipeline.detect_ppe([crops[k] for k in stale])):
+            i = int(valid[k])
+            x1, y1, x2, y2 = regions[i]
+            low = len(dets.scores) and dets.scores.min() < self.low_conf
+            self.cache[int(ids[i])] = (regions[i].astype(np.float32), self.frame_index,
+                                       self.low_conf_interval if low else self.refresh_interval,
+                                       dets.boxes / np.array([x2 - x1, y2 - y1] * 2, np.float32), dets.scores,
+                                       dets.classes)
+            ppe_by_person[i] = dets
+
+        # Forget the tracks the tracker dropped
+        alive = set(self.tracker.ids.tolist())
+        for track_id in [t for t in self.cache if t not in alive]:
+            del self.cache[track_id]
+
+        self.crops += len(valid)
+        self.ppe_runs += len(stale)
+        self.frame_index += 1
+        self.track_ids = ids
+        return assemble_result(persons, regions, ppe_by_person)
+
+    def stats(self):
+        return {'frames': self.frame_index, 'crops': self.crops, 'ppe_runs': self.ppe_runs,
+                'saved': 1 - self.ppe_runs / self.crops if self.crops else 0.0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the PPE inference saved by tracking persons on a clip.')
+    parser.add_argument('source', type=str, help='Video file.')
+    parser.add_argument('--person_weights', type=str, default='person_detection.pt',
+                        help='Person model: .pt weights, .onnx file or OpenVINO model directory.')
+    parser.add_argument('--ppe_weights', type=str, default='ppe_detection.pt',
+                        help='PPE model: .pt weights, .onnx file or OpenVINO model directory.')
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads per model (default: runtime default).')
+    parser.add_argument('--stub', action='store_true', help='Use stub detectors instead of YOLO models.')
+    parser.add_argument('--max_frames', type=int, default=None, help='Stop after this many frames.')
+    parser.add_argument('--refresh_interval', type=int, default=15, help='Frames a track\'s PPE result is reused at most.')
+    parser.add_argument('--min_iou', type=float, default=0.85,
+                        help='Re-run PPE when the person box overlaps the last checked one less than this.')
+    parser.add_argument('--low_conf', type=float, default=0.5, help='PPE scores below this count as uncertain.')
+    parser.add_argument('--low_conf_interval', type=int, default=3,
+                        help='Refresh interval for tracks with uncertain PPE detections.')
+    parser.add_argument('--compare', action='store_true',
+                        help='Also run PPE on every crop and report how often the reused results agree.')
+    args = parser.parse_args()
+
+    from stream import video_frames
+    if args.stub:
+        person_detector = StubDetector(boxes_per_image=5)
+        ppe_detector = StubDetector(boxes_per_image=3, num_classes=9, per_image_latency=0.002)
+    else:
+        from backends import load_detector
+        person_detector = load_detector(args.person_weights, threads=args.threads)
+        ppe_detector = load_detector(args.ppe_weights, threads=args.threads)
+    pipeline = TwoStagePipeline(person_detector, ppe_detector)
+    tracked = TrackedPipeline(pipeline, refresh_interval=args.refresh_interval, min_iou=args.min_iou,
+                              low_conf=args.low_conf, low_conf_interval=args.low_conf_interval)
+
+    tracked_time = full_time = 0.0
+    agree = compared = 0
+    for index, frame in enumerate(video_frames(args.source)):
+        if args.max_frames and index >= args.max_frames:
+            break
+        persons = tracked.detect_persons(frame)
+        start = time.perf_counter()
+        result = tracked.attach_ppe(frame, persons)
+        tracked_time += time.perf_counter() - start
+        if args.compare:
+            start = time.perf_counter()
+            reference = pipeline.attach_ppe(frame, persons)
+            full_time += time.perf_counter() - start
+            for a, b in zip(result.people, reference.people):
+                agree += set(a.ppe.classes.tolist()) == set(b.ppe.classes.tolist())
+                compared += 1
+
+    stats = tracked.stats()
+    print(f"{stats['frames']} frames, {stats['crops']} person crops, PPE run on {stats['ppe_runs']} "
+          f"({stats['saved']:.1%} saved), {tracked.tracker.next_id} tracks")
+    print(f"PPE stage: {1000 * tracked_time / max(stats['frames'], 1):.1f} ms/frame with tracking", end='')
+    if args.compare:
+        print(f", {1000 * full_time / max(stats['frames'], 1):.1f} ms/frame without; "
+              f"same PPE classes as a full run for {agree / max(compared, 1):.1%} of the person crops")
+    else:
+        print()
+
+
+if __name__ == '__main__':
+    main()
+
+# python tracker.py site_camera.mp4 --person_weights person.onnx --ppe_weights ppe.onnx --compare
+# python tracker.py site_camera.mp4 --refresh_interval 30 --min_iou 0.9 --low_conf_interval 5
+# python tracker.py site_camera.mp4 --stub --max_frames 300
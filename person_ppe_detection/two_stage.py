@@ -0,0 +1,259 @@
+import time
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from render import PERSON_COLOR, draw_detections
+
+# Boxes are (N, 4) float32 xyxy, scores (N,) float32 and classes (N,) int
+Detections = namedtuple('Detections', ['boxes', 'scores', 'classes'])
+
+# One entry per detected person: the integer crop region in the frame, PPE detections
+# in crop coordinates and the same PPE boxes mapped back into frame coordinates
+PersonPPE = namedtuple('PersonPPE', ['crop_box', 'ppe', 'ppe_frame_boxes'])
+
+FrameResult = namedtuple('FrameResult', ['persons', 'people'])
+
+
+def empty_detections():
+    return Detections(np.zeros((0, 4), np.float32), np.zeros(0, np.float32), np.zeros(0, int))
+
+
+def letterbox(image, size=640, color=(114, 114, 114)):
+    # Resize keeping the aspect ratio and pad to a square of `size`, the same
+    # preprocessing ultralytics applies before a forward pass
+    out = np.empty((size, size, 3), dtype=np.uint8)
+    r, pad = letterbox_into(out, image, color)
+    return out, r, pad
+
+
+def letterbox_into(out, image, color=(114, 114, 114)):
+    # Letterbox `image` (which may be a view of a larger frame) into the preallocated square `out`.
+    # The resize writes straight into `out` and only the padding is filled: no temporary arrays.
+    size = out.shape[0]
+    h, w = image.shape[:2]
+    r = min(size / h, size / w)
+    new_w, new_h = max(int(round(w * r)), 1), max(int(round(h * r)), 1)
+    dx, dy = (size - new_w) // 2, (size - new_h) // 2
+
+    out[:dy] = color
+    out[dy + new_h:] = color
+    out[dy:dy + new_h, :dx] = color
+    out[dy:dy + new_h, dx + new_w:] = color
+    region = out[dy:dy + new_h, dx:dx + new_w]
+    if (new_w, new_h) != (w, h):
+        cv2.resize(image, (new_w, new_h), dst=region, interpolation=cv2.INTER_LINEAR)
+    else:
+        region[...] = image
+    return r, (dx, dy)
+
+
+class LetterboxPool:
+    # Reusable (n, size, size, 3) input batch for a model, grown to the largest batch seen so far.
+    # The batch returned by `batch` is overwritten by the next call, so it must be consumed first.
+    def __init__(self, size=640, color=(114, 114, 114)):
+        self.size = size
+        self.color = color
+        self.buffer = np.empty((0, size, size, 3), dtype=np.uint8)
+
+    def batch(self, images):
+        # Letterbox `images` into the pool, returns the batch and a (r, pad) per image
+        if len(images) > len(self.buffer):
+            self.buffer = np.empty((len(images), self.size, self.size, 3), dtype=np.uint8)
+        params = [letterbox_into(self.buffer[i], image, self.color) for i, image in enumerate(images)]
+        return self.buffer[:len(images)], params
+
+
+def unletterbox_boxes(boxes, r, pad, crop_shape):
+    # Map xyxy boxes from letterbox coordinates back into the original crop
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4).copy()
+    boxes[:, [0, 2]] = (boxes[:, [0, 2]] - pad[0]) / r
+    boxes[:, [1, 3]] = (boxes[:, [1, 3]] - pad[1]) / r
+    h, w = crop_shape[:2]
+    boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, w)
+    boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, h)
+    return boxes
+
+
+def yolo_detector(model, **predict_kwargs):
+    # Wrap an ultralytics YOLO model as a detector callable: list of BGR images in,
+    # list of Detections out (one forward pass for the whole list)
+    def detect(images):
+        results = model(list(images), verbose=False, **predict_kwargs)
+        return [Detections(r.boxes.xyxy.cpu().numpy().astype(np.float32),
+                           r.boxes.conf.cpu().numpy().astype(np.float32),
+                           r.boxes.cls.cpu().numpy().astype(int)) for r in results]
+
+    detect.names = model.names
+    detect.params = dict(predict_kwargs)  # what the results depend on besides the weights
+    return detect
+
+
+class StubDetector:
+    # Deterministic stand-in for a YOLO model so pipelines can be exercised on CPU.
+    # `latency` is a fixed cost per call, `per_image_latency` a cost per image in the batch.
+    def __init__(self, boxes_per_image=1, num_classes=1, latency=0.0, per_image_latency=0.0, seed=0, names=None):
+        self.boxes_per_image = boxes_per_image
+        self.num_classes = num_classes
+        self.latency = latency
+        self.per_image_latency = per_image_latency
+        self.seed = seed
+        self.names = names or {i: f'class_{i}' for i in range(num_classes)}
+        self.calls = 0
+        self.images_seen = 0
+
+    def __call__(self, images):
+        images = list(images)
+        self.calls += 1
+        self.images_seen += len(images)
+        delay = self.latency + self.per_image_latency * len(images)
+        if delay:
+            time.sleep(delay)
+        return [self.detect_one(image) for image in images]
+
+    def detect_one(self, image):
+        h, w = image.shape[:2]
+        n = self.boxes_per_image
+        rng = np.random.default_rng((self.seed, h, w))
+        x1 = rng.uniform(0, w * 0.8, n)
+        y1 = rng.uniform(0, h * 0.8, n)
+        bw = rng.uniform(w * 0.05, w * 0.2, n)
+        bh = rng.uniform(h * 0.1, h * 0.2, n)
+        boxes = np.stack([x1, y1, np.minimum(x1 + bw, w), np.minimum(y1 + bh, h)], axis=1).astype(np.float32)
+        scores = rng.uniform(0.3, 1.0, n).astype(np.float32)
+        classes = rng.integers(0, self.num_classes, n)
+        return Detections(boxes, scores, classes)
+
+
+def crop_regions(boxes, frame_shape):
+    # Integer crop regions (x1, y1, x2, y2) clamped to the frame, same truncation as the
+    # original `original_image[int(y1):int(y2), int(x1):int(x2)]` slicing
+    h, w = frame_shape[:2]
+    regions = np.asarray(boxes, dtype=np.float32).reshape(-1, 4).astype(int)
+    regions[:, [0, 2]] = regions[:, [0, 2]].clip(0, w)
+    regions[:, [1, 3]] = regions[:, [1, 3]].clip(0, h)
+    return regions
+
+
+def person_crops(frame, persons):
+    # Crop regions for every person, the indices of those with a non-empty crop and the crops (views)
+    regions = crop_regions(persons.boxes, frame.shape)
+    valid = [i for i, (x1, y1, x2, y2) in enumerate(regions) if x2 > x1 and y2 > y1]
+    crops = [frame[regions[i, 1]:regions[i, 3], regions[i, 0]:regions[i, 2]] for i in valid]
+    return regions, valid, crops
+
+
+def restore_detections(dets, r, pad, crop_shape):
+    # Detections on a letterboxed crop -> Detections in crop coordinates
+    return Detections(unletterbox_boxes(dets.boxes, r, pad, crop_shape),
+                      np.asarray(dets.scores, np.float32), np.asarray(dets.classes).astype(int))
+
+
+def assemble_result(persons, regions, ppe_by_person):
+    # Persons whose crop collapsed to nothing (absent from ppe_by_person) get no PPE
+    people = []
+    for i, region in enumerate(regions):
+        ppe = ppe_by_person.get(i, empty_detections())
+        frame_boxes = ppe.boxes + np.array([region[0], region[1], region[0], region[1]], dtype=np.float32)
+        people.append(PersonPPE(tuple(int(v) for v in region), ppe, frame_boxes))
+    return FrameResult(persons, people)
+
+
+class TwoStagePipeline:
+    # Person detection on the full frame followed by PPE detection on every person crop.
+    # In batched mode all crops of a frame are letterboxed into one batch (split into
+    # chunks of `max_batch_size`) so the PPE model runs once per chunk instead of once per person.
+    # Crops are views of the frame; with `reuse_buffers` they are letterboxed straight into a
+    # LetterboxPool instead of allocating and stacking a new array per crop. Detectors that do their
+    # own letterboxing (`letterboxes = True`, e.g. the ONNX/OpenVINO backends) get the crops as they
+    # are and return crop coordinates, so each crop is only resized once.
+    def __init__(self, person_detector, ppe_detector, imgsz=640, max_batch_size=32, batched=True,
+                 reuse_buffers=True):
+        self.person_detector = person_detector
+        self.ppe_detector = ppe_detector
+        self.imgsz = imgsz
+        self.max_batch_size = max_batch_size
+        self.batched = batched
+        self.pool = LetterboxPool(imgsz) if reuse_buffers else None
+
+    def detect_persons(self, frame):
+        return self.person_detector([frame])[0]
+
+    def detect_ppe(self, crops):
+        # Run the PPE model on a list of crops, returns Detections in crop coordinates
+        step = self.max_batch_size if self.batched else 1
+        if getattr(self.ppe_detector, 'letterboxes', False):
+            return [dets for start in range(0, len(crops), step)
+                    for dets in self.ppe_detector(crops[start:start + step])]
+
+        outputs, params = [], []
+        for start in range(0, len(crops), step):
+            chunk = crops[start:start + step]
+            if self.pool is not None:
+                batch, chunk_params = self.pool.batch(chunk)
+            else:
+                prepared = [letterbox(crop, self.imgsz) for crop in chunk]
+                batch = np.stack([image for image, _, _ in prepared])
+                chunk_params = [(r, pad) for _, r, pad in prepared]
+            outputs.extend(self.ppe_detector(batch))
+            params.extend(chunk_params)
+
+        return [restore_detections(dets, r, pad, crop.shape)
+                for crop, (r, pad), dets in zip(crops, params, outputs)]
+
+    def __call__(self, frame):
+        return self.attach_ppe(frame, self.detect_persons(frame))
+
+    def attach_ppe(self, frame, persons):
+        # Second stage on its own so streaming pipelines can run it in a separate thread
+        regions, valid, crops = person_crops(frame, persons)
+        return assemble_result(persons, regions, dict(zip(valid, self.detect_ppe(crops))))
+
+
+def draw_result(image, result, ppe_names, person_color=PERSON_COLOR, ppe_color=None):
+    # Draw persons and their PPE (in frame coordinates) onto `image` in place; ppe_color None: per class
+    draw_detections(image, result.persons.boxes, np.zeros(len(result.persons.scores), int), ['Person'],
+                    result.persons.scores, person_color)
+    for person in result.people:
+        draw_detections(image, person.ppe_frame_boxes, person.ppe.classes, ppe_names, person.ppe.scores, ppe_color)
+    return image
+
+
+def detections_to_dict(dets, names=None):
+    items = []
+    for box, score, class_id in zip(np.asarray(dets.boxes).tolist(), np.asarray(dets.scores).tolist(),
+                                    np.asarray(dets.classes).tolist()):
+        item = {'box': box, 'score': score, 'class': int(class_id)}
+        if names is not None:
+            item['name'] = names[int(class_id)]
+        items.append(item)
+    return items
+
+
+def detections_from_dict(items):
+    if not items:
+        return empty_detections()
+    return Detections(np.array([item['box'] for item in items], dtype=np.float32).reshape(-1, 4),
+                      np.array([item['score'] for item in items], dtype=np.float32),
+                      np.array([item['class'] for item in items], dtype=int))
+
+
+def result_to_dict(result, ppe_names=None):
+    # JSON-friendly form of a FrameResult; PPE boxes are given in crop and frame coordinates
+    people = []
+    for person in result.people:
+        ppe = detections_to_dict(person.ppe, ppe_names)
+        for item, frame_box in zip(ppe, np.asarray(person.ppe_frame_boxes).tolist()):
+            item['frame_box'] = frame_box
+        people.append({'crop_box': list(person.crop_box), 'ppe': ppe})
+    return {'persons': detections_to_dict(result.persons), 'people': people}
+
+
+def result_from_dict(data):
+    people = []
+    for person in data['people']:
+        ppe = detections_from_dict(person['ppe'])
+        frame_boxes = np.array([item['frame_box'] for item in person['ppe']], dtype=np.float32).reshape(-1, 4)
+        people.append(PersonPPE(tuple(person['crop_box']), ppe, frame_boxes))
+    return FrameResult(detections_from_dict(data['persons']), people)
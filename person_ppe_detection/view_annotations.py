@@ -1,73 +1,179 @@
 import os
 import cv2
 import random
-
-
-images_path = 'augmented_data/cropped/images'
-labels_path = 'augmented_data/cropped/labels'
-output_path = 'augmented_data/cropped/annotated_images'
-classes_file = 'cropped_classes.txt'
-
-# Load class names
-with open(classes_file, 'r') as f:
-    class_names = f.read().strip().split('\n')
-
-# Define specific colors for the classes
-colors = [
-    (0, 0, 255),  # Red
-    (0, 255, 255),  # Yellow
-    (255, 0, 0),  # Blue
-    (0, 255, 0),  # Green
-    (255, 0, 255),  # Pink
-    (64, 224, 208),  # Turquoise
-    (128, 0, 128),  # Purple
-    (255, 165, 0),  # Orange
-    (255, 255, 255)  # White
-]
-
-# Assign colors to classes (loop around if more classes than colors)
-class_colors = {class_name: colors[i % len(colors)] for i, class_name in enumerate(class_names)}
-
-# Create output directory if it doesn't exist
-os.makedirs(output_path, exist_ok=True)
-
-
-# Function to draw bounding boxes on the image
-def draw_bounding_boxes(img, label_file):
-    height, width, _ = img.shape
-    with open(label_file, 'r') as f:
-        labels = f.readlines()
-
-    for label in labels:
-        class_id, x_center, y_center, bbox_width, bbox_height = map(float, label.strip().split())
-        class_id = int(class_id)
-
-        # Convert YOLO format to bounding box coordinates
-        x1 = int((x_center - bbox_width / 2) * width)
-        y1 = int((y_center - bbox_height / 2) * height)
-        x2 = int((x_center + bbox_width / 2) * width)
-        y2 = int((y_center + bbox_height / 2) * height)
-
-        # Draw the bounding box
-        class_name = class_names[class_id]
-        color = class_colors[class_name]
-        thickness = 2
-        img = cv2.rectangle(img, (x1, y1), (x2, y2), color, thickness, lineType=cv2.LINE_AA)
-        img = cv2.putText(img, class_name, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1, lineType=cv2.LINE_AA)
-
-    return img
-
-
-# Process images
-for image_file in os.listdir(images_path):
-    if image_file.endswith(('.jpg', '.png', '.jpeg')):
-        image_path = os.path.join(images_path, image_file)
-        label_file = os.path.join(labels_path, os.path.splitext(image_file)[0] + '.txt')
-
-        if os.path.exists(label_file):
-            img = cv2.imread(image_path)
-            img_with_boxes = draw_bounding_boxes(img, label_file)
-            output_image_path = os.path.join(output_path, image_file)
-            cv2.imwrite(output_image_path, img_with_boxes)
-
-print(f"Annotated images have been saved to {output_path}")
\ No newline at end of file
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+
+from annotation_index import AnnotationIndex, parse_label_file
+from image_io import IMAGE_EXTENSIONS, decode_image, image_size, read_image
+from render import contact_sheet, draw_labels, fit_thumbnail
+from shards import is_packed, open_packed
+
+
+def list_samples(images_path, labels_path):
+    # (image names, label names, (N, C) boxes per class) of the images that have a label file
+    if is_packed(images_path):
+        dataset = open_packed(images_path)
+        labelled = dataset.label_offsets >= 0
+        image_names = [key + ext for key, ext in zip(dataset.keys[labelled].tolist(), dataset.exts[labelled].tolist())]
+        return image_names, dataset.names.tolist(), dataset.file_class_counts()
+
+    index = AnnotationIndex.load(labels_path)
+    images = {os.path.splitext(f)[0]: f for f in os.listdir(images_path) if f.lower().endswith(IMAGE_EXTENSIONS)}
+    rows = [i for i, name in enumerate(index.names.tolist()) if os.path.splitext(name)[0] in images]
+    image_names = [images[os.path.splitext(index.names[i])[0]] for i in rows]
+    return image_names, [index.names[i] for i in rows], index.file_class_counts()[rows]
+
+
+def load_sample(images_path, labels_path, image_name, label_name, scale=1, cell=None):
+    # (image, class ids, boxes); with a cell size the image is decoded at the largest DCT scale that still
+    # covers the cell
+    packed = is_packed(images_path)
+    if cell is not None:
+        if packed:
+            dataset = open_packed(images_path)
+            i = dataset.index_of(image_name)
+            w, h = int(dataset.widths[i]), int(dataset.heights[i])
+        else:
+            w, h = image_size(os.path.join(images_path, image_name))
+        # fit_thumbnail shrinks the image by min(cell / size), so any decode at least that large will do
+        shrink = max(w / cell[0], h / cell[1], 1)
+        scale = max(s for s in (8, 4, 2, 1) if s <= shrink)
+    if packed:
+        dataset = open_packed(images_path)
+        image = decode_image(dataset.read_bytes(image_name), scale)
+        class_ids, boxes = dataset.read_label(image_name)
+    else:
+        image = read_image(os.path.join(images_path, image_name), scale)
+        class_ids, boxes, _ = parse_label_file(os.path.join(labels_path, label_name))
+    return image, class_ids, boxes
+
+
+def _selected(class_ids, boxes, keep_classes):
+    if keep_classes is None:
+        return class_ids, boxes
+    mask = np.isin(class_ids, list(keep_classes))
+    return class_ids[mask], boxes[mask]
+
+
+def _render_task(task):
+    # Worker: annotated images, or one contact sheet. Returns the number of images drawn.
+    kind, images_path, labels_path, samples, output, options = task
+    if kind == 'images':
+        for image_name, label_name in samples:
+            image, class_ids, boxes = load_sample(images_path, labels_path, image_name, label_name, options['scale'])
+            if image is None:
+                continue
+            draw_labels(image, *_selected(class_ids, boxes, options['keep_classes']), options['class_names'])
+            cv2.imwrite(os.path.join(output, image_name), image)
+        return len(samples)
+
+    thumbnails = []
+    for image_name, label_name in samples:
+        image, class_ids, boxes = load_sample(images_path, labels_path, image_name, label_name, cell=options['cell'])
+        if image is None:
+            thumbnails.append(None)
+            continue
+        # Drawn after downscaling, so boxes and labels stay sharp and cost no more than the thumbnail
+        thumbnail = fit_thumbnail(image, options['cell'])
+        draw_labels(thumbnail, *_selected(class_ids, boxes, options['keep_classes']), options['class_names'],
+                    thickness=1, font_scale=0.35, labels=options['thumbnail_labels'])
+        thumbnails.append(thumbnail)
+    captions = [os.path.splitext(image_name)[0] for image_name, _ in samples] if options['captions'] else None
+    cv2.imwrite(output, contact_sheet(thumbnails, options['grid'], options['cell'], captions),
+                [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return len(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Draw YOLO annotations on images, one file per image or as '
+                                                 'contact sheets of thumbnails.')
+    parser.add_argument('--images', type=str, default='augmented_data/cropped/images',
+                        help='Image directory, or a packed dataset (shards.py) which holds the labels too.')
+    parser.add_argument('--labels', type=str, default='augmented_data/cropped/labels', help='Label directory.')
+    parser.add_argument('--output', type=str, default='augmented_data/cropped/annotated_images',
+                        help='Output directory.')
+    parser.add_argument('--classes_file', type=str, default='cropped_classes.txt', help='Class names.')
+    parser.add_argument('--scale', type=int, choices=(1, 2, 4, 8), default=1,
+                        help='Decode JPEGs at 1/scale resolution for the annotated images (default: 1, full '
+                             'resolution). Contact sheets always decode at the smallest scale covering a cell.')
+    parser.add_argument('--sheets', action='store_true', help='Write contact sheets instead of one file per image.')
+    parser.add_argument('--grid', type=str, default='8x8', help='Thumbnails per sheet, columns x rows.')
+    parser.add_argument('--cell', type=int, default=160, help='Thumbnail cell size in pixels.')
+    parser.add_argument('--no_captions', action='store_true', help='No file names under the thumbnails.')
+    parser.add_argument('--no_thumbnail_labels', action='store_true', help='Only boxes on the thumbnails.')
+    parser.add_argument('--classes', type=str, default=None,
+                        help='Comma separated class names: only images containing one of them, and only their boxes.')
+    parser.add_argument('--group_by_class', action='store_true',
+                        help='Separate images (or sheets) per class, each showing only that class\' boxes.')
+    parser.add_argument('--sample', type=int, default=None, help='Random images per class group (or overall).')
+    parser.add_argument('--seed', type=int, default=0, help='Sampling seed.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Worker processes.')
+    args = parser.parse_args()
+
+    # Load class names
+    with open(args.classes_file, 'r') as f:
+        class_names = f.read().strip().split('\n')
+    selected = None
+    if args.classes:
+        unknown = [name for name in args.classes.split(',') if name.strip() not in class_names]
+        if unknown:
+            parser.error(f"unknown classes: {', '.join(unknown)}")
+        selected = [class_names.index(name.strip()) for name in args.classes.split(',')]
+
+    image_names, label_names, counts = list_samples(args.images, args.labels)
+    if counts.shape[1] < len(class_names):
+        counts = np.pad(counts, ((0, 0), (0, len(class_names) - counts.shape[1])))
+    samples = list(zip(image_names, label_names))
+
+    # Groups of (name, sample rows, classes drawn)
+    if args.group_by_class:
+        groups = [(class_names[c], np.flatnonzero(counts[:, c]), {c}) for c in (selected or range(len(class_names)))]
+    elif selected is not None:
+        groups = [('selected', np.flatnonzero(counts[:, selected].sum(axis=1)), set(selected))]
+    else:
+        groups = [('', np.arange(len(samples)), None)]
+    rng = random.Random(args.seed)
+
+    cols, rows = (int(v) for v in args.grid.lower().split('x'))
+    options = {'class_names': class_names, 'scale': args.scale, 'grid': (cols, rows), 'cell': (args.cell, args.cell),
+               'captions': not args.no_captions, 'thumbnail_labels': not args.no_thumbnail_labels}
+    tasks = []
+    for group_name, group_rows, keep_classes in groups:
+        group_rows = group_rows.tolist()
+        if args.sample is not None and len(group_rows) > args.sample:
+            group_rows = sorted(rng.sample(group_rows, args.sample))
+        group_samples = [samples[i] for i in group_rows]
+        task_options = dict(options, keep_classes=keep_classes)
+        output_dir = os.path.join(args.output, group_name) if args.group_by_class and not args.sheets else args.output
+        os.makedirs(output_dir, exist_ok=True)
+        if args.sheets:
+            per_sheet = cols * rows
+            prefix = f'{group_name}_' if group_name else 'sheet_'
+            for k, start in enumerate(range(0, len(group_samples), per_sheet)):
+                tasks.append(('sheet', args.images, args.labels, group_samples[start:start + per_sheet],
+                              os.path.join(output_dir, f'{prefix}{k:04d}.jpg'), task_options))
+        else:
+            chunk = max(len(group_samples) // (args.workers * 8), 1)
+            tasks += [('images', args.images, args.labels, group_samples[start:start + chunk], output_dir, task_options)
+                      for start in range(0, len(group_samples), chunk)]
+
+    if args.workers > 1:
+        with Pool(args.workers) as pool:
+            drawn = sum(pool.imap_unordered(_render_task, tasks))
+    else:
+        drawn = sum(map(_render_task, tasks))
+    what = f"{sum(t[0] == 'sheet' for t in tasks)} contact sheets" if args.sheets else 'annotated images'
+    print(f"Drew {drawn} images into {what} in {args.output}")
+
+
+if __name__ == '__main__':
+    main()
+
+# python view_annotations.py
+# python view_annotations.py --scale 2
+# python view_annotations.py --sheets --group_by_class --sample 64
+# python view_annotations.py --images augmented_data/images --labels augmented_data/labels --classes_file classes.txt --sheets --grid 6x4 --cell 320
+# python view_annotations.py --images augmented_data/packed --classes gloves,boots --sheets --workers 8